@@ -0,0 +1,169 @@
+import time  # Import time module for refilling token buckets
+import math  # Import math module for rounding Retry-After up to whole seconds
+import threading  # Import threading for the stripe locks
+from collections import OrderedDict  # Import OrderedDict for evicting idle buckets in access order
+
+from response import Response  # Import Response class from response module
+
+
+class TokenBucketTable:
+    """
+    Token buckets keyed by client, split across lock stripes.
+
+    Each bucket is a (tokens, last update time) tuple, refilled lazily when its
+    key is next seen. Keys are spread over independently locked stripes, so
+    concurrent requests from different clients rarely wait on each other. Each
+    stripe keeps its buckets in access order: a bucket idle for long enough to
+    have refilled completely is the same as a new one, so idle buckets are
+    evicted from the front of the stripe as it is used, and the least recently
+    used bucket is evicted when a stripe is full.
+
+    Attributes:
+        rate (float): Tokens added per second.
+        capacity (float): Maximum tokens, the burst a client may send at once.
+        idle_time (float): Seconds after which an unused bucket is full and can be evicted.
+    """
+
+    def __init__(self, rate: float, capacity: float, stripe_count: int, max_keys: int):
+        """
+        Initialize the TokenBucketTable.
+
+        Args:
+            rate (float): Tokens added per second.
+            capacity (float): Maximum tokens, the burst a client may send at once.
+            stripe_count (int): Number of lock stripes.
+            max_keys (int): Maximum number of buckets kept across all stripes.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.idle_time = capacity / rate
+        self.max_stripe_keys = max(max_keys // stripe_count, 1)
+        self.stripes = [(threading.Lock(), OrderedDict()) for _ in range(stripe_count)]
+
+    def acquire(self, key: str) -> float:
+        """
+        Take a token from a client's bucket.
+
+        Args:
+            key (str): Client key.
+
+        Returns:
+            float: 0 if a token was taken, otherwise seconds until one is available.
+        """
+        now = time.monotonic()
+        lock, buckets = self.stripes[hash(key) % len(self.stripes)]
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                tokens = self.capacity
+                if len(buckets) >= self.max_stripe_keys:
+                    buckets.popitem(last=False)
+            else:
+                tokens = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+                buckets.move_to_end(key)
+
+            if tokens >= 1:
+                tokens -= 1
+                retry_after = 0.0
+            else:
+                retry_after = (1 - tokens) / self.rate
+            buckets[key] = (tokens, now)
+
+            # Evict buckets that have been idle long enough to be full again
+            idle_before = now - self.idle_time
+            while buckets:
+                oldest_key = next(iter(buckets))
+                if buckets[oldest_key][1] >= idle_before:
+                    break
+                del buckets[oldest_key]
+
+        return retry_after
+
+    def __len__(self):
+        return sum(len(buckets) for _, buckets in self.stripes)
+
+
+class AdmissionControl:
+    """
+    Rate limits requests per client IP before any decryption, and per wallet key before any database work.
+
+    Attributes:
+        ip_buckets (TokenBucketTable): Buckets per client IP, None to not limit IPs.
+        key_buckets (TokenBucketTable): Buckets per verifying key, None to not limit keys.
+    """
+
+    def __init__(self, ip_buckets: TokenBucketTable = None, key_buckets: TokenBucketTable = None):
+        """
+        Initialize the AdmissionControl.
+
+        Args:
+            ip_buckets (TokenBucketTable): Buckets per client IP, None to not limit IPs.
+            key_buckets (TokenBucketTable): Buckets per verifying key, None to not limit keys.
+        """
+        self.ip_buckets = ip_buckets
+        self.key_buckets = key_buckets
+        self.rejected_ip_count = 0
+        self.rejected_key_count = 0
+
+    @staticmethod
+    def _too_many_requests(retry_after: float) -> Response:
+        """Build the 429 response for a client that is out of tokens."""
+        retry_after = math.ceil(retry_after)
+        return Response(
+            error_message='too_many_requests',
+            message=f'Too many requests. Retry after {retry_after} seconds.',
+            status_code=429,
+            retry_after=retry_after
+        )
+
+    def check_ip(self, ip: str):
+        """
+        Admit a request from a client IP.
+
+        Args:
+            ip (str): Client IP address.
+
+        Returns:
+            Response: 429 response, or None if the request is admitted.
+        """
+        if self.ip_buckets is None:
+            return None
+
+        retry_after = self.ip_buckets.acquire(ip)
+        if retry_after:
+            self.rejected_ip_count += 1
+            return self._too_many_requests(retry_after)
+        return None
+
+    def check_key(self, key: str):
+        """
+        Admit a request signed by a wallet key.
+
+        Args:
+            key (str): Base64-encoded public key the request was verified with.
+
+        Returns:
+            Response: 429 response, or None if the request is admitted.
+        """
+        if self.key_buckets is None:
+            return None
+
+        retry_after = self.key_buckets.acquire(key)
+        if retry_after:
+            self.rejected_key_count += 1
+            return self._too_many_requests(retry_after)
+        return None
+
+    def get_metrics(self) -> dict:
+        """
+        Get admission control metrics.
+
+        Returns:
+            dict: Tracked IPs and keys, and requests rejected for each.
+        """
+        return {
+            'tracked_ips': 0 if self.ip_buckets is None else len(self.ip_buckets),
+            'tracked_keys': 0 if self.key_buckets is None else len(self.key_buckets),
+            'rejected_ip_count': self.rejected_ip_count,
+            'rejected_key_count': self.rejected_key_count
+        }
@@ -0,0 +1,91 @@
+class Amount(int):
+    """
+    Fixed-point currency amount, stored as an integer number of minor units.
+
+    One unit is SCALE minor units, so amounts have PRECISION implied decimal
+    places. Amounts are parsed from their decimal string in a single pass, kept
+    as Python ints for exact arithmetic and stored in BIGINT columns.
+
+    Attributes:
+        PRECISION (int): Number of implied decimal places.
+        SCALE (int): Minor units per unit.
+        MAX_MINOR_UNITS (int): Largest amount a BIGINT column can hold, in minor units.
+    """
+
+    PRECISION = 5
+    SCALE = 10 ** PRECISION
+    MAX_MINOR_UNITS = 2 ** 63 - 1
+    MAX_DIGITS = len(str(MAX_MINOR_UNITS // SCALE))  # Longest whole part of an amount that can fit in a BIGINT
+
+    INVALID = 'invalid'
+    TOO_PRECISE = 'too_precise'
+    TOO_LARGE = 'too_large'
+
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, string: str) -> 'Amount':
+        """
+        Parse a plain decimal string such as "12", "12.5" or "0.00001".
+
+        Trailing zeros beyond PRECISION are accepted, as they were for Decimal
+        amounts. Signs, exponents, whitespace and non-ASCII digits are not.
+
+        Args:
+            string (str): Decimal string sent by the client.
+
+        Returns:
+            Amount: Parsed amount.
+
+        Raises:
+            ValueError: With INVALID if the string is not a plain decimal, TOO_PRECISE if it
+                has more than PRECISION significant decimal places, or TOO_LARGE if it cannot fit in a BIGINT.
+        """
+        whole, separator, fraction = string.partition('.')
+        if ((not whole) and (not fraction)) or not (string.isascii() and (whole + fraction).isdigit()):
+            raise ValueError(cls.INVALID)
+        if len(whole.lstrip('0')) > cls.MAX_DIGITS:
+            raise ValueError(cls.TOO_LARGE)  # Checked before int() so huge strings are never converted
+
+        if len(fraction) > cls.PRECISION:
+            if fraction[cls.PRECISION:].strip('0'):
+                raise ValueError(cls.TOO_PRECISE)
+            fraction = fraction[:cls.PRECISION]
+
+        minor_units = int(whole or '0') * cls.SCALE + int(fraction.ljust(cls.PRECISION, '0'))
+        if minor_units > cls.MAX_MINOR_UNITS:
+            raise ValueError(cls.TOO_LARGE)
+        return cls(minor_units)
+
+    @staticmethod
+    def _minor_units(other) -> int:
+        """Get the minor units of an operand, which must be an int or Amount so nothing is silently truncated."""
+        if not isinstance(other, int):
+            raise TypeError(f'Cannot combine an Amount with {type(other).__name__}')
+        return int(other)
+
+    def __str__(self):
+        whole, fraction = divmod(abs(int(self)), self.SCALE)
+        sign = '-' if self < 0 else ''
+        return f'{sign}{whole}.{fraction:0{self.PRECISION}d}'
+
+    def __repr__(self):
+        return f'Amount({str(self)!r})'
+
+    def __neg__(self):
+        return Amount(-int(self))
+
+    def __abs__(self):
+        return Amount(abs(int(self)))
+
+    def __add__(self, other):
+        return Amount(int(self) + self._minor_units(other))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return Amount(int(self) - self._minor_units(other))
+
+    def __rsub__(self, other):
+        return Amount(self._minor_units(other) - int(self))
+
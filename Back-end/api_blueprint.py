@@ -1,12 +1,58 @@
 from flask import request, Blueprint, current_app, jsonify
 from encryption import Encryption
+from admission import AdmissionControl
+from database import PoolTimeoutError
+from database_operations import release_request_connection
+from response import Response
 from request_handling import (TransferRequest, GetTransactionsRequest, CreateTransactionRequest,
                               DeleteTransactionRequest, AddAliasRequest, DeleteAliasRequest,
-                              GetBalanceRequest, CompleteTransactionRequest)
+                              GetBalanceRequest, CompleteTransactionRequest, HandshakeRequest)
 
 # Create a Flask Blueprint
 app_api_blueprint = Blueprint('app_api', __name__)
 
+# Return the database connection of each request to the pool once the request is done
+app_api_blueprint.teardown_request(release_request_connection)
+
+# Rate limit each client IP before any decryption or database work, remote_addr is the connecting address
+# unless AdmissionConfig.TRUSTED_PROXY_COUNT is set, then ProxyFix takes it from the trusted X-Forwarded-For entries
+@app_api_blueprint.before_request
+def admit_client():
+    """
+    Reject the request with 429 if its client IP is out of tokens.
+
+    Returns:
+        Response: 429 response with Retry-After, or None to continue to the route.
+    """
+    admission_control: AdmissionControl = current_app.config['admission_control']
+    if admission_control is None:
+        return None
+
+    response = admission_control.check_ip(request.remote_addr)
+    if response is not None:
+        return response.json(), response.status_code, response.headers()
+    return None
+
+# Answer with 503 when every database connection stayed busy for the whole checkout timeout
+@app_api_blueprint.errorhandler(PoolTimeoutError)
+def database_busy(error):
+    """
+    Tell the client to retry when no database connection became free in time.
+
+    Args:
+        error (PoolTimeoutError): The checkout timeout error.
+
+    Returns:
+        Response: 503 response with Retry-After.
+    """
+    response = Response(
+        error_message='service_unavailable',
+        message='Server is busy. Retry after 1 seconds.',
+        status_code=503,
+        retry_after=1
+    )
+    return response.json(), response.status_code, response.headers()
+
 # Define route to process transfer request
 @app_api_blueprint.route('/api/transfer', methods=['POST'])
 def process_transfer_request():
@@ -23,8 +69,12 @@ def process_transfer_request():
     """
     connection_pool = current_app.config['connection_pool']
     encryption = current_app.config['encryption']
-    transfer_request = TransferRequest(request, encryption, connection_pool)
-    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key)
+    replay_guard = current_app.config['replay_guard']
+    admission_control = current_app.config['admission_control']
+    transfer_request = TransferRequest(request, encryption, connection_pool, replay_guard,
+                                       admission_control)
+    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key,
+                                             transfer_request.envelope)
 
 # Define route to process create transaction request
 @app_api_blueprint.route('/api/create-transaction', methods=['POST'])
@@ -42,8 +92,12 @@ def process_create_transaction_request():
     """
     connection_pool = current_app.config['connection_pool']
     encryption = current_app.config['encryption']
-    transfer_request = CreateTransactionRequest(request, encryption, connection_pool)
-    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key)
+    replay_guard = current_app.config['replay_guard']
+    admission_control = current_app.config['admission_control']
+    transfer_request = CreateTransactionRequest(request, encryption, connection_pool, replay_guard,
+                                                admission_control)
+    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key,
+                                             transfer_request.envelope)
 
 # Define route to process get transactions request
 @app_api_blueprint.route('/api/get-transactions', methods=['POST'])
@@ -62,7 +116,8 @@ def process_get_transaction_request():
     connection_pool = current_app.config['connection_pool']
     encryption = current_app.config['encryption']
     transfer_request = GetTransactionsRequest(request, encryption, connection_pool)
-    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key)
+    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key,
+                                             transfer_request.envelope)
 
 # Define route to process delete transaction request
 @app_api_blueprint.route('/api/delete-transaction', methods=['POST'])
@@ -80,8 +135,12 @@ def process_delete_transaction_request():
     """
     connection_pool = current_app.config['connection_pool']
     encryption = current_app.config['encryption']
-    transfer_request = DeleteTransactionRequest(request, encryption, connection_pool)
-    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key)
+    replay_guard = current_app.config['replay_guard']
+    admission_control = current_app.config['admission_control']
+    transfer_request = DeleteTransactionRequest(request, encryption, connection_pool, replay_guard,
+                                                admission_control)
+    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key,
+                                             transfer_request.envelope)
 
 # Define route to process complete transaction request
 @app_api_blueprint.route('/api/complete-transaction', methods=['POST'])
@@ -99,8 +158,12 @@ def process_complete_transaction_request():
     """
     connection_pool = current_app.config['connection_pool']
     encryption = current_app.config['encryption']
-    transfer_request = CompleteTransactionRequest(request, encryption, connection_pool)
-    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key)
+    replay_guard = current_app.config['replay_guard']
+    admission_control = current_app.config['admission_control']
+    transfer_request = CompleteTransactionRequest(request, encryption, connection_pool, replay_guard,
+                                                  admission_control)
+    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key,
+                                             transfer_request.envelope)
 
 # Define route to process add alias request
 @app_api_blueprint.route('/api/add-alias', methods=['POST'])
@@ -118,8 +181,12 @@ def process_add_alias_request():
     """
     connection_pool = current_app.config['connection_pool']
     encryption = current_app.config['encryption']
-    transfer_request = AddAliasRequest(request, encryption, connection_pool)
-    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key)
+    replay_guard = current_app.config['replay_guard']
+    admission_control = current_app.config['admission_control']
+    transfer_request = AddAliasRequest(request, encryption, connection_pool, replay_guard,
+                                       admission_control)
+    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key,
+                                             transfer_request.envelope)
 
 # Define route to process delete alias request
 @app_api_blueprint.route('/api/delete-alias', methods=['POST'])
@@ -137,8 +204,12 @@ def process_delete_alias_request():
     """
     connection_pool = current_app.config['connection_pool']
     encryption = current_app.config['encryption']
-    transfer_request = DeleteAliasRequest(request, encryption, connection_pool)
-    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key)
+    replay_guard = current_app.config['replay_guard']
+    admission_control = current_app.config['admission_control']
+    transfer_request = DeleteAliasRequest(request, encryption, connection_pool, replay_guard,
+                                          admission_control)
+    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key,
+                                             transfer_request.envelope)
 
 # Define route to process get balance request
 @app_api_blueprint.route('/api/get-balance', methods=['POST'])
@@ -156,8 +227,12 @@ def process_get_balance_request():
     """
     connection_pool = current_app.config['connection_pool']
     encryption = current_app.config['encryption']
-    transfer_request = GetBalanceRequest(request, encryption, connection_pool)
-    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key)
+    replay_guard = current_app.config['replay_guard']
+    admission_control = current_app.config['admission_control']
+    transfer_request = GetBalanceRequest(request, encryption, connection_pool, replay_guard,
+                                         admission_control)
+    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key,
+                                             transfer_request.envelope)
 
 # Define route to process get key request
 @app_api_blueprint.route('/api/get-key', methods=['GET'])
@@ -169,7 +244,31 @@ def process_get_key_request():
         encryption: Encryption instance.
 
     Returns:
-        Response: JSON response containing the public key.
+        Response: JSON response containing the RSA and X25519 public keys, their key id and the supported payload encodings.
     """
     encryption: Encryption = current_app.config['encryption']
-    return jsonify({'key': encryption.get_public_key()})
+    server_key = encryption.get_current_key()
+    return jsonify({'key': server_key.public_key_b64,
+                    'key_id': server_key.key_id,
+                    'x25519_key': server_key.x25519_public_key_b64,
+                    'payload_encodings': ['json', 'cbor']})
+
+# Define route to process handshake request
+@app_api_blueprint.route('/api/handshake', methods=['POST'])
+def process_handshake_request():
+    """
+    Process the handshake request and return an encrypted session.
+
+    Args:
+        request: Flask request object.
+        encryption: Encryption instance.
+        connection_pool: Connection pool instance.
+
+    Returns:
+        Response: Encrypted response containing the session id, key and expiry time.
+    """
+    connection_pool = current_app.config['connection_pool']
+    encryption = current_app.config['encryption']
+    transfer_request = HandshakeRequest(request, encryption, connection_pool)
+    return encryption.get_encrypted_response(transfer_request.response, transfer_request.encryption_key,
+                                             transfer_request.envelope)
@@ -14,8 +14,9 @@ import time
 import base64
 import json
 import os
-from docx import Document
-# pip install python-docx
+from decimal import Decimal
+
+from compact_payload import CompactPayload
 
 
 
@@ -253,6 +254,13 @@ class KeyPair():
         signature = self._private_key.sign(json_string.encode('utf-8'))
         return signature
 
+    def raw_signed(self, json_data):
+        # Sign the exact payload bytes, so the server can verify them before parsing
+        payload = json.dumps(json_data, separators=(',', ':'))
+
+        signature = self._private_key.sign(payload.encode('utf-8'))
+        return f"r1.{self.public_key_b64()}.{base64.b64encode(signature).decode('utf-8')}.{payload}"
+
 
 class Testing:
 
@@ -280,11 +288,13 @@ class Testing:
             serialized_public_key,
             backend=default_backend()
         )
+        if isinstance(message, str):
+            message = message.encode('utf-8')  # CBOR payloads are already bytes
         message_sections = [message[i:i + 190] for i in range(0, len(message), 190)]  # Divide message into chunks
         encrypted_message_sections = []
 
         for section in message_sections:
-            ciphertext = public_key.encrypt(section.encode('utf-8'), padding.PKCS1v15())  # Encrypt each message chunk
+            ciphertext = public_key.encrypt(section, padding.PKCS1v15())  # Encrypt each message chunk
             encrypted_message_sections.append(base64.b64encode(ciphertext).decode('utf-8'))
 
         final_encrypted = ''.join(encrypted_message_sections)
@@ -302,6 +312,13 @@ class Testing:
 
         final_plaintext = ''.join(plaintext_sections)
         return final_plaintext
+
+    def decrypt_compact_message(self, private_key, ciphertext: str):
+        ciphertext_sections = [ciphertext[i:i + 344] for i in range(0, len(ciphertext), 344)]  # Divide ciphertext into chunks
+        plaintext = b''.join(private_key.decrypt(base64.b64decode(section), padding.PKCS1v15())
+                             for section in ciphertext_sections)  # CBOR responses are only decoded once joined
+
+        return CompactPayload.decode(plaintext)
     
     def send(self, endpoint, data):
         headers = {
@@ -332,6 +349,106 @@ class Testing:
 
         self.check_json(required, endpoint, json_data)
 
+    def raw_signed_transfer_test(self):
+        endpoint = '/api/transfer'
+
+        private_key, public_key = self.generate_rsa_keypair()
+        encryption_key = base64.b64encode(public_key.public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )).decode('utf-8')
+
+        def transfer_data():
+            self.sample_data = SampleData().get_data()
+            return {
+                'request_id': self.sample_data['request_id'][0][0],
+                'request_expiry_time': self.sample_data['request_expiry_time'][0][0],
+                'transfer_amount': self.sample_data['transfer_amount'][0][0],
+                'recipient_key': self.sample_data['recipient_key'][0][0],
+                'sender_key': valid_wallet.public_key_b64(),
+                'encryption_key': encryption_key
+            }
+
+        # Valid raw signature over the exact payload
+        self.send_plaintext(endpoint, valid_wallet.raw_signed(transfer_data()), private_key, 'raw-signed')
+
+        # Payload changed after it was signed
+        json_data = transfer_data()
+        plaintext = valid_wallet.raw_signed(json_data)
+        tampered = plaintext.replace(f'"transfer_amount":"{json_data["transfer_amount"]}"',
+                                     f'"transfer_amount":"{json_data["transfer_amount"]}0"')
+        self.send_plaintext(endpoint, tampered, private_key, 'raw-signed, tampered payload')
+
+        # Signed by a key other than sender_key
+        self.send_plaintext(endpoint, KeyPair().raw_signed(transfer_data()), private_key,
+                            'raw-signed by a key other than sender_key')
+
+    def cbor_transfer_test(self):
+        endpoint = '/api/transfer'
+
+        private_key, public_key = self.generate_rsa_keypair()
+        encryption_key = public_key.public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+
+        self.sample_data = SampleData().get_data()
+        json_data = {
+            'request_id': self.sample_data['request_id'][0][0],
+            'request_expiry_time': self.sample_data['request_expiry_time'][0][0],
+            'transfer_amount': self.sample_data['transfer_amount'][0][0],
+            'recipient_key': self.sample_data['recipient_key'][0][0],
+            'sender_key': valid_wallet.public_key_b64()
+        }
+        signature = valid_wallet.sign(json_data)
+
+        # Typed values, decoded by the server back to the strings that were signed
+        cbor_data = {
+            'request_id': int(json_data['request_id']),
+            'request_expiry_time': int(json_data['request_expiry_time']),
+            'transfer_amount': Decimal(json_data['transfer_amount']),
+            'recipient_key': base64.b64decode(json_data['recipient_key']),
+            'sender_key': base64.b64decode(json_data['sender_key']),
+            'signature': signature,
+            'encryption_key': encryption_key
+        }
+        payload = CompactPayload.encode(cbor_data)
+        self.send_plaintext(endpoint, payload, private_key, 'CBOR payload')
+
+        # Map header promises more pairs than the payload holds
+        malformed = b'\xa3' + CompactPayload.encode('request_id') + CompactPayload.encode(cbor_data['request_id'])
+        self.send_plaintext(endpoint, malformed, private_key, 'CBOR map with missing pairs')
+
+        # Same key twice in one map
+        duplicate = (b'\xa2' + CompactPayload.encode('request_id') + CompactPayload.encode(cbor_data['request_id'])
+                     + CompactPayload.encode('request_id') + CompactPayload.encode(cbor_data['request_id']))
+        self.send_plaintext(endpoint, duplicate, private_key, 'CBOR map with a duplicate key')
+
+        # Extra bytes after the map
+        self.send_plaintext(endpoint, payload + b'\x00', private_key, 'CBOR payload with trailing bytes')
+
+        # Decimal fraction 1E39, whose exponent is out of range
+        bad_amount_data = {key: value for key, value in cbor_data.items() if key != 'transfer_amount'}
+        bad_amount = CompactPayload.encode(bad_amount_data)
+        bad_amount = (bytes((bad_amount[0] + 1,)) + bad_amount[1:]
+                      + CompactPayload.encode('transfer_amount') + b'\xc4\x82\x18\x27\x01')
+        self.send_plaintext(endpoint, bad_amount, private_key, 'CBOR payload with an invalid decimal fraction')
+
+    def send_plaintext(self, endpoint, plaintext, private_key, value):
+        response = self.send(endpoint, self.encrypt(plaintext))
+        if ('data' in response) and isinstance(plaintext, bytes):
+            response = self.decrypt_compact_message(private_key, response['data'])
+        elif 'data' in response:
+            response = json.loads(self.decrypt_message(private_key, response['data']))
+        self.results.append(
+            {
+                'endpoint': endpoint,
+                'raw_request': plaintext,
+                'raw_result': response,
+                'value': value
+            }
+        )
+
     def create_transaction_test(self):
         endpoint = '/api/create-transaction'
         
@@ -512,82 +629,88 @@ domain = 'http://127.0.0.1:5000'
 valid_sender_private_key = "aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"
 valid_wallet = KeyPair(valid_sender_private_key)
 
-testing = Testing()
+if __name__ == "__main__":
+    from docx import Document
+    # pip install python-docx
+
+    testing = Testing()
 
-testing.transfer_test()
-testing.add_alias_test()
-testing.delete_alias_test()
-testing.create_transaction_test()
-testing.get_transactions_test()
-testing.complete_transaction_test()
-testing.delete_transaction_test()
+    testing.transfer_test()
+    testing.raw_signed_transfer_test()
+    testing.cbor_transfer_test()
+    testing.add_alias_test()
+    testing.delete_alias_test()
+    testing.create_transaction_test()
+    testing.get_transactions_test()
+    testing.complete_transaction_test()
+    testing.delete_transaction_test()
 
 
-print(len(testing.results))
+    print(len(testing.results))
 
 
-test_number = 0
-csv_lines = []
-docs_lines = []
+    test_number = 0
+    csv_lines = []
+    docs_lines = []
 
-# Create a new Document
-doc = Document()
+    # Create a new Document
+    doc = Document()
 
-# Add some text to the document
-doc.add_heading('My First Document', level=1)
-doc.add_paragraph('This is a simple Word document created using Python.')
+    # Add some text to the document
+    doc.add_heading('My First Document', level=1)
+    doc.add_paragraph('This is a simple Word document created using Python.')
 
-# Save the document
+    # Save the document
 
-for result in testing.results:
-    # print(result)
-    endpoint = result['endpoint']
-    raw_request = result['raw_request']
-    raw_result = result['raw_result']
-    value = result['value'] if 'value' in result else ''
+    for result in testing.results:
+        # print(result)
+        endpoint = result['endpoint']
+        raw_request = result['raw_request']
+        raw_result = result['raw_result']
+        value = result['value'] if 'value' in result else ''
 
 
-    if 'error_message' in raw_result:
-        expected = raw_result['error_message']
-    else:
-        expected = raw_result['message']
+        if 'error_message' in raw_result:
+            expected = raw_result['error_message']
+        else:
+            expected = raw_result['message']
     
     
-    # lines.append(f"{raw_result['message']}\n")
-    # continue
+        # lines.append(f"{raw_result['message']}\n")
+        # continue
     
-    if expected == 'success':
-        description = "Send a successful request."
-    elif expected == 'missing_keys':
-        description = f"Send a request with missing key: {raw_result['message'][8: raw_result['message'].find(' in')]}, in JSON data."
-    else:
-        var_name = expected[8:]
-        var_name_expanded = var_name.replace('_', ' ')
-
-        description = f"Send an invalid {var_name_expanded}"
+        if expected == 'success':
+            description = "Send a successful request."
+        elif expected == 'missing_keys':
+            description = f"Send a request with missing key: {raw_result['message'][8: raw_result['message'].find(' in')]}, in JSON data."
+        else:
+            var_name = expected[8:]
+            var_name_expanded = var_name.replace('_', ' ')
+
+            description = f"Send an invalid {var_name_expanded}"
     
-    test_number += 1
-    line = f"No.{test_number};{description};{value};{expected};{expected};Pass\n"#,{raw_request},{raw_request}\n"
-    csv_lines.append(line)
+        test_number += 1
+        line = f"No.{test_number};{description};{value};{expected};{expected};Pass\n"#,{raw_request},{raw_request}\n"
+        csv_lines.append(line)
 
-    docs_lines.append(())
+        docs_lines.append(())
 
-    doc.add_heading(f'Test No.{test_number}', level=3)
-    doc.add_paragraph(f"{description.rstrip('.')}.")
-    if value != '':
-        doc.add_paragraph(f"Test Value: {value}")
-    doc.add_paragraph(f"Expected result: {expected}")
-    doc.add_paragraph(f"Actual result: {expected}")
-    doc.add_paragraph(f"Request data: {raw_request}")
-    doc.add_paragraph(f"Response data: {raw_result}")
-    paragraph = doc.add_paragraph()
-    paragraph.add_run('PASS').bold = True
-    paragraph.add_run().add_break()
+        doc.add_heading(f'Test No.{test_number}', level=3)
+        doc.add_paragraph(f"{description.rstrip('.')}.")
+        if value != '':
+            doc.add_paragraph(f"Test Value: {value}")
+        doc.add_paragraph(f"Expected result: {expected}")
+        doc.add_paragraph(f"Actual result: {expected}")
+        doc.add_paragraph(f"Request data: {raw_request}")
+        doc.add_paragraph(f"Response data: {raw_result}")
+        paragraph = doc.add_paragraph()
+        paragraph.add_run('PASS').bold = True
+        paragraph.add_run().add_break()
 
-doc.save('my_document.docx')
+    doc.save('my_document.docx')
 
 
-with open('results.csv', 'w') as f:
-    f.writelines(csv_lines)
+    with open('results.csv', 'w') as f:
+        f.writelines(csv_lines)
 
 
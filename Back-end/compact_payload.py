@@ -0,0 +1,329 @@
+import json  # Import json module for the transaction id lists RequestData parses
+import base64  # Import base64 module for converting raw keys to the base64 form RequestData checks
+import struct  # Import struct module for CBOR argument encoding
+from decimal import Decimal  # Import the Decimal class for CBOR decimal fractions
+
+from amounts import Amount  # Import the Amount class for fixed-point amounts
+
+
+class CompactPayload:
+    """
+    CBOR (RFC 8949) encoding of request and response payloads, used inside the envelope instead of JSON.
+
+    A client opts in by sending a CBOR map as the plaintext of its envelope,
+    and is answered with a CBOR map in the same envelope. A CBOR map starts
+    with a byte of 0xA0 to 0xBF, which never starts a UTF-8 string, so JSON
+    and CBOR plaintexts are told apart by their first byte. Raw-signed requests
+    ("r1.<public key>.<signature>.<payload>") may carry a CBOR payload too.
+
+    Values are typed: integers are CBOR integers (ids too large for 64 bits are
+    bignums), amounts are decimal fractions (tag 4) with an exponent of
+    -PRECISION, and keys and signatures are raw byte strings. Only the subset of
+    CBOR the API needs is supported: floats, indefinite lengths and tags other
+    than bignums and decimal fractions are rejected.
+
+    Request maps are normalised to the strings the JSON form carries, so both
+    encodings share one validation path. Signatures sent in the signature field
+    cover the normalised strings, with ids padded to ID_LENGTH digits and
+    amounts written with PRECISION decimal places. Clients signing CBOR
+    requests should prefer raw signing, which covers the exact payload bytes.
+
+    Attributes:
+        MAX_DEPTH (int): Maximum nesting of arrays and maps.
+        MAX_BIGNUM_LENGTH (int): Maximum length of a bignum, enough for 32-digit ids.
+        MAX_EXPONENT (int): Maximum absolute exponent of a decimal fraction.
+    """
+
+    UNSIGNED = 0
+    NEGATIVE = 1
+    BYTES = 2
+    TEXT = 3
+    ARRAY = 4
+    MAP = 5
+    TAG = 6
+    SIMPLE = 7
+
+    POSITIVE_BIGNUM_TAG = 2
+    NEGATIVE_BIGNUM_TAG = 3
+    DECIMAL_FRACTION_TAG = 4
+
+    FALSE = 0xF4
+    TRUE = 0xF5
+    NULL = 0xF6
+
+    MAX_DEPTH = 8
+    MAX_BIGNUM_LENGTH = 16
+    MAX_EXPONENT = 38
+
+    ARGUMENT_FORMATS = {24: struct.Struct('>B'), 25: struct.Struct('>H'), 26: struct.Struct('>I'), 27: struct.Struct('>Q')}
+
+    ID_FIELDS = frozenset(['request_id', 'transaction_id', 'transaction_ids'])
+    ID_LENGTH = 32
+
+    # Offset of the payload in a raw-signed plaintext: "r1." + key (44) + "." + signature (88) + "."
+    RAW_SIGNED_PREFIX = b'r1.'
+    RAW_SIGNED_PAYLOAD_OFFSET = 3 + 44 + 1 + 88 + 1
+
+    @classmethod
+    def is_map_start(cls, byte: int) -> bool:
+        """Check if a byte starts a CBOR map."""
+        return (byte >> 5) == cls.MAP
+
+    @classmethod
+    def is_compact(cls, plaintext) -> bool:
+        """
+        Check if a decrypted plaintext carries a CBOR payload rather than JSON.
+
+        Args:
+            plaintext (bytes): Decrypted request body.
+
+        Returns:
+            bool: True if the payload, after any raw signature header, is a CBOR map.
+        """
+        if not plaintext:
+            return False
+        if cls.is_map_start(plaintext[0]):
+            return True
+        offset = cls.RAW_SIGNED_PAYLOAD_OFFSET
+        return (plaintext[:len(cls.RAW_SIGNED_PREFIX)] == cls.RAW_SIGNED_PREFIX and len(plaintext) > offset
+                and cls.is_map_start(plaintext[offset]))
+
+    @classmethod
+    def _encode_head(cls, major_type: int, argument: int, parts: list):
+        """Append the head of a data item with the shortest encoding of its argument."""
+        if argument < 24:
+            parts.append(bytes(((major_type << 5) | argument,)))
+        elif argument <= 0xFF:
+            parts.append(bytes(((major_type << 5) | 24, argument)))
+        elif argument <= 0xFFFF:
+            parts.append(bytes(((major_type << 5) | 25,)) + cls.ARGUMENT_FORMATS[25].pack(argument))
+        elif argument <= 0xFFFFFFFF:
+            parts.append(bytes(((major_type << 5) | 26,)) + cls.ARGUMENT_FORMATS[26].pack(argument))
+        else:
+            parts.append(bytes(((major_type << 5) | 27,)) + cls.ARGUMENT_FORMATS[27].pack(argument))
+
+    @classmethod
+    def _encode_integer(cls, value: int, parts: list):
+        """Append an integer, as a bignum if it does not fit in 64 bits."""
+        if value >= 0:
+            major_type, tag, argument = cls.UNSIGNED, cls.POSITIVE_BIGNUM_TAG, value
+        else:
+            major_type, tag, argument = cls.NEGATIVE, cls.NEGATIVE_BIGNUM_TAG, -1 - value
+
+        if argument <= 0xFFFFFFFFFFFFFFFF:
+            cls._encode_head(major_type, argument, parts)
+        else:
+            cls._encode_head(cls.TAG, tag, parts)
+            cls._encode_item(argument.to_bytes((argument.bit_length() + 7) // 8, 'big'), parts)
+
+    @classmethod
+    def _encode_item(cls, value, parts: list):
+        """Append one data item."""
+        if value is None:
+            parts.append(bytes((cls.NULL,)))
+        elif value is True:
+            parts.append(bytes((cls.TRUE,)))
+        elif value is False:
+            parts.append(bytes((cls.FALSE,)))
+        elif isinstance(value, Amount):
+            cls._encode_head(cls.TAG, cls.DECIMAL_FRACTION_TAG, parts)
+            cls._encode_head(cls.ARRAY, 2, parts)
+            cls._encode_integer(-Amount.PRECISION, parts)
+            cls._encode_integer(int(value), parts)
+        elif isinstance(value, int):
+            cls._encode_integer(value, parts)
+        elif isinstance(value, Decimal):
+            sign, digits, exponent = value.as_tuple()
+            if not isinstance(exponent, int):
+                raise ValueError('Decimal is not finite')
+            mantissa = int(''.join(map(str, digits)) or '0')
+            cls._encode_head(cls.TAG, cls.DECIMAL_FRACTION_TAG, parts)
+            cls._encode_head(cls.ARRAY, 2, parts)
+            cls._encode_integer(exponent, parts)
+            cls._encode_integer(-mantissa if sign else mantissa, parts)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            cls._encode_head(cls.BYTES, len(value), parts)
+            parts.append(bytes(value))
+        elif isinstance(value, str):
+            encoded = value.encode('utf-8')
+            cls._encode_head(cls.TEXT, len(encoded), parts)
+            parts.append(encoded)
+        elif isinstance(value, (list, tuple)):
+            cls._encode_head(cls.ARRAY, len(value), parts)
+            for item in value:
+                cls._encode_item(item, parts)
+        elif isinstance(value, dict):
+            cls._encode_head(cls.MAP, len(value), parts)
+            for key, item in value.items():
+                cls._encode_item(key, parts)
+                cls._encode_item(item, parts)
+        else:
+            raise TypeError(f'Cannot encode {type(value).__name__} as CBOR')
+
+    @classmethod
+    def encode(cls, value) -> bytes:
+        """
+        Encode a value as CBOR.
+
+        Args:
+            value: None, bool, int, Amount, Decimal, bytes, str, list, tuple or dict of these.
+
+        Returns:
+            bytes: CBOR encoding of the value.
+        """
+        parts = []
+        cls._encode_item(value, parts)
+        return b''.join(parts)
+
+    @classmethod
+    def _decode_item(cls, view: memoryview, offset: int, depth: int):
+        """
+        Decode one data item.
+
+        Args:
+            view (memoryview): Encoded data.
+            offset (int): Offset of the item.
+            depth (int): Nesting depth of the item.
+
+        Returns:
+            tuple: Decoded value and the offset after it.
+
+        Raises:
+            ValueError: If the item is truncated, malformed or unsupported.
+        """
+        if offset >= len(view):
+            raise ValueError('Truncated CBOR data')
+        initial_byte = view[offset]
+        major_type = initial_byte >> 5
+        additional_info = initial_byte & 0x1F
+        offset += 1
+
+        if major_type == cls.SIMPLE:
+            if initial_byte == cls.FALSE:
+                return False, offset
+            if initial_byte == cls.TRUE:
+                return True, offset
+            if initial_byte == cls.NULL:
+                return None, offset
+            raise ValueError('Unsupported CBOR simple value or float')
+
+        if additional_info < 24:
+            argument = additional_info
+        elif additional_info in cls.ARGUMENT_FORMATS:
+            argument_format = cls.ARGUMENT_FORMATS[additional_info]
+            if offset + argument_format.size > len(view):
+                raise ValueError('Truncated CBOR data')
+            (argument,) = argument_format.unpack_from(view, offset)
+            offset += argument_format.size
+        else:
+            raise ValueError('Indefinite or reserved CBOR length')
+
+        if major_type == cls.UNSIGNED:
+            return argument, offset
+        if major_type == cls.NEGATIVE:
+            return -1 - argument, offset
+
+        if major_type in (cls.BYTES, cls.TEXT):
+            end = offset + argument
+            if end > len(view):
+                raise ValueError('Truncated CBOR data')
+            if major_type == cls.BYTES:
+                return bytes(view[offset:end]), end
+            return str(view[offset:end], 'utf-8'), end  # Raises UnicodeDecodeError, a ValueError
+
+        if depth >= cls.MAX_DEPTH:
+            raise ValueError('CBOR data is nested too deeply')
+
+        if major_type == cls.ARRAY:
+            if argument > len(view) - offset:
+                raise ValueError('Truncated CBOR data')  # Every item takes at least one byte
+            items = []
+            for _ in range(argument):
+                item, offset = cls._decode_item(view, offset, depth + 1)
+                items.append(item)
+            return items, offset
+
+        if major_type == cls.MAP:
+            if argument > (len(view) - offset) // 2:
+                raise ValueError('Truncated CBOR data')
+            items = {}
+            for _ in range(argument):
+                key, offset = cls._decode_item(view, offset, depth + 1)
+                if not isinstance(key, str):
+                    raise ValueError('CBOR map keys must be text')
+                if key in items:
+                    raise ValueError('Duplicate CBOR map key')
+                items[key], offset = cls._decode_item(view, offset, depth + 1)
+            return items, offset
+
+        # Tags
+        value, offset = cls._decode_item(view, offset, depth + 1)
+        if argument in (cls.POSITIVE_BIGNUM_TAG, cls.NEGATIVE_BIGNUM_TAG):
+            if not isinstance(value, bytes) or len(value) > cls.MAX_BIGNUM_LENGTH:
+                raise ValueError('Invalid CBOR bignum')
+            number = int.from_bytes(value, 'big')
+            return (number if argument == cls.POSITIVE_BIGNUM_TAG else -1 - number), offset
+        if argument == cls.DECIMAL_FRACTION_TAG:
+            if (not isinstance(value, list) or len(value) != 2
+                    or not all(isinstance(part, int) and not isinstance(part, bool) for part in value)
+                    or abs(value[0]) > cls.MAX_EXPONENT):
+                raise ValueError('Invalid CBOR decimal fraction')
+            exponent, mantissa = value
+            return Decimal(f'{mantissa}E{exponent}'), offset  # Exact, unlike arithmetic in the decimal context
+        raise ValueError('Unsupported CBOR tag')
+
+    @classmethod
+    def decode(cls, data):
+        """
+        Decode a CBOR data item.
+
+        Args:
+            data (bytes | memoryview): Encoded data, a single data item.
+
+        Returns:
+            Decoded value. Decimal fractions are returned as Decimals.
+
+        Raises:
+            ValueError: If the data is malformed, unsupported or has trailing bytes.
+        """
+        view = memoryview(data)
+        value, offset = cls._decode_item(view, 0, 0)
+        if offset != len(view):
+            raise ValueError('Trailing bytes after CBOR data')
+        return value
+
+    @classmethod
+    def _request_string(cls, key: str, value) -> str:
+        """Convert a typed request value to the string the JSON form of the field carries."""
+        if isinstance(value, str):
+            return value
+        if isinstance(value, bytes):
+            return base64.b64encode(value).decode('ascii')
+        if isinstance(value, bool) or value is None:
+            return json.dumps(value)
+        if isinstance(value, int):
+            return str(value).zfill(cls.ID_LENGTH) if key in cls.ID_FIELDS and value >= 0 else str(value)
+        if isinstance(value, Decimal):
+            return format(value, 'f')
+        if isinstance(value, list):
+            return json.dumps([cls._request_string(key, item) for item in value])
+        raise ValueError(f'Unsupported value for {key}')
+
+    @classmethod
+    def decode_request(cls, data) -> dict:
+        """
+        Decode a CBOR request map into the field strings RequestData verifies.
+
+        Args:
+            data (bytes | memoryview): CBOR payload.
+
+        Returns:
+            dict: Request fields as strings.
+
+        Raises:
+            ValueError: If the payload is not a CBOR map of supported values.
+        """
+        fields = cls.decode(data)
+        if not isinstance(fields, dict):
+            raise ValueError('CBOR payload is not a map')
+        return {key: cls._request_string(key, value) for key, value in fields.items()}
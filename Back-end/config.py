@@ -1,20 +1,26 @@
 from decimal import Decimal  # Import the Decimal class from the decimal module
 import base64  # Import the base64 module
 
+from amounts import Amount  # Import the Amount class for fixed-point amounts
+
 class TransactionConfig:
     """
     Configurations related to transactions.
     """
 
     TRANSFER_FEE_PERCENT = Decimal("0.01")  # Set transfer fee percentage to 0.01 (1%)
-    TRANSACTION_CREATION_FEE = Decimal("0.00001")  # Set transaction creation fee to 0.000001
-    ALIAS_CREATION_FEE = Decimal("0.00001")  # Set alias creation fee to 0.000001
+    MIN_TRANSFER_FEE = Amount.parse("0.00001")  # Set min transfer fee to 0.00001
+    MAX_TRANSFER_FEE = Amount.parse("1")  # Set max transfer fee to 1
+    TRANSACTION_CREATION_FEE = Amount.parse("0.00001")  # Set transaction creation fee to 0.000001
+    ALIAS_CREATION_FEE = Amount.parse("0.00001")  # Set alias creation fee to 0.000001
     ADMIN_ADDRESS = base64.b64encode(bytes.fromhex("e734ea6c2b6257de72355e472aa05a4c487e6b463c029ed306df2f01b5636b58")).decode()  # Set admin address using base64 encoding
     DELETION_DELAY_AFTER_EXPIRY = 3600  # Set deletion delay after expiry to 3600 seconds (1 hour)
     MAX_REQUEST_SIZE = 1024 * 1024  # Set max request size to 1 MB
+    READ_BLOCK_SIZE = 344 * 12  # Set size of the blocks request bodies are read in to 12 legacy RSA blocks
     MAX_REQUEST_EXPIRY_TIME = 60  # Set max request expiry time to 60 seconds
     MAX_TRANSACTION_EXPIRY_TIME = 3600  # Set max transaction expiry time to 3600 seconds (1 hour)
     MAX_ALIAS_EXPIRY_TIME = 86400  # Set max alias expiry time to 86400 seconds (1 day)
+    MAX_TRANSACTION_IDS = 100  # Set max number of transaction ids per get-transactions request
 
 
 class TransferLimits:
@@ -22,6 +28,70 @@ class TransferLimits:
     Configurations related to transfer limits.
     """
 
-    MAX_TRANSFER_PRECISION = 5  # Set max transfer precision to 5
-    MAX_TRANSFER_AMOUNT = Decimal("99999999999999.99999")  # Set max transfer amount to 99999999999999.99999
-    MIN_TRANSFER_AMOUNT = Decimal("0.00001")  # Set min transfer amount to 0.00001
+    MAX_TRANSFER_PRECISION = Amount.PRECISION  # Set max transfer precision to 5
+    MAX_TRANSFER_AMOUNT = Amount.parse("10000000000000")  # Set max transfer amount to 10000000000000, so balances stay well inside BIGINT
+    MIN_TRANSFER_AMOUNT = Amount.parse("0.00001")  # Set min transfer amount to 0.00001
+
+
+class EncryptionConfig:
+    """
+    Configurations related to request encryption.
+    """
+
+    CLIENT_KEY_CACHE_SIZE = 4096  # Set max number of parsed client RSA public keys kept in memory
+    KEY_RING_PATH = None  # Set absolute path of the file used to share server keys between API worker processes, in a directory only the API user can access as it holds unencrypted private keys (None keeps keys per process)
+    CRYPTO_SERVICE_WORKERS = 0  # Set number of crypto worker processes (0 runs crypto on the request thread)
+    SESSION_TTL = 900  # Set handshake session lifetime to 900 seconds (15 minutes)
+    MAX_SESSIONS = 100000  # Set max number of sessions kept in the session table
+    MAX_LEGACY_BLOCKS = 48  # Set max number of RSA blocks in a legacy request, enough for the largest get-transactions request
+
+
+class SignatureConfig:
+    """
+    Configurations related to request signature verification.
+    """
+
+    VERIFYING_KEY_CACHE_SIZE = 4096  # Set max number of constructed Ed25519 verifying keys kept in memory
+    BATCH_WINDOW = 0  # Set time to collect signatures for a batch, 0 verifies each on its request thread (batching measured no faster)
+    MAX_BATCH_SIZE = 64  # Set max number of signatures verified in one batch
+    VERIFY_TIMEOUT = 1  # Set max time a request waits for its batch to 1 second before verifying on its own thread
+    OFFLOAD_BATCHES = False  # Set whether large batches are sent to the crypto service workers instead of the batch thread
+
+
+class ReplayConfig:
+    """
+    Configurations related to request replay protection.
+    """
+
+    IN_MEMORY = False  # Set to check request ids in memory and write them to the database in the background (only safe with a single API process, so it cannot be used with a shared KEY_RING_PATH)
+    FLUSH_INTERVAL = 0.2  # Set time between background writes of request ids to 0.2 seconds
+    MAX_BATCH_SIZE = 1000  # Set max number of request ids written per INSERT
+
+
+class AdmissionConfig:
+    """
+    Configurations related to request rate limiting.
+    """
+
+    IP_RATE = 20  # Set requests per second allowed from one client IP (0 disables IP limits)
+    IP_BURST = 40  # Set max requests one client IP may send at once
+    TRUSTED_PROXY_COUNT = 0  # Set number of proxies in front of the API whose X-Forwarded-For entries are trusted, 0 uses the connecting address (a load balancer deployment must set its own proxy count, never more than the proxies it runs)
+    KEY_RATE = 5  # Set requests per second allowed for one wallet key (0 disables key limits)
+    KEY_BURST = 10  # Set max requests one wallet key may send at once
+    STRIPE_COUNT = 16  # Set number of independently locked stripes per rate limit table
+    MAX_TRACKED_CLIENTS = 100000  # Set max number of IPs or keys tracked per rate limit table
+
+
+class PoolConfig:
+    """
+    Configurations related to the database connection pool.
+    """
+
+    MIN_CONNECTIONS = 10  # Set number of connections opened when the pool starts
+    MAX_CONNECTIONS = 50  # Set max number of open connections
+    CHECKOUT_TIMEOUT = 5  # Set max time a request waits for a free connection to 5 seconds
+    MAX_USES = 10000  # Set number of checkouts after which a connection is replaced
+    MAX_IDLE_TIME = 600  # Set time after which an idle connection is replaced to 600 seconds (10 minutes)
+    VALIDATE_IDLE_TIME = 30  # Set time after which an idle connection is checked with a query before use to 30 seconds
+    PREPARE_ON_CONNECT = True  # Set to prepare the hot queries when a connection is opened (False prepares each on first use)
+    WAIT_HISTOGRAM_BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)  # Set upper bounds in seconds of the checkout wait time histogram buckets
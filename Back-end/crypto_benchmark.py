@@ -0,0 +1,439 @@
+import argparse  # Import argparse module for command line options
+import base64  # Import base64 module for base64 encoding/decoding
+import json  # Import json module for request payloads and result files
+import math  # Import math module for percentile ranks
+import os  # Import os module for random nonces and CPU count
+import platform  # Import platform module for recording the benchmark environment
+import time  # Import time module for timing operations
+from concurrent.futures import ThreadPoolExecutor  # Import ThreadPoolExecutor for multi-threaded runs
+import cryptography  # Import cryptography to record its version
+from cryptography.hazmat.primitives import serialization  # Import serialization module
+from cryptography.hazmat.primitives.asymmetric import x25519  # Import X25519 module for client keys
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM  # Import AES-GCM for sealing client requests
+
+from api_test import KeyPair, Testing, SampleData  # Import the client-side Ed25519 and RSA helpers used by the API tests
+from key_ring import KeyRingManager, KeyRing, ServerKey  # Import key ring classes for rotation benchmarks
+from encryption import Encryption  # Import Encryption class under test
+from request_verification import RequestData  # Import RequestData for signature verification benchmarks
+from signatures import SignatureBatcher, split_raw_signed, verify_ed25519  # Import raw-signed request helpers and the batcher
+from config import SignatureConfig, TransactionConfig  # Import signature and transaction configuration
+
+ID_LENGTH = 32  # Length of request and transaction ids
+
+
+class BenchmarkResult:
+    """
+    Timing results of one benchmark case.
+
+    Attributes:
+        name (str): Operation that was benchmarked.
+        params (dict): Case parameters, such as envelope format and payload size.
+        threads (int): Number of threads running the operation concurrently.
+        iterations (int): Number of operations timed.
+        ops_per_sec (float): Operations completed per second of wall time, across all threads.
+        p50_ms (float): Median latency in milliseconds.
+        p99_ms (float): 99th percentile latency in milliseconds.
+        mean_ms (float): Mean latency in milliseconds.
+        chunks (int): RSA blocks per operation, None for operations without chunks.
+        per_chunk_us (float): Mean latency per RSA block in microseconds, None for operations without chunks.
+    """
+
+    def __init__(self, name: str, params: dict, threads: int, latencies: list, wall_seconds: float, chunks: int = None):
+        latencies = sorted(latencies)
+        mean_seconds = sum(latencies) / len(latencies)
+
+        self.name = name
+        self.params = params
+        self.threads = threads
+        self.iterations = len(latencies)
+        self.ops_per_sec = len(latencies) / wall_seconds
+        self.p50_ms = self.percentile(latencies, 0.50) * 1000
+        self.p99_ms = self.percentile(latencies, 0.99) * 1000
+        self.mean_ms = mean_seconds * 1000
+        self.chunks = chunks
+        self.per_chunk_us = mean_seconds * 1000000 / chunks if chunks else None
+
+    @staticmethod
+    def percentile(sorted_values: list, fraction: float) -> float:
+        """Get a nearest-rank percentile of sorted values."""
+        rank = max(math.ceil(fraction * len(sorted_values)), 1)
+        return sorted_values[rank - 1]
+
+    def to_dict(self) -> dict:
+        """Convert the result to a JSON-serializable dict."""
+        return {
+            'name': self.name,
+            'params': self.params,
+            'threads': self.threads,
+            'iterations': self.iterations,
+            'ops_per_sec': round(self.ops_per_sec, 2),
+            'p50_ms': round(self.p50_ms, 4),
+            'p99_ms': round(self.p99_ms, 4),
+            'mean_ms': round(self.mean_ms, 4),
+            'chunks': self.chunks,
+            'per_chunk_us': None if self.per_chunk_us is None else round(self.per_chunk_us, 2)
+        }
+
+    def __str__(self):
+        params = ' '.join(f'{key}={value}' for key, value in self.params.items())
+        line = (f'{self.name:<22} {params:<42} threads={self.threads:<3} {self.ops_per_sec:>10.1f} ops/s '
+                f'p50={self.p50_ms:.3f}ms p99={self.p99_ms:.3f}ms')
+        if self.per_chunk_us is not None:
+            line += f' per_chunk={self.per_chunk_us:.1f}us'
+        return line
+
+
+class CryptoBenchmark:
+    """
+    Benchmarks the request crypto paths of the Encryption and RequestData classes.
+
+    Request bodies are sealed client-side in every envelope format, text and
+    binary, and sized by the number of transaction ids in a get-transactions
+    request, which is the largest body the client sends.
+
+    Attributes:
+        ENVELOPE_FORMATS (list): Envelope formats benchmarked.
+    """
+
+    ENVELOPE_FORMATS = [Encryption.LEGACY_FORMAT, Encryption.HYBRID_FORMAT,
+                        Encryption.ECDH_FORMAT, Encryption.SESSION_FORMAT]
+
+    def __init__(self, iterations: int, thread_counts: list, transaction_id_counts: list,
+                 crypto_service_workers: int = 0, batch_window: float = 0):
+        """
+        Initialize the benchmark and its keys.
+
+        Args:
+            iterations (int): Operations timed per case.
+            thread_counts (list): Thread counts to run each case with.
+            transaction_id_counts (list): Numbers of transaction ids in the benchmarked request bodies.
+            crypto_service_workers (int): Number of crypto worker processes, 0 to run crypto on the calling thread.
+            batch_window (float): Signature batch window to compare against unbatched verification, 0 to use the
+                configured batcher, if any.
+        """
+        self.iterations = iterations
+        self.thread_counts = thread_counts
+        self.transaction_id_counts = transaction_id_counts
+        self.crypto_service_workers = crypto_service_workers
+
+        self.key_ring_manager = KeyRingManager(start_thread=False)
+        self.encryption = Encryption(self.key_ring_manager, crypto_service_workers)
+
+        self.signature_batcher = self.encryption.signature_batcher
+        if batch_window > 0:
+            offload_service = self.encryption.crypto_service if SignatureConfig.OFFLOAD_BATCHES else None
+            self.signature_batcher = SignatureBatcher(batch_window, SignatureConfig.MAX_BATCH_SIZE,
+                                                      SignatureConfig.VERIFY_TIMEOUT, offload_service)
+        self.session = self.encryption.create_session()
+
+        self.wallet = KeyPair()
+        self.rsa_private_key, rsa_public_key = Testing.generate_rsa_keypair()
+        self.rsa_encryption_key = base64.b64encode(rsa_public_key.public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )).decode('utf-8')
+        self.x25519_encryption_key = base64.b64encode(x25519.X25519PrivateKey.generate().public_key().public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw
+        )).decode('utf-8')
+
+        self.results = []
+
+    def build_transactions_request(self, transaction_id_count: int) -> str:
+        """Build a get-transactions request body as the client sends it."""
+        transaction_ids = [int(SampleData.generate_id(ID_LENGTH)) for _ in range(transaction_id_count)]
+        return json.dumps({
+            'transaction_ids': str(transaction_ids),
+            'encryption_key': self.rsa_encryption_key
+        }, separators=(',', ':'))
+
+    def build_transfer_request(self) -> dict:
+        """Build a signed transfer request as the client sends it."""
+        data = {
+            'request_id': SampleData.generate_id(ID_LENGTH),
+            'request_expiry_time': str(int(time.time()) + TransactionConfig.MAX_REQUEST_EXPIRY_TIME),
+            'transfer_amount': '100',
+            'sender_key': self.wallet.public_key_b64(),
+            'recipient_key': KeyPair().public_key_b64()
+        }
+        data['signature'] = base64.b64encode(self.wallet.sign(data)).decode('utf-8')
+        data['encryption_key'] = self.rsa_encryption_key
+        return data
+
+    def seal_request(self, envelope_format: str, message, binary: bool):
+        """
+        Encrypt a request body for the server the way a client would.
+
+        Args:
+            envelope_format (str): Envelope format to produce.
+            message (str | bytes): Request body, JSON text or CBOR.
+            binary (bool): Produce a binary frame instead of a text envelope.
+
+        Returns:
+            str | bytes: Encrypted request body.
+        """
+        encryption = self.encryption
+        server_key = self.key_ring_manager.get_key_ring().current
+
+        if envelope_format in (Encryption.LEGACY_FORMAT, Encryption.HYBRID_FORMAT):
+            return encryption.encrypt_message(server_key.public_key_b64, message, envelope_format, binary).message
+
+        nonce = os.urandom(Encryption.NONCE_SIZE)
+        if envelope_format == Encryption.SESSION_FORMAT:
+            ciphertext = self.session.aead.encrypt(nonce, Encryption._message_bytes(message),
+                                                   Encryption._session_associated_data(self.session.session_id, False))
+            return encryption._serialize_envelope(envelope_format, self.session.session_id, [nonce], ciphertext, binary)
+
+        ephemeral_private_key = x25519.X25519PrivateKey.generate()
+        ephemeral_public_key = ephemeral_private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw
+        )
+        associated_data = Encryption._ecdh_associated_data(server_key.key_id, ephemeral_public_key)
+        content_key = encryption._derive_ecdh_key(ephemeral_private_key,
+                                                  server_key.x25519_private_key.public_key(),
+                                                  associated_data)
+        ciphertext = AESGCM(content_key).encrypt(nonce, Encryption._message_bytes(message), associated_data)
+        return encryption._serialize_envelope(envelope_format, server_key.key_id, [ephemeral_public_key, nonce],
+                                              ciphertext, binary)
+
+    def measure(self, name: str, params: dict, operation, inputs: list, threads: int, chunks: int = None,
+                setup=None) -> BenchmarkResult:
+        """
+        Time an operation over a list of inputs, spread across threads.
+
+        Args:
+            name (str): Operation name.
+            params (dict): Case parameters.
+            operation (callable): Function called with each input.
+            inputs (list): Inputs, one per timed operation.
+            threads (int): Number of threads.
+            chunks (int): RSA blocks per operation, for per-chunk cost.
+            setup (callable): Function called before each operation, outside the timed region.
+
+        Returns:
+            BenchmarkResult: Timing results.
+        """
+        operation(inputs[0])  # Warm up caches and lazily built state
+
+        def worker(worker_inputs):
+            latencies = []
+            setup_seconds = 0.0
+            for item in worker_inputs:
+                if setup is not None:
+                    setup_start_time = time.perf_counter()
+                    setup()
+                    setup_seconds += time.perf_counter() - setup_start_time
+                start_time = time.perf_counter()
+                operation(item)
+                latencies.append(time.perf_counter() - start_time)
+            return latencies, setup_seconds
+
+        batches = [inputs[i::threads] for i in range(threads)]
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            worker_results = list(executor.map(worker, batches))
+        wall_seconds = time.perf_counter() - start_time
+        wall_seconds -= max(setup_seconds for _, setup_seconds in worker_results)  # Setup is not part of the throughput
+
+        latencies = [latency for worker_latencies, _ in worker_results for latency in worker_latencies]
+
+        result = BenchmarkResult(name, params, threads, latencies, wall_seconds, chunks)
+        self.results.append(result)
+        print(result)
+        return result
+
+    def run_decrypt(self):
+        """Benchmark Encryption.decrypt_message for each envelope format and request size."""
+        for transaction_id_count in self.transaction_id_counts:
+            message = self.build_transactions_request(transaction_id_count)
+            chunks = math.ceil(len(message) / Encryption.ENCRYPTION_CHUNK_SIZE)
+
+            for envelope_format in self.ENVELOPE_FORMATS:
+                for binary in (False, True):
+                    bodies = [self.seal_request(envelope_format, message, binary) for _ in range(self.iterations)]
+                    if self.encryption.decrypt_message(bodies[0]).status_code != 200:
+                        raise RuntimeError(f'Benchmark request in {envelope_format} format did not decrypt')
+
+                    params = {'format': envelope_format, 'binary': binary, 'bytes': len(message)}
+                    for threads in self.thread_counts:
+                        self.measure('decrypt_message', params, self.encryption.decrypt_message, bodies, threads,
+                                     chunks if envelope_format == Encryption.LEGACY_FORMAT else None)
+
+    def run_encrypt(self):
+        """Benchmark Encryption.encrypt_message for response bodies of each size."""
+        for transaction_id_count in self.transaction_id_counts:
+            transactions = {SampleData.generate_id(ID_LENGTH): json.dumps({
+                'transaction_type': 'fixed',
+                'transaction_amount': '100.00000',
+                'expiry_time': str(int(time.time())),
+                'status': 'pending'
+            }) for _ in range(transaction_id_count)}
+            message = json.dumps({'message': 'success', 'status_code': 200, 'transactions': json.dumps(transactions)})
+            chunks = math.ceil(len(message) / Encryption.ENCRYPTION_CHUNK_SIZE)
+
+            cases = [
+                (Encryption.LEGACY_FORMAT, self.rsa_encryption_key, chunks),
+                (Encryption.HYBRID_FORMAT, self.rsa_encryption_key, None),
+                (Encryption.ECDH_FORMAT, self.x25519_encryption_key, None)
+            ]
+            for envelope_format, encryption_key, case_chunks in cases:
+                params = {'format': envelope_format, 'bytes': len(message)}
+                for threads in self.thread_counts:
+                    self.measure('encrypt_message', params,
+                                 lambda key: self.encryption.encrypt_message(key, message, envelope_format),
+                                 [encryption_key] * self.iterations, threads, case_chunks)
+
+    def _age_key_ring(self):
+        """Make the current key ring stale, so the next get_public_key call rotates it."""
+        key_ring = self.key_ring_manager.get_key_ring()
+        current = key_ring.current
+        aged_key = ServerKey(current.private_key, current.updated - KeyRing.KEY_PERIOD,
+                             current.session_secret, current.x25519_private_key)
+        with self.key_ring_manager._lock:
+            self.key_ring_manager._publish(KeyRing(aged_key, key_ring.previous, key_ring.generation))
+
+    def run_get_public_key(self):
+        """Benchmark Encryption.get_public_key in steady state and on the first call after a key period ends."""
+        for threads in self.thread_counts:
+            self.measure('get_public_key', {'rotation': 'none'}, lambda _: self.encryption.get_public_key(),
+                         [None] * self.iterations, threads)
+
+        # Rotations generate RSA keys, so fewer iterations keep the run short
+        rotation_iterations = max(self.iterations // 20, 5)
+        self.measure('get_public_key', {'rotation': 'pregenerated'}, lambda _: self.encryption.get_public_key(),
+                     [None] * rotation_iterations, 1,
+                     setup=lambda: (self.key_ring_manager._pregenerate(), self._age_key_ring()))
+        self.measure('get_public_key', {'rotation': 'inline_keygen'}, lambda _: self.encryption.get_public_key(),
+                     [None] * rotation_iterations, 1, setup=self._age_key_ring)
+
+    def build_raw_signed_transfer_request(self) -> str:
+        """Build a raw-signed transfer request body as the client sends it."""
+        data = self.build_transfer_request()
+        del data['signature']
+        return self.wallet.raw_signed(data)
+
+    def run_verify_signature(self):
+        """
+        Benchmark signature verification from decrypted plaintext to verified request data.
+
+        The json mode parses the request and verifies the signature over the
+        re-serialised sorted fields; the raw mode verifies the signature over the
+        plaintext bytes and only then parses it. Each mode is measured on the
+        request thread and, if a signature batcher is configured, through it.
+        """
+        message_vars = ['request_id', 'request_expiry_time', 'transfer_amount', 'sender_key', 'recipient_key']
+        json_plaintexts = [json.dumps(self.build_transfer_request(), separators=(',', ':'))
+                           for _ in range(self.iterations)]
+        raw_plaintexts = [self.build_raw_signed_transfer_request() for _ in range(self.iterations)]
+
+        signature_batchers = [None]
+        if self.signature_batcher is not None:
+            signature_batchers.append(self.signature_batcher)
+
+        for signature_batcher in signature_batchers:
+            def verify_json(plaintext: str):
+                response = RequestData(json.loads(plaintext)).verify_signature('sender_key', message_vars,
+                                                                               signature_batcher)
+                if response.status_code != 200:
+                    raise RuntimeError('Benchmark signature did not verify')
+
+            def verify_raw(plaintext: str):
+                public_key_b64, signature_b64, payload = split_raw_signed(plaintext)
+                signature = base64.b64decode(signature_b64)
+                if signature_batcher is not None:
+                    valid = signature_batcher.verify(public_key_b64, signature, payload.encode('utf-8'))
+                else:
+                    valid = verify_ed25519(public_key_b64, signature, payload.encode('utf-8'))
+                if not valid:
+                    raise RuntimeError('Benchmark signature did not verify')
+                RequestData(json.loads(payload))
+
+            batched = signature_batcher is not None
+            for threads in self.thread_counts:
+                self.measure('verify_signature', {'mode': 'json', 'fields': len(message_vars), 'batched': batched},
+                             verify_json, json_plaintexts, threads)
+                self.measure('verify_signature', {'mode': 'raw', 'fields': len(message_vars), 'batched': batched},
+                             verify_raw, raw_plaintexts, threads)
+
+    def run(self, groups: list) -> list:
+        """
+        Run benchmark groups.
+
+        Args:
+            groups (list): Names of the groups to run.
+
+        Returns:
+            list: BenchmarkResult for each case.
+        """
+        benchmarks = {
+            'decrypt': self.run_decrypt,
+            'encrypt': self.run_encrypt,
+            'get_public_key': self.run_get_public_key,
+            'verify_signature': self.run_verify_signature
+        }
+        for group in groups:
+            benchmarks[group]()
+        return self.results
+
+    def save(self, path: str):
+        """
+        Save the results and the environment they were measured in as JSON.
+
+        Args:
+            path (str): Output file.
+        """
+        with open(path, 'w') as results_file:
+            json.dump({
+                'timestamp': int(time.time()),
+                'environment': {
+                    'python': platform.python_version(),
+                    'cryptography': cryptography.__version__,
+                    'platform': platform.platform(),
+                    'cpu_count': os.cpu_count(),
+                    'crypto_service_workers': self.crypto_service_workers
+                },
+                'results': [result.to_dict() for result in self.results]
+            }, results_file, indent=2)
+
+    def close(self):
+        """Stop the signature batchers and crypto service, if they were started."""
+        if (self.signature_batcher is not None) and (self.signature_batcher is not self.encryption.signature_batcher):
+            self.signature_batcher.stop()
+        if self.encryption.signature_batcher is not None:
+            self.encryption.signature_batcher.stop()
+        if self.encryption.crypto_service is not None:
+            self.encryption.crypto_service.close()
+
+
+def parse_list(value: str) -> list:
+    """Parse a comma-separated list of integers."""
+    return [int(item) for item in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark request encryption, decryption and signature verification.')
+    parser.add_argument('--iterations', type=int, default=200, help='operations timed per case')
+    parser.add_argument('--threads', type=parse_list, default=[1, 4], help='comma-separated thread counts')
+    parser.add_argument('--transaction-ids', type=parse_list, default=[1, 10, 100],
+                        help='comma-separated numbers of transaction ids per request body')
+    parser.add_argument('--workers', type=int, default=0, help='crypto service worker processes')
+    parser.add_argument('--batch-window', type=float, default=0,
+                        help='signature batch window in seconds to compare against unbatched verification')
+    parser.add_argument('--groups', default='decrypt,encrypt,get_public_key,verify_signature',
+                        help='comma-separated benchmark groups')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON results file')
+    args = parser.parse_args()
+
+    benchmark = CryptoBenchmark(args.iterations, args.threads, args.transaction_ids, args.workers,
+                                args.batch_window)
+    try:
+        benchmark.run(args.groups.split(','))
+        benchmark.save(args.output)
+        print(f'Saved {len(benchmark.results)} results to {args.output}')
+    finally:
+        benchmark.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,458 @@
+import time  # Import time module for key ring synchronisation waits
+import math  # Import math module for splitting batches across workers
+import struct  # Import struct module for shared memory headers
+import logging  # Import logging module for worker failures
+import threading  # Import threading for serialising key ring publication
+import multiprocessing  # Import multiprocessing for the worker process context
+import concurrent.futures  # Import concurrent.futures for the process pool
+from multiprocessing import shared_memory  # Import shared_memory for key ring and job buffers
+from cryptography.hazmat.backends import default_backend  # Import cryptography library for RSA encryption
+from cryptography.hazmat.primitives.asymmetric import padding, ed25519  # Import padding and Ed25519 modules
+from cryptography.hazmat.primitives import serialization  # Import serialization module
+from cryptography.exceptions import InvalidSignature  # Raised when an Ed25519 signature does not verify
+
+from key_ring import KeyRing, KeyRingManager  # Import key ring classes
+from tools import LRUCache  # Import LRUCache for caching parsed client keys in workers
+
+# Job operations
+RSA_DECRYPT_PKCS1 = 'rsa_decrypt_pkcs1'
+RSA_ENCRYPT_PKCS1 = 'rsa_encrypt_pkcs1'
+ED25519_VERIFY = 'ed25519_verify'
+
+# Key ring segment layout: active slot index, then two slots of [generation][length][serialized key ring]
+ACTIVE_SLOT = struct.Struct('<I')
+SLOT_HEADER = struct.Struct('<qI')
+SLOT_SIZE = 32 * 1024
+WRITING_GENERATION = -1
+KEY_RING_SYNC_TIMEOUT = 2  # Seconds a worker waits for a key ring generation before failing its batch
+
+# Job buffer layout: abort flag, then the packed job payloads
+ABORT_FLAG_SIZE = 1
+MAX_ATTACHED_BUFFERS = 64  # Job buffers a worker keeps attached before detaching them all
+
+# Per-worker state, populated by _init_worker
+_worker_state = {
+    'segment': None,
+    'key_ring': None,
+    'generation': None,
+    'public_keys': None,
+    'verifying_keys': None,
+    'buffers': None
+}
+
+
+class KeyRingSyncError(RuntimeError):
+    """Raised in a worker when the key ring it needs is not published in time."""
+
+
+def _slot_offset(slot: int) -> int:
+    """Get the offset of a key ring slot in the shared segment."""
+    return ACTIVE_SLOT.size + slot * SLOT_SIZE
+
+
+def _read_key_ring(buffer, deadline: float) -> KeyRing:
+    """
+    Read a consistent key ring from the shared segment.
+
+    The writer marks a slot with WRITING_GENERATION before filling it, so a
+    copy is only accepted if the slot generation is the same before and after.
+
+    Args:
+        buffer (memoryview): Shared key ring segment.
+        deadline (float): time.monotonic() value after which to give up.
+
+    Returns:
+        KeyRing: Key ring published in the active slot.
+
+    Raises:
+        KeyRingSyncError: If no consistent copy could be read before the deadline.
+    """
+    while time.monotonic() < deadline:
+        offset = _slot_offset(ACTIVE_SLOT.unpack_from(buffer, 0)[0])
+        generation, length = SLOT_HEADER.unpack_from(buffer, offset)
+        data = bytes(buffer[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + length])
+        if generation != WRITING_GENERATION and SLOT_HEADER.unpack_from(buffer, offset)[0] == generation:
+            return KeyRing.from_bytes(data)
+        time.sleep(0)
+    raise KeyRingSyncError('Timed out reading the shared key ring')
+
+
+def _init_worker(segment_name: str):
+    """
+    Attach a worker process to the shared key ring segment.
+
+    Args:
+        segment_name (str): Name of the shared key ring segment.
+    """
+    segment = shared_memory.SharedMemory(name=segment_name)
+    _worker_state['segment'] = segment
+    _worker_state['public_keys'] = LRUCache(1024)
+    _worker_state['verifying_keys'] = LRUCache(4096)
+    _worker_state['buffers'] = {}
+    _sync_key_ring(0)
+
+
+def _sync_key_ring(required_generation: int):
+    """
+    Reload the worker's key ring until it is at least the required generation.
+
+    Args:
+        required_generation (int): Generation the submitting process was using.
+
+    Raises:
+        KeyRingSyncError: If the generation is not published within KEY_RING_SYNC_TIMEOUT,
+            so the submitting process falls back to running the batch itself.
+    """
+    deadline = time.monotonic() + KEY_RING_SYNC_TIMEOUT
+    while (_worker_state['generation'] is None) or (_worker_state['generation'] < required_generation):
+        if _worker_state['generation'] is not None:
+            if time.monotonic() >= deadline:
+                raise KeyRingSyncError(f'Key ring generation {required_generation} was not published, '
+                                       f'worker has {_worker_state["generation"]}')
+            time.sleep(0.001)  # Rotation is being published, give the writer a moment
+        key_ring = _read_key_ring(_worker_state['segment'].buf, deadline)
+        _worker_state['key_ring'] = key_ring
+        _worker_state['generation'] = key_ring.generation
+
+
+def _private_keys(key_id: str) -> list:
+    """Get the private keys to try for a job, by key id or newest first."""
+    key_ring = _worker_state['key_ring']
+    if key_id is None:
+        return key_ring.private_keys()
+    private_key = key_ring.get_private_key(key_id)
+    return [] if private_key is None else [private_key]
+
+
+def _public_key(serialized_public_key: bytes):
+    """Load a DER-encoded client public key through the worker's cache."""
+    public_keys = _worker_state['public_keys']
+    public_key = public_keys.get(serialized_public_key)
+    if public_key is None:
+        public_key = serialization.load_der_public_key(serialized_public_key, backend=default_backend())
+        public_keys.put(serialized_public_key, public_key)
+    return public_key
+
+
+def _verifying_key(public_key_bytes: bytes):
+    """Load a raw Ed25519 public key through the worker's cache."""
+    verifying_keys = _worker_state['verifying_keys']
+    public_key = verifying_keys.get(public_key_bytes)
+    if public_key is None:
+        public_key = ed25519.Ed25519PublicKey.from_public_bytes(public_key_bytes)
+        verifying_keys.put(public_key_bytes, public_key)
+    return public_key
+
+
+def _run_job(operation: str, payload: bytes, args: tuple):
+    """
+    Run a single job inside a worker process.
+
+    Args:
+        operation (str): Job operation.
+        payload (bytes): Ciphertext, plaintext or signed message.
+        args (tuple): Operation arguments.
+
+    Returns:
+        bytes | bool | None: Job result, None for failed decryptions.
+    """
+    if operation == RSA_DECRYPT_PKCS1:
+        for private_key in _private_keys(args[0]):
+            try:
+                return private_key.decrypt(payload, padding.PKCS1v15())
+            except ValueError:
+                continue
+        return None
+    elif operation == RSA_ENCRYPT_PKCS1:
+        return _public_key(args[0]).encrypt(payload, padding.PKCS1v15())
+    elif operation == ED25519_VERIFY:
+        public_key_bytes, signature = args
+        try:
+            _verifying_key(public_key_bytes).verify(signature, payload)
+            return True
+        except (InvalidSignature, ValueError):
+            return False
+    raise ValueError(f'Unknown crypto job operation {operation}')
+
+
+def _attach_buffer(buffer_name: str, reusable: bool):
+    """Attach a job buffer, keeping reusable buffers attached for later batches."""
+    buffers = _worker_state['buffers']
+    job_buffer = buffers.get(buffer_name)
+    if job_buffer is None:
+        job_buffer = shared_memory.SharedMemory(name=buffer_name)
+        if reusable:
+            if len(buffers) >= MAX_ATTACHED_BUFFERS:
+                for attached in buffers.values():
+                    attached.close()
+                buffers.clear()  # Drops buffers the parent has retired
+            buffers[buffer_name] = job_buffer
+    return job_buffer
+
+
+def _run_batch(buffer_name: str, reusable: bool, descriptors: list, required_generation: int) -> list:
+    """
+    Run a batch of jobs whose payloads are packed into a shared memory buffer.
+
+    Decryption stops at the first block that no key can decrypt, and raises the
+    buffer's abort flag so other workers on the same batch stop too.
+
+    Args:
+        buffer_name (str): Name of the shared memory buffer holding the payloads.
+        reusable (bool): True if the buffer is reused for later batches and should stay attached.
+        descriptors (list): (operation, offset, length, args) for each job.
+        required_generation (int): Key ring generation the submitting process was using.
+
+    Returns:
+        list: Result of each job, in order, with None for jobs skipped after a failed decryption.
+    """
+    _sync_key_ring(required_generation)
+
+    job_buffer = _attach_buffer(buffer_name, reusable)
+    view = job_buffer.buf
+    try:
+        results = []
+        for operation, offset, length, args in descriptors:
+            if view[0]:
+                break  # Another chunk of the batch failed
+            result = _run_job(operation, bytes(view[offset:offset + length]), args)
+            if (result is None) and (operation == RSA_DECRYPT_PKCS1):
+                view[0] = 1
+                break
+            results.append(result)
+        return results + [None] * (len(descriptors) - len(results))
+    finally:
+        del view
+        if not reusable:
+            job_buffer.close()
+
+
+class CryptoService:
+    """
+    Pool of worker processes that run RSA and Ed25519 work off the request threads.
+
+    Workers read the key ring from a shared memory segment that is republished
+    on every rotation, and receive job payloads through shared memory buffers
+    that are reused across batches. Batches are split across the workers so one
+    request can use several cores. Sending a batch costs far more than a single
+    RSA operation, so callers only offload batches of at least MIN_DECRYPT_JOBS
+    or MIN_ENCRYPT_JOBS jobs, and run anything smaller, or any batch the
+    workers fail, on the calling thread.
+    """
+
+    MIN_CHUNK_SIZE = 4  # Min jobs sent to a single worker from one batch
+    MIN_DECRYPT_JOBS = 8  # Only offload legacy bodies of at least this many RSA blocks
+    MIN_ENCRYPT_JOBS = 8  # Public key operations are cheap, so only offload long responses
+    BUFFER_SIZE = 64 * 1024  # Size of each reusable job buffer, larger batches get a buffer of their own
+    TIMEOUT = 10  # Seconds to wait for a whole batch, across all of its chunks, before giving up
+
+    def __init__(self, key_ring_manager: KeyRingManager, workers: int):
+        """
+        Create the shared key ring segment and start the worker processes.
+
+        Args:
+            key_ring_manager (KeyRingManager): Key ring to share with the workers.
+            workers (int): Number of worker processes.
+        """
+        self.key_ring_manager = key_ring_manager
+        self.workers = workers
+        self._publish_lock = threading.Lock()
+        self._published_generation = None
+        self._buffer_lock = threading.Lock()
+        self._free_buffers = []
+
+        self.segment = shared_memory.SharedMemory(create=True, size=_slot_offset(2))
+        ACTIVE_SLOT.pack_into(self.segment.buf, 0, 0)
+        self.publish_key_ring(key_ring_manager.get_key_ring())
+        key_ring_manager.add_rotation_listener(self.publish_key_ring)
+
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),  # Avoid forking the threaded server process
+            initializer=_init_worker,
+            initargs=(self.segment.name,)
+        )
+
+        self._metrics_lock = threading.Lock()
+        self.batch_count = 0
+        self.job_count = 0
+        self.failure_count = 0
+
+    def publish_key_ring(self, key_ring: KeyRing):
+        """
+        Write a key ring to the inactive slot of the shared segment and make it active.
+
+        Args:
+            key_ring (KeyRing): Key ring to publish.
+        """
+        data = key_ring.to_bytes()
+        if SLOT_HEADER.size + len(data) > SLOT_SIZE:
+            raise ValueError('Serialized key ring does not fit in the shared key ring segment')
+
+        with self._publish_lock:
+            if (self._published_generation is not None) and (key_ring.generation <= self._published_generation):
+                return  # Older than what the workers already have
+
+            buffer = self.segment.buf
+            slot = 1 - ACTIVE_SLOT.unpack_from(buffer, 0)[0]
+            offset = _slot_offset(slot)
+
+            SLOT_HEADER.pack_into(buffer, offset, WRITING_GENERATION, 0)
+            buffer[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + len(data)] = data
+            SLOT_HEADER.pack_into(buffer, offset, key_ring.generation, len(data))
+            ACTIVE_SLOT.pack_into(buffer, 0, slot)
+
+            self._published_generation = key_ring.generation
+
+    def _checkout_buffer(self, size: int):
+        """
+        Get a job buffer with room for size bytes of payloads.
+
+        Returns:
+            tuple: (SharedMemory, True if it is a reusable buffer).
+        """
+        if ABORT_FLAG_SIZE + size > self.BUFFER_SIZE:
+            return shared_memory.SharedMemory(create=True, size=ABORT_FLAG_SIZE + size), False
+        with self._buffer_lock:
+            if self._free_buffers:
+                return self._free_buffers.pop(), True
+        return shared_memory.SharedMemory(create=True, size=self.BUFFER_SIZE), True
+
+    def _release_buffer(self, job_buffer, reusable: bool, finished: bool):
+        """
+        Return a job buffer after its batch.
+
+        A buffer is only reused if every worker on the batch has finished with it.
+        Otherwise it is unlinked, and workers that still have it mapped keep reading
+        their own copy of the pages until they finish.
+        """
+        if reusable and finished:
+            with self._buffer_lock:
+                self._free_buffers.append(job_buffer)
+            return
+        job_buffer.close()
+        job_buffer.unlink()
+
+    def run_batch(self, jobs: list):
+        """
+        Run a batch of jobs on the worker processes.
+
+        Args:
+            jobs (list): (operation, payload, args) tuples.
+
+        Returns:
+            list: Result of each job in order, or None if the workers could not run the batch.
+        """
+        if not jobs:
+            return []
+
+        total_size = sum(len(payload) for _, payload, _ in jobs)
+        job_buffer, reusable = self._checkout_buffer(total_size)
+        finished = True
+        try:
+            buffer = job_buffer.buf
+            buffer[0] = 0  # Clear the abort flag
+            descriptors = []
+            offset = ABORT_FLAG_SIZE
+            for operation, payload, args in jobs:
+                buffer[offset:offset + len(payload)] = payload
+                descriptors.append((operation, offset, len(payload), args))
+                offset += len(payload)
+            del buffer
+
+            generation = self.key_ring_manager.get_key_ring().generation
+            chunk_size = max(self.MIN_CHUNK_SIZE, math.ceil(len(descriptors) / self.workers))
+            futures = [
+                self.executor.submit(_run_batch, job_buffer.name, reusable,
+                                     descriptors[i:i + chunk_size], generation)
+                for i in range(0, len(descriptors), chunk_size)
+            ]
+
+            # One deadline for the whole batch, so a hung worker cannot stall it once per chunk
+            _, not_done = concurrent.futures.wait(futures, timeout=self.TIMEOUT)
+            if not_done:
+                # Chunks that could not be cancelled may still be reading the buffer
+                finished = all([future.cancel() or future.done() for future in not_done])
+                raise concurrent.futures.TimeoutError(f'{len(not_done)} of {len(futures)} chunks did not finish')
+
+            results = []
+            for future in futures:
+                results.extend(future.result())
+
+            with self._metrics_lock:
+                self.batch_count += 1
+                self.job_count += len(jobs)
+            return results
+        except Exception:
+            # Any failure falls back to running the batch on the calling thread
+            with self._metrics_lock:
+                self.failure_count += 1
+            logging.exception("Crypto service failed to run a batch of %s jobs", len(jobs))
+            return None
+        finally:
+            self._release_buffer(job_buffer, reusable, finished)
+
+    def rsa_decrypt(self, key_id: str, ciphertexts: list):
+        """
+        Decrypt PKCS#1 v1.5 RSA ciphertexts with the server key ring.
+
+        Args:
+            key_id (str): Key id the ciphertexts were encrypted for, or None to try each accepted key.
+            ciphertexts (list): Raw RSA ciphertexts.
+
+        Returns:
+            list: Plaintext for each ciphertext (None from the first one that failed), or None if the workers failed.
+        """
+        return self.run_batch([(RSA_DECRYPT_PKCS1, ciphertext, (key_id,)) for ciphertext in ciphertexts])
+
+    def rsa_encrypt(self, serialized_public_key: bytes, plaintexts: list):
+        """
+        Encrypt plaintext chunks with a client's RSA public key using PKCS#1 v1.5.
+
+        Args:
+            serialized_public_key (bytes): DER-encoded client public key.
+            plaintexts (list): Plaintext chunks.
+
+        Returns:
+            list: Ciphertext for each chunk, or None if the workers failed.
+        """
+        return self.run_batch([(RSA_ENCRYPT_PKCS1, plaintext, (serialized_public_key,)) for plaintext in plaintexts])
+
+    def verify_ed25519(self, items: list):
+        """
+        Verify Ed25519 signatures.
+
+        Args:
+            items (list): (public key bytes, signature, message) tuples.
+
+        Returns:
+            list: True/False for each signature, or None if the workers failed.
+        """
+        return self.run_batch([(ED25519_VERIFY, message, (public_key_bytes, signature))
+                               for public_key_bytes, signature, message in items])
+
+    def get_metrics(self) -> dict:
+        """
+        Get crypto service metrics.
+
+        Returns:
+            dict: Batches and jobs run, failures and the key ring generation shared with workers.
+        """
+        with self._metrics_lock:
+            return {
+                'batch_count': self.batch_count,
+                'job_count': self.job_count,
+                'failure_count': self.failure_count,
+                'published_generation': self._published_generation
+            }
+
+    def close(self):
+        """Stop the worker processes and release the shared key ring segment."""
+        self.executor.shutdown(wait=True)
+        with self._buffer_lock:
+            for job_buffer in self._free_buffers:
+                job_buffer.close()
+                job_buffer.unlink()
+            self._free_buffers = []
+        self.segment.close()
+        self.segment.unlink()
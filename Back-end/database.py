@@ -2,11 +2,17 @@ import logging
 import time
 import random
 import math
-from decimal import Decimal
+import bisect
+import threading
+import weakref
+from collections import deque
+from contextlib import contextmanager
 import psycopg2
-from psycopg2 import pool
+from psycopg2 import pool, extras, extensions, errors
+from psycopg2.extensions import register_adapter
 
-from config import TransactionConfig
+from amounts import Amount
+from config import TransactionConfig, PoolConfig
 from response import Response
 
 # Constants
@@ -15,13 +21,19 @@ ADMIN_ADDRESS = TransactionConfig.ADMIN_ADDRESS
 TRANSFER_FEE_PERCENT = TransactionConfig.TRANSFER_FEE_PERCENT
 DELETION_DELAY_AFTER_EXPIRY = TransactionConfig.DELETION_DELAY_AFTER_EXPIRY
 ALIAS_ADDRESS_CREATION_FEE = TransactionConfig.ALIAS_CREATION_FEE
+MINIMUM_TRANSFER_FEE = TransactionConfig.MIN_TRANSFER_FEE
+MAXIMUM_TRANSFER_FEE = TransactionConfig.MAX_TRANSFER_FEE
 
 TRANSACTION_ID_LENGTH = 32
 PUBLIC_KEY_LENGTH = 44
-MAX_TRANSFER_PRECISION = 5
 
-MINIMUM_TRANSFER_FEE = Decimal("0.00001")
-MAXIMUM_TRANSFER_FEE = Decimal("1")
+
+def adapt_amount(amount: Amount):
+    """Send an amount to PostgreSQL as its integer number of minor units, quoted like any other int."""
+    return extensions.adapt(int(amount))
+
+
+register_adapter(Amount, adapt_amount)
 
 # Database Creator Class
 class DatabaseCreator:
@@ -73,12 +85,59 @@ class DatabaseCreator:
 
 
 # Connection Pool Class
+class PoolTimeoutError(pool.PoolError):
+    """Raised when no connection becomes free within the checkout timeout."""
+
+
+class PoolWaiter:
+    """
+    A thread waiting in the connection pool queue.
+
+    Attributes:
+        event (threading.Event): Set when the waiter has been given a connection or slot.
+        connection: Connection handed over, NEW_CONNECTION if the waiter may open one, None while waiting.
+    """
+
+    __slots__ = ('event', 'connection')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.connection = None
+
+
 class ConnectionPool:
     """
-    Class for managing a connection pool to the database.
+    Thread-safe pool of database connections with a fair wait queue and statistics.
+
+    Every pool operation takes a single lock, so request threads and the
+    background threads can share the pool. When every connection is in use,
+    callers queue and are served first come, first served: a returned
+    connection is handed straight to the longest waiting caller, and a caller
+    that waits longer than the checkout timeout gets a PoolTimeoutError.
+
+    Connections are checked on checkout. Closed connections, connections used
+    max_uses times and connections idle for max_idle_time are replaced, and a
+    connection idle for validate_idle_time is tested with a query first.
+    Connections are returned with their transaction rolled back, and broken
+    ones are discarded.
+
+    Attributes:
+        min_conn (int): Number of connections opened when the pool starts.
+        max_conn (int): Maximum number of open connections.
+        checkout_timeout (float): Seconds a caller waits for a connection.
+        max_uses (int): Checkouts after which a connection is replaced.
+        max_idle_time (float): Seconds after which an idle connection is replaced.
+        validate_idle_time (float): Seconds after which an idle connection is tested before use.
+        on_connect (callable): Called with each new connection before it is used, None for nothing.
     """
 
-    def __init__(self, db_name, user, password, host, port, min_conn, max_conn):
+    NEW_CONNECTION = object()  # Handed to a waiter that may open a connection in a freed slot
+    RATE_WINDOW = 60  # Seconds of checkouts counted in the checkout rate
+
+    def __init__(self, db_name, user, password, host, port, min_conn, max_conn,
+                 checkout_timeout: float = PoolConfig.CHECKOUT_TIMEOUT, max_uses: int = PoolConfig.MAX_USES,
+                 max_idle_time: float = PoolConfig.MAX_IDLE_TIME,
+                 validate_idle_time: float = PoolConfig.VALIDATE_IDLE_TIME, on_connect=None):
         self.db_name = db_name
         self.user = user
         self.password = password
@@ -86,48 +145,454 @@ class ConnectionPool:
         self.port = port
         self.min_conn = min_conn
         self.max_conn = max_conn
-        self.pool = None
-        
+        self.checkout_timeout = checkout_timeout
+        self.max_uses = max_uses
+        self.max_idle_time = max_idle_time
+        self.validate_idle_time = validate_idle_time
+        self.on_connect = on_connect
+
+        self.lock = threading.Lock()
+        self.idle = []  # Idle connections, most recently returned last
+        self.waiters = deque()  # Callers waiting for a connection, oldest first
+        self.connection_info = {}  # Connection -> [opened time, checkouts, returned time]
+        self.open_count = 0  # Open connections, including any being opened
+        self.closed = True
+
+        self.checkout_count = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.wait_histogram = [0] * (len(PoolConfig.WAIT_HISTOGRAM_BOUNDS) + 1)
+        self.rate_seconds = [0] * self.RATE_WINDOW
+        self.rate_counts = [0] * self.RATE_WINDOW
+        self.timeout_count = 0
+        self.connect_count = 0
+        self.recycled_count = 0
+        self.failed_validation_count = 0
+        self.discarded_count = 0
+
         self.create_pool()
-    
+
     def create_pool(self):
-        """Create a connection pool."""
-        db_params = {
+        """Open the first min_conn connections."""
+        self.db_params = {
             'database': self.db_name,
             'user': self.user,
             'password': self.password,
             'host': self.host,
             'port': self.port
         }
+        self.closed = False
+
+        for _ in range(self.min_conn):
+            with self.lock:
+                self.open_count += 1
+            self.putconn(self._connect())
+
+    def _connect(self):
+        """Open a connection in a slot already counted in open_count, releasing the slot if it fails."""
+        try:
+            connection = psycopg2.connect(**self.db_params)
+        except Exception:
+            self._release_slot()
+            raise
+
+        if self.on_connect is not None:
+            try:
+                self.on_connect(connection)
+            except Exception:
+                connection.close()
+                self._release_slot()
+                raise
+
+        now = time.monotonic()
+        with self.lock:
+            self.connection_info[connection] = [now, 0, now]
+            self.connect_count += 1
+        return connection
+
+    def _release_slot(self):
+        """Give up a slot, passing it to the longest waiting caller if there is one."""
+        with self.lock:
+            if self.waiters and not self.closed:
+                waiter = self.waiters.popleft()
+                waiter.connection = self.NEW_CONNECTION
+                waiter.event.set()
+            else:
+                self.open_count -= 1
+
+    def _close_connection(self, connection):
+        """Close a connection and forget it, keeping its slot."""
+        with self.lock:
+            self.connection_info.pop(connection, None)
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    @staticmethod
+    def _is_alive(connection) -> bool:
+        """Check a connection with a trivial query."""
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT 1;")
+                cur.fetchone()
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _check_out(self, connection):
+        """
+        Make a connection ready for a caller, replacing it if it is closed, worn out, stale or broken.
+
+        Args:
+            connection: Connection taken from the pool, or NEW_CONNECTION to open one.
+
+        Returns:
+            Connection ready for use.
+        """
+        if connection is not self.NEW_CONNECTION:
+            info = self.connection_info[connection]
+            idle_time = time.monotonic() - info[2]
+            if connection.closed or (info[1] >= self.max_uses) or (idle_time > self.max_idle_time):
+                with self.lock:
+                    self.recycled_count += 1
+                self._close_connection(connection)
+                connection = self.NEW_CONNECTION
+            elif (idle_time > self.validate_idle_time) and (not self._is_alive(connection)):
+                with self.lock:
+                    self.failed_validation_count += 1
+                self._close_connection(connection)
+                connection = self.NEW_CONNECTION
+
+        if connection is self.NEW_CONNECTION:
+            connection = self._connect()
+        self.connection_info[connection][1] += 1
+        return connection
+
+    def _record_checkout(self, wait_time: float):
+        """Add a checkout to the statistics. The lock must be held."""
+        self.checkout_count += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        self.wait_histogram[bisect.bisect_left(PoolConfig.WAIT_HISTOGRAM_BOUNDS, wait_time)] += 1
+
+        second = int(time.time())
+        index = second % self.RATE_WINDOW
+        if self.rate_seconds[index] != second:
+            self.rate_seconds[index] = second
+            self.rate_counts[index] = 0
+        self.rate_counts[index] += 1
+
+    def get_conn(self, timeout: float = None):
+        """
+        Get a connection from the pool, waiting in turn if every connection is in use.
+
+        Args:
+            timeout (float): Seconds to wait, None for the pool's checkout timeout.
+
+        Returns:
+            A psycopg2 connection, to be given back with putconn.
+
+        Raises:
+            PoolTimeoutError: If no connection became free in time.
+            PoolError: If the pool is closed.
+        """
+        if timeout is None:
+            timeout = self.checkout_timeout
+        start_time = time.perf_counter()
+
+        waiter = None
+        with self.lock:
+            if self.closed:
+                raise pool.PoolError("connection pool is closed")
+            if self.idle:
+                connection = self.idle.pop()  # The most recently used connection is the least likely to be stale
+            elif self.open_count < self.max_conn:
+                self.open_count += 1
+                connection = self.NEW_CONNECTION
+            else:
+                waiter = PoolWaiter()
+                self.waiters.append(waiter)
+
+        if waiter is not None:
+            waiter.event.wait(timeout)
+            with self.lock:
+                connection = waiter.connection
+                if connection is None:
+                    self.waiters.remove(waiter)
+                    if not self.closed:
+                        self.timeout_count += 1
+            if connection is None:
+                if self.closed:
+                    raise pool.PoolError("connection pool is closed")
+                raise PoolTimeoutError(f"no database connection became free within {timeout} seconds")
+
+        connection = self._check_out(connection)
+
+        with self.lock:
+            self._record_checkout(time.perf_counter() - start_time)
+        return connection
+
+    def putconn(self, connection, close: bool = False):
+        """
+        Return a connection to the pool, or hand it to the longest waiting caller.
+
+        Args:
+            connection: Connection taken with get_conn.
+            close (bool): Close the connection instead of keeping it.
+        """
+        if self.closed:
+            self._close_connection(connection)
+            return
+        if connection not in self.connection_info:
+            raise pool.PoolError("trying to put unkeyed connection")
+
+        if (not close) and (not connection.closed):
+            transaction_status = connection.info.transaction_status
+            if transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()  # Never hand an open transaction to the next caller
+                except psycopg2.Error:
+                    close = True
+
+        if close or connection.closed:
+            with self.lock:
+                self.discarded_count += 1
+            self._close_connection(connection)
+            self._release_slot()
+            return
+
+        with self.lock:
+            self.connection_info[connection][2] = time.monotonic()
+            if self.waiters and not self.closed:
+                waiter = self.waiters.popleft()
+                waiter.connection = connection
+                waiter.event.set()
+                return
+            if not self.closed:
+                self.idle.append(connection)
+                return
+        self._close_connection(connection)
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection for the duration of a with block.
+
+        Yields:
+            A psycopg2 connection, returned to the pool when the block exits.
+        """
+        connection = self.get_conn()
+        try:
+            yield connection
+        finally:
+            self.putconn(connection)
+
+    def get_stats(self) -> dict:
+        """
+        Get connection pool statistics.
+
+        Returns:
+            dict: Open, in-use, idle and waiting counts, checkouts, checkouts per second over
+            the last RATE_WINDOW seconds, wait times and their histogram (keyed by upper bound
+            in seconds), timeouts, and connections opened, recycled, failed and discarded.
+        """
+        with self.lock:
+            second = int(time.time())
+            recent_checkouts = sum(count for rate_second, count in zip(self.rate_seconds, self.rate_counts)
+                                   if second - rate_second < self.RATE_WINDOW)
+            bounds = [str(bound) for bound in PoolConfig.WAIT_HISTOGRAM_BOUNDS] + ['inf']
+            return {
+                'open': self.open_count,
+                'in_use': self.open_count - len(self.idle),
+                'idle': len(self.idle),
+                'waiting': len(self.waiters),
+                'checkout_count': self.checkout_count,
+                'checkout_rate': recent_checkouts / self.RATE_WINDOW,
+                'mean_wait_time': self.total_wait_time / self.checkout_count if self.checkout_count else 0.0,
+                'max_wait_time': self.max_wait_time,
+                'wait_histogram': dict(zip(bounds, self.wait_histogram)),
+                'timeout_count': self.timeout_count,
+                'connect_count': self.connect_count,
+                'recycled_count': self.recycled_count,
+                'failed_validation_count': self.failed_validation_count,
+                'discarded_count': self.discarded_count
+            }
 
-        connection_pool = pool.SimpleConnectionPool(self.min_conn, self.max_conn, **db_params)
-        self.pool = connection_pool
-        
-    def get_conn(self):
-        """Get a connection from the pool."""
-        return self.pool.getconn()
-    
-    def putconn(self, connection):
-        """Return a connection to the pool."""
-        self.pool.putconn(connection)
-    
     def close(self):
-        """Close all connections in the pool."""
-        self.pool.closeall()
-        self.pool = None
-        
+        """Close all connections in the pool and wake any waiting callers."""
+        with self.lock:
+            self.closed = True
+            connections = list(self.connection_info)
+            self.connection_info.clear()
+            self.idle = []
+            waiters = list(self.waiters)
+            self.waiters.clear()
+            self.open_count = 0
+
+        for waiter in waiters:
+            waiter.event.set()
+        for connection in connections:
+            try:
+                connection.close()
+            except psycopg2.Error:
+                pass
+
     def __del__(self):
         """Close all connections in the pool when the object is deleted."""
-        if self.pool:
-            self.pool.closeall()
+        if not getattr(self, 'closed', True):
+            self.close()
+
+
+# Prepared Statement Registry Class
+class StatementRegistry:
+    """
+    Named SQL statements, prepared once per connection and then run by name.
+
+    A statement is prepared on a connection the first time it is used there,
+    or up front by prepare_all when the pool opens the connection, so the
+    database parses and plans it once per connection instead of once per
+    query. The names prepared on each connection are tracked in a weak
+    dictionary, so they are forgotten with the connection.
+
+    PostgreSQL re-plans prepared statements after schema changes by itself. If
+    a change makes a statement unusable ("cached plan must not change result
+    type") or the statement has been dropped, it is prepared again and run
+    once more, provided no transaction was open, so rolling back loses nothing.
+
+    Attributes:
+        statements (dict): Statement name -> SQL with $1, $2, ... parameters.
+    """
+
+    RETRYABLE_ERRORS = (errors.FeatureNotSupported, errors.InvalidSqlStatementName)
+
+    def __init__(self, statements: dict):
+        """
+        Initialize the StatementRegistry.
+
+        Args:
+            statements (dict): Statement name -> SQL with $1, $2, ... parameters.
+        """
+        self.statements = statements
+        self.lock = threading.Lock()
+        self.prepared = weakref.WeakKeyDictionary()  # Connection -> names prepared on it
+        self.prepare_count = 0
+        self.execute_count = 0
+        self.reprepare_count = 0
+
+    def _prepared_names(self, connection) -> dict:
+        """Get the statements prepared on a connection, name -> True, or False if it must be prepared again."""
+        with self.lock:
+            names = self.prepared.get(connection)
+            if names is None:
+                names = self.prepared[connection] = {}
+            return names
+
+    def _ensure_prepared(self, cur, name: str, names: dict):
+        """Prepare a statement on the connection of a cursor, replacing it if its plan is stale."""
+        state = names.get(name)
+        if state:
+            return
+        if state is False:
+            cur.execute(f"DEALLOCATE {name}")
+        cur.execute(f"PREPARE {name} AS {self.statements[name]}")
+        names[name] = True
+        with self.lock:
+            self.prepare_count += 1
+
+    def prepare_all(self, connection):
+        """
+        Prepare every statement on a new connection.
+
+        Statements whose tables do not exist yet are left to be prepared on first use.
+
+        Args:
+            connection: psycopg2 connection.
+        """
+        names = self._prepared_names(connection)
+        with connection.cursor() as cur:
+            for name in self.statements:
+                try:
+                    self._ensure_prepared(cur, name, names)
+                    connection.commit()
+                except psycopg2.Error:
+                    connection.rollback()
+                    names.pop(name, None)
+
+    def execute(self, cur, name: str, params: tuple):
+        """
+        Run a statement by name, preparing it first if needed.
+
+        Args:
+            cur: psycopg2 cursor.
+            name (str): Statement name.
+            params (tuple): Statement parameters.
+        """
+        connection = cur.connection
+        names = self._prepared_names(connection)
+        was_idle = connection.info.transaction_status == extensions.TRANSACTION_STATUS_IDLE
+        execute_sql = f"EXECUTE {name} ({', '.join(['%s'] * len(params))})"
+
+        self._ensure_prepared(cur, name, names)
+        try:
+            cur.execute(execute_sql, params)
+        except self.RETRYABLE_ERRORS as error:
+            if isinstance(error, errors.InvalidSqlStatementName):
+                names.pop(name, None)  # Dropped, so it is simply prepared again
+            else:
+                names[name] = False  # Still exists with an unusable plan, so it is replaced
+            if not was_idle:
+                raise  # Retrying would roll back earlier work of the transaction
+            connection.rollback()
+            with self.lock:
+                self.reprepare_count += 1
+            self._ensure_prepared(cur, name, names)
+            cur.execute(execute_sql, params)
+        with self.lock:
+            self.execute_count += 1
+
+    def get_stats(self) -> dict:
+        """
+        Get prepared statement statistics.
+
+        Returns:
+            dict: Connections tracked, statements prepared, statements run and statements prepared again.
+        """
+        with self.lock:
+            return {
+                'connections': len(self.prepared),
+                'prepare_count': self.prepare_count,
+                'execute_count': self.execute_count,
+                'reprepare_count': self.reprepare_count
+            }
 
 
 # Database Connector Class
 class DatabaseConnector:
     """
     DatabaseConnector class handles interactions with the database for transactions and related operations.
+
+    The hot queries are run as prepared statements through STATEMENTS.
     """
 
+    STATEMENTS = StatementRegistry({
+        'select_balance': "SELECT Balance FROM Balances WHERE PublicAddress = $1",
+        'select_transaction': "SELECT TransactionType, Amount, ExpiryTime, Status FROM Transactions WHERE TransactionID = $1",
+        'select_transactions': """
+            SELECT TransactionID, TransactionType, Amount, ExpiryTime, Status
+            FROM Transactions WHERE TransactionID = ANY($1::NUMERIC(32, 0)[])
+        """,
+        'select_alias_master': "SELECT MainPublicAddress FROM AliasAddresses WHERE AliasAddress = $1",
+        'insert_id': "INSERT INTO Ids (ID, ExpiryTime) VALUES ($1, $2)",
+        'insert_transaction': """
+            INSERT INTO Transactions (TransactionID, TransactionType, PublicAddress, Amount, ExpiryTime, Status)
+            VALUES ($1, $2, $3, $4, $5, $6)
+        """
+    })
+
     def __init__(self, conn):
         """
         Initializes the DatabaseConnector with a database connection and cursor.
@@ -139,6 +604,26 @@ class DatabaseConnector:
         self.conn = conn
         self.cur = conn.cursor()
 
+    @classmethod
+    def prepare_statements(cls, conn):
+        """
+        Prepare the hot queries on a new connection, used as the connection pool's on_connect hook.
+
+        Args:
+            conn: psycopg2 connection object
+        """
+        cls.STATEMENTS.prepare_all(conn)
+
+    def execute_statement(self, name: str, params: tuple):
+        """
+        Run a prepared statement on the cursor.
+
+        Args:
+            name (str): Statement name in STATEMENTS.
+            params (tuple): Statement parameters.
+        """
+        self.STATEMENTS.execute(self.cur, name, params)
+
     def create_tables_if_not_exist(self):
         """Create database tables if they do not exist."""
         table_queries = [
@@ -159,7 +644,7 @@ class DatabaseConnector:
             f"""
             CREATE TABLE IF NOT EXISTS Balances (
                 PublicAddress CHAR({PUBLIC_KEY_LENGTH}) PRIMARY KEY,
-                Balance DECIMAL(20, 5) NOT NULL
+                Balance BIGINT NOT NULL
             );
             """,
             f"""
@@ -175,7 +660,7 @@ class DatabaseConnector:
                 TransactionID NUMERIC(32, 0) PRIMARY KEY,
                 TransactionType transaction_type NOT NULL,
                 PublicAddress CHAR({PUBLIC_KEY_LENGTH}) NOT NULL,
-                Amount DECIMAL(20, {MAX_TRANSFER_PRECISION}) NOT NULL,
+                Amount BIGINT NOT NULL,
                 ExpiryTime BIGINT NOT NULL,
                 Status status NOT NULL,
                 FOREIGN KEY (PublicAddress) REFERENCES Balances(PublicAddress) ON DELETE CASCADE
@@ -186,7 +671,20 @@ class DatabaseConnector:
                 ID NUMERIC(32, 0) PRIMARY KEY,
                 ExpiryTime BIGINT NOT NULL
             );
-            """
+            """,
+            f"""
+            DO $$ BEGIN
+                IF (SELECT data_type FROM information_schema.columns
+                    WHERE table_name = 'balances' AND column_name = 'balance') = 'numeric' THEN
+                    ALTER TABLE Balances ALTER COLUMN Balance TYPE BIGINT USING ROUND(Balance * {Amount.SCALE})::BIGINT;
+                END IF;
+                IF (SELECT data_type FROM information_schema.columns
+                    WHERE table_name = 'transactions' AND column_name = 'amount') = 'numeric' THEN
+                    ALTER TABLE Transactions ALTER COLUMN Amount TYPE BIGINT USING ROUND(Amount * {Amount.SCALE})::BIGINT;
+                END IF;
+            END $$;
+            """,
+            *self.transfer_function_queries()
         ]
 
         for query in table_queries:
@@ -194,6 +692,128 @@ class DatabaseConnector:
 
         self.commit_transaction()
 
+    @staticmethod
+    def transfer_function_queries():
+        """
+        Get the queries creating the server-side transfer and settlement functions.
+
+        The fee limits and admin address are written into the functions, which
+        are replaced whenever the tables are checked, so they follow the config.
+
+        Returns:
+            list: CREATE OR REPLACE FUNCTION queries.
+        """
+        fee_numerator, fee_denominator = TRANSFER_FEE_PERCENT.as_integer_ratio()
+
+        return [
+            # TRANSFER_FEE_PERCENT of an amount, rounded half-even and clamped to the fee limits
+            f"""
+            CREATE OR REPLACE FUNCTION transfer_fee(transfer_amount BIGINT) RETURNS BIGINT AS $$
+            DECLARE
+                product NUMERIC := transfer_amount::NUMERIC * {fee_numerator};
+                quotient NUMERIC := div(product, {fee_denominator});
+                remainder NUMERIC := product - quotient * {fee_denominator};
+            BEGIN
+                IF (2 * remainder > {fee_denominator}) OR ((2 * remainder = {fee_denominator}) AND (mod(quotient, 2) = 1)) THEN
+                    quotient := quotient + 1;
+                END IF;
+                RETURN LEAST(GREATEST(quotient, {int(MINIMUM_TRANSFER_FEE)}), {int(MAXIMUM_TRANSFER_FEE)})::BIGINT;
+            END;
+            $$ LANGUAGE plpgsql IMMUTABLE;
+            """,
+            # Move funds between two resolved addresses, taking the transfer fee from the amount
+            f"""
+            CREATE OR REPLACE FUNCTION move_funds(sending_address CHAR({PUBLIC_KEY_LENGTH}),
+                                                  receiving_address CHAR({PUBLIC_KEY_LENGTH}),
+                                                  transfer_amount BIGINT) RETURNS BOOLEAN AS $$
+            DECLARE
+                fee_amount BIGINT := transfer_fee(transfer_amount);
+            BEGIN
+                -- Lock the rows in address order, so opposing transfers cannot deadlock
+                PERFORM 1 FROM Balances
+                WHERE PublicAddress IN (sending_address, receiving_address, '{ADMIN_ADDRESS}')
+                ORDER BY PublicAddress
+                FOR UPDATE;
+
+                UPDATE Balances
+                SET Balance = Balance - transfer_amount
+                WHERE PublicAddress = sending_address AND Balance >= transfer_amount;
+                IF NOT FOUND THEN
+                    RETURN FALSE;
+                END IF;
+
+                INSERT INTO Balances (PublicAddress, Balance)
+                SELECT credit.address, SUM(credit.credit_amount)
+                FROM (VALUES (receiving_address, transfer_amount - fee_amount),
+                             ('{ADMIN_ADDRESS}', fee_amount)) AS credit (address, credit_amount)
+                GROUP BY credit.address
+                ORDER BY credit.address
+                ON CONFLICT (PublicAddress) DO UPDATE SET Balance = Balances.Balance + EXCLUDED.Balance;
+                RETURN TRUE;
+            END;
+            $$ LANGUAGE plpgsql;
+            """,
+            f"""
+            CREATE OR REPLACE FUNCTION resolve_alias(address CHAR({PUBLIC_KEY_LENGTH})) RETURNS CHAR({PUBLIC_KEY_LENGTH}) AS $$
+                SELECT COALESCE(
+                    (SELECT MainPublicAddress FROM AliasAddresses WHERE AliasAddress = address),
+                    address
+                );
+            $$ LANGUAGE sql STABLE;
+            """,
+            f"""
+            CREATE OR REPLACE FUNCTION transfer_funds(sender_key CHAR({PUBLIC_KEY_LENGTH}),
+                                                      recipient_key CHAR({PUBLIC_KEY_LENGTH}),
+                                                      transfer_amount BIGINT) RETURNS TEXT AS $$
+            BEGIN
+                IF NOT move_funds(resolve_alias(sender_key), resolve_alias(recipient_key), transfer_amount) THEN
+                    RETURN 'insufficient_balance';
+                END IF;
+                RETURN 'success';
+            END;
+            $$ LANGUAGE plpgsql;
+            """,
+            f"""
+            CREATE OR REPLACE FUNCTION settle_transaction(settled_transaction_id NUMERIC(32, 0),
+                                                          master_key CHAR({PUBLIC_KEY_LENGTH}),
+                                                          settle_time DOUBLE PRECISION) RETURNS TEXT AS $$
+            DECLARE
+                owner_address CHAR({PUBLIC_KEY_LENGTH});
+                settled_type transaction_type;
+                settled_amount BIGINT;
+                settled_expiry_time BIGINT;
+                settled_status status;
+                master_address CHAR({PUBLIC_KEY_LENGTH}) := resolve_alias(master_key);
+            BEGIN
+                SELECT PublicAddress, TransactionType, Amount, ExpiryTime, Status
+                INTO owner_address, settled_type, settled_amount, settled_expiry_time, settled_status
+                FROM Transactions
+                WHERE TransactionID = settled_transaction_id
+                FOR UPDATE;
+
+                IF NOT FOUND THEN
+                    RETURN 'transaction_not_found';
+                ELSIF settled_status = 'COMPLETED' THEN
+                    RETURN 'transaction_completed';
+                ELSIF (settled_status = 'EXPIRED') OR (settled_expiry_time < settle_time) THEN
+                    RETURN 'transaction_expired';
+                END IF;
+
+                IF settled_type = 'SEND' THEN
+                    IF NOT move_funds(owner_address, master_address, settled_amount) THEN
+                        RETURN 'insufficient_balance';
+                    END IF;
+                ELSIF NOT move_funds(master_address, owner_address, settled_amount) THEN
+                    RETURN 'insufficient_balance';
+                END IF;
+
+                UPDATE Transactions SET Status = 'COMPLETED' WHERE TransactionID = settled_transaction_id;
+                RETURN 'success';
+            END;
+            $$ LANGUAGE plpgsql;
+            """
+        ]
+
     def commit_transaction(self):
         """Commit the current transaction."""
         self.conn.commit()
@@ -202,14 +822,14 @@ class DatabaseConnector:
         """Rollback the current transaction."""
         self.conn.rollback()
 
-    def insert_transaction(self, transaction_type: str, public_key: str, amount: Decimal, expiry_time: int):
+    def insert_transaction(self, transaction_type: str, public_key: str, amount: Amount, expiry_time: int):
         """
         Insert a new transaction into the database.
 
         Args:
             transaction_type (str): Type of transaction (SEND or RECEIVE).
             public_key (str): Public key of the user.
-            amount (Decimal): Amount of the transaction.
+            amount (Amount): Amount of the transaction.
             expiry_time (int): Expiry time of the transaction.
 
         Returns:
@@ -220,24 +840,18 @@ class DatabaseConnector:
             return response
         self.change_balance(ADMIN_ADDRESS, TRANSACTION_CREATION_FEE)
 
-        final_amount = str(Decimal(amount))
-
-        sql = """
-            INSERT INTO Transactions (TransactionID, TransactionType, PublicAddress, Amount, ExpiryTime, Status)
-            VALUES (%s, %s, %s, %s, %s, %s);
-        """
-
         for _ in range(0, 5):
             transaction_id = self.generate_transaction_id()
 
             try:
-                self.cur.execute(sql, (transaction_id, transaction_type, public_key, final_amount, expiry_time, 'PENDING'))
+                self.execute_statement('insert_transaction',
+                                       (transaction_id, transaction_type, public_key, amount, expiry_time, 'PENDING'))
                 self.commit_transaction()
                 self.change_balance(ADMIN_ADDRESS, TRANSACTION_CREATION_FEE)
                 return Response(
                     message='success',
                     transaction_id=str(transaction_id),
-                    transaction_amount=str(final_amount),
+                    transaction_amount=str(amount),
                     status_code=200
                 )
             except psycopg2.IntegrityError:
@@ -250,13 +864,13 @@ class DatabaseConnector:
             status_code=500
         )
 
-    def create_balance_item(self, public_key: str, amount: int = 0):
+    def create_balance_item(self, public_key: str, amount: Amount = Amount(0)):
         """
         Create a new balance item in the database.
 
         Args:
             public_key (str): Public key of the user.
-            amount (int): Initial balance amount.
+            amount (Amount): Initial balance amount.
 
         Returns:
             None
@@ -269,35 +883,51 @@ class DatabaseConnector:
         self.cur.execute(sql, (public_key, amount))
         self.commit_transaction()
 
-    def transfer(self, sender_key: str, receiver_key: str, amount: Decimal):
+    def call_transfer_function(self, sql: str, params: tuple) -> str:
         """
-        Transfer funds from one user to another.
+        Run a server-side transfer function in a single transaction.
 
         Args:
-            sender_key (str): Public key of the sender.
-            receiver_key (str): Public key of the receiver.
-            amount (Decimal): Amount to be transferred.
+            sql (str): Query calling the function.
+            params (tuple): Query parameters.
 
         Returns:
-            Response: Response object indicating the success or failure of the transfer.
+            str: Result code returned by the function.
         """
-        response = self.change_balance(sender_key, -amount)
-        if response.status_code != 200:
-            return response
+        try:
+            self.cur.execute(sql, params)
+            result = self.cur.fetchone()[0]
+            self.commit_transaction()
+        except Exception:
+            self.rollback_transaction()
+            raise
 
-        transfer_fee = round(amount * TRANSFER_FEE_PERCENT, 5)
-        if transfer_fee < MINIMUM_TRANSFER_FEE:
-            transfer_fee = MINIMUM_TRANSFER_FEE
-        elif transfer_fee > MAXIMUM_TRANSFER_FEE:
-            transfer_fee = MAXIMUM_TRANSFER_FEE
-        
-        transfer_amount = amount - transfer_fee
-        
+        return result
 
+    def transfer(self, sender_key: str, receiver_key: str, amount: Amount):
+        """
+        Transfer funds from one user to another.
 
-        self.change_balance(ADMIN_ADDRESS, transfer_fee)
-        self.change_balance(receiver_key, transfer_amount)
+        Aliases are resolved, the sender is debited and the receiver and admin
+        fee are credited by the transfer_funds function, in one round trip and
+        one commit.
+
+        Args:
+            sender_key (str): Public key or alias of the sender.
+            receiver_key (str): Public key or alias of the receiver.
+            amount (Amount): Amount to be transferred.
 
+        Returns:
+            Response: Response object indicating the success or failure of the transfer.
+        """
+        result = self.call_transfer_function("SELECT transfer_funds(%s, %s, %s);", (sender_key, receiver_key, amount))
+
+        if result == 'insufficient_balance':
+            return Response(
+                error_message='insufficient_balance',
+                message='Insufficient balance.',
+                status_code=400
+            )
         return Response(
             message='success',
             status_code=200
@@ -315,13 +945,8 @@ class DatabaseConnector:
             bool: True if the ID is added successfully, False otherwise.
         """
         try:
-            insert_sql = """
-                INSERT INTO Ids (ID, ExpiryTime)
-                VALUES (%s, %s);
-            """
-
             try:
-                self.cur.execute(insert_sql, (request_id, expiry_time))
+                self.execute_statement('insert_id', (request_id, expiry_time))
                 self.commit_transaction()
                 return True
             except psycopg2.IntegrityError:
@@ -331,6 +956,47 @@ class DatabaseConnector:
             self.cur.execute("ROLLBACK;")
             raise  # Handle other exceptions as needed
 
+    def add_ids(self, ids: list):
+        """
+        Add a batch of IDs to the database, skipping any that are already present.
+
+        Args:
+            ids (list): (ID, expiry time) pairs.
+        """
+        insert_sql = """
+            INSERT INTO Ids (ID, ExpiryTime)
+            VALUES %s
+            ON CONFLICT (ID) DO NOTHING;
+        """
+
+        try:
+            extras.execute_values(self.cur, insert_sql, ids, page_size=len(ids))
+            self.commit_transaction()
+        except Exception:
+            self.rollback_transaction()
+            raise
+
+    def get_live_ids(self, current_time: int):
+        """
+        Get the IDs that have not expired yet.
+
+        Args:
+            current_time (int): Current time.
+
+        Returns:
+            list: (ID, expiry time) rows.
+        """
+        select_sql = """
+            SELECT ID, ExpiryTime
+            FROM Ids
+            WHERE ExpiryTime >= %s;
+        """
+
+        self.cur.execute(select_sql, (current_time,))
+        rows = self.cur.fetchall()
+        self.commit_transaction()
+        return rows
+
     def add_alias_address(self, alias: str, master_key: str, expiry_time: int):
         """
         Add an alias address to the database.
@@ -377,12 +1043,7 @@ class DatabaseConnector:
         Returns:
             Response: Response object containing the main public address.
         """
-        select_query = """
-            SELECT MainPublicAddress
-            FROM AliasAddresses
-            WHERE AliasAddress = %s
-        """
-        self.cur.execute(select_query, (alias,))
+        self.execute_statement('select_alias_master', (alias,))
         master_key = self.cur.fetchone()
 
         if master_key is not None:
@@ -390,13 +1051,13 @@ class DatabaseConnector:
         else:
             return alias
 
-    def change_balance(self, key: str, amount: Decimal):
+    def change_balance(self, key: str, amount: Amount):
         """
         Change the balance of a user.
 
         Args:
             key (str): Public key of the user.
-            amount (Decimal): Amount to be added or subtracted.
+            amount (Amount): Amount to be added or subtracted.
 
         Returns:
             Response: Response object indicating the success or failure of the balance change.
@@ -421,7 +1082,7 @@ class DatabaseConnector:
                 SET Balance = Balance + %s
                 WHERE PublicAddress = %s
             """
-            self.cur.execute(sql, (str(amount), key))
+            self.cur.execute(sql, (amount, key))
             self.commit_transaction()
             return Response(
                 message='success',
@@ -436,7 +1097,7 @@ class DatabaseConnector:
                     SET Balance = Balance - %s
                     WHERE PublicAddress = %s
                 """
-                self.cur.execute(sql, (str(abs(amount)), key))
+                self.cur.execute(sql, (abs(amount), key))
                 self.commit_transaction()
                 return Response(
                     message='success',
@@ -458,17 +1119,17 @@ class DatabaseConnector:
             key (str): Public key of the user.
 
         Returns:
-            Decimal: Balance of the user.
+            Amount: Balance of the user.
         """
-        self.cur.execute("SELECT Balance FROM Balances WHERE PublicAddress = %s;", (key,))
+        self.execute_statement('select_balance', (key,))
 
         # Fetch the result (if any)
         result = self.cur.fetchone()
 
         if result is not None:
-            balance = result[0]
+            balance = Amount(result[0])
         else:
-            balance = Decimal(0)
+            balance = Amount(0)
 
         return balance
 
@@ -484,10 +1145,7 @@ class DatabaseConnector:
         """
         def get_result():
             # Fetch transaction details from the database
-            self.cur.execute(
-                "SELECT TransactionType, Amount, ExpiryTime, Status FROM Transactions WHERE TransactionID = %s;",
-                (transaction_id,)
-            )
+            self.execute_statement('select_transaction', (transaction_id,))
             result = self.cur.fetchone()
             return result
 
@@ -512,7 +1170,7 @@ class DatabaseConnector:
                 return Response(
                     message='success',
                     transaction_type=result[0],
-                    transaction_amount=str(result[1]),
+                    transaction_amount=str(Amount(result[1])),
                     expiry_time=str(expiry_time),
                     status=status,
                     status_code=200
@@ -524,6 +1182,57 @@ class DatabaseConnector:
                     status_code=400
                 )
 
+    def get_transactions(self, transaction_ids: list) -> dict:
+        """
+        Retrieves several transactions in one query, expiring pending transactions that have passed their expiry time.
+
+        Expired transactions are marked EXPIRED, or deleted once DELETION_DELAY_AFTER_EXPIRY has also
+        passed, with a single statement for the whole batch.
+
+        Args:
+            transaction_ids (list): The IDs of the transactions to retrieve, as strings.
+
+        Returns:
+            dict: Transaction ID -> transaction details, for each ID that was found.
+        """
+        self.execute_statement('select_transactions', ([int(transaction_id) for transaction_id in transaction_ids],))
+        rows = self.cur.fetchall()
+
+        now = time.time()
+        found = {}
+        expired_ids = []
+        deleted_ids = []
+        for row_id, transaction_type, amount, expiry_time, status in rows:
+            expiry_time = int(expiry_time)
+            if (status == 'PENDING') and (expiry_time < now):
+                status = 'EXPIRED'
+                if expiry_time + DELETION_DELAY_AFTER_EXPIRY < now:
+                    deleted_ids.append(int(row_id))
+                else:
+                    expired_ids.append(int(row_id))
+
+            found[int(row_id)] = {
+                'transaction_type': transaction_type,
+                'transaction_amount': str(Amount(amount)),
+                'expiry_time': str(expiry_time),
+                'status': status
+            }
+
+        if expired_ids or deleted_ids:
+            # Only still-pending rows are changed, in case one was settled since it was read
+            self.cur.execute("""
+                WITH deleted AS (
+                    DELETE FROM Transactions
+                    WHERE TransactionID = ANY(%s::NUMERIC(32, 0)[]) AND Status = 'PENDING'
+                )
+                UPDATE Transactions SET Status = 'EXPIRED'
+                WHERE TransactionID = ANY(%s::NUMERIC(32, 0)[]) AND Status = 'PENDING';
+            """, (deleted_ids, expired_ids))
+            self.commit_transaction()
+
+        return {transaction_id: found[int(transaction_id)]
+                for transaction_id in transaction_ids if int(transaction_id) in found}
+
     def get_transaction_owner(self, transaction_id):
         """
         Retrieves the public address of the transaction owner from the database based on the given transaction ID.
@@ -573,6 +1282,10 @@ class DatabaseConnector:
         """
         Completes a transaction in the database, updating its status and performing necessary balance changes.
 
+        The transaction row is locked, checked and settled, and the balances and
+        admin fee updated, by the settle_transaction function in one round trip
+        and one commit.
+
         Args:
             transaction_id (str): The ID of the transaction to be completed.
             master_key (str): The public address of the master key.
@@ -580,91 +1293,33 @@ class DatabaseConnector:
         Returns:
             Response: Response object indicating the success of the transaction completion.
         """
+        result = self.call_transfer_function("SELECT settle_transaction(%s, %s, %s);",
+                                             (transaction_id, master_key, time.time()))
 
-        def set_transaction_status(status):
-            # Set the transaction status in the database
-            self.cur.execute(
-                "SELECT PublicAddress, TransactionType, Amount, ExpiryTime, Status FROM Transactions WHERE TransactionID = %s FOR UPDATE;",
-                (transaction_id,)
+        if result == 'success':
+            return Response(
+                message='success',
+                status_code=200
+            )
+        elif result == 'transaction_completed':
+            return Response(
+                error_message='transaction_completed',
+                message='Transaction is already completed.',
+                status_code=400
+            )
+        elif result == 'transaction_expired':
+            return Response(
+                error_message='transaction_expired',
+                message='Transaction has expired.',
+                status_code=400
+            )
+        elif result == 'insufficient_balance':
+            return Response(
+                error_message='insufficient_balance',
+                message='Insufficient balance.',
+                status_code=400
             )
-            result = self.cur.fetchone()
-
-            if result is not None:
-                self.cur.execute("UPDATE Transactions SET Status = %s WHERE TransactionID = %s;",
-                                 (status, transaction_id))
-                self.commit_transaction()
-            else:
-                self.rollback_transaction()
-
-        self.cur.execute(
-            "SELECT PublicAddress, TransactionType, Amount, ExpiryTime, Status FROM Transactions WHERE TransactionID = %s FOR UPDATE;",
-            (transaction_id,)
-        )
-
-        # Fetch the result (if any)
-        result = self.cur.fetchone()
-
-        if result is not None:
-            expiry_time = int(result[3])
-            status = result[4]
-
-            if status == 'COMPLETED':
-                self.rollback_transaction()
-                return Response(
-                    error_message='transaction_completed',
-                    message='Transaction is already completed.',
-                    status_code=400
-                )
-            elif (status == 'EXPIRED') or (expiry_time < time.time()):
-                self.rollback_transaction()
-                return Response(
-                    error_message='transaction_expired',
-                    message='Transaction has expired.',
-                    status_code=400
-                )
-            else:
-                public_key = result[0]
-                transaction_type = result[1]
-                amount = Decimal(result[2])
-
-                self.cur.execute("UPDATE Transactions SET Status = %s WHERE TransactionID = %s;",
-                                 ('PROCESSING', transaction_id))
-
-                self.commit_transaction()
-
-                if transaction_type == 'SEND':
-                    sending_key = public_key
-                    receiving_key = master_key
-                else:
-                    sending_key = master_key
-                    receiving_key = public_key
-
-                response = self.change_balance(sending_key, -amount)
-
-                if response.status_code != 200:
-                    set_transaction_status('PENDING')
-                    return response
-
-                transaction_fee = amount * TRANSFER_FEE_PERCENT
-                transfer_fee = round(amount * TRANSFER_FEE_PERCENT, 5)
-                if transfer_fee < MINIMUM_TRANSFER_FEE:
-                    transfer_fee = MINIMUM_TRANSFER_FEE
-                elif transfer_fee > MAXIMUM_TRANSFER_FEE:
-                    transfer_fee = MAXIMUM_TRANSFER_FEE
-                
-                transfer_amount = amount - transaction_fee
-
-                self.change_balance(ADMIN_ADDRESS, transaction_fee)
-                self.change_balance(receiving_key, transfer_amount)
-
-                set_transaction_status('COMPLETED')
-
-                return Response(
-                    message='success',
-                    status_code=200
-                )
         else:
-            self.rollback_transaction()
             return Response(
                 error_message='transaction_not_found',
                 message='Transaction not found.',
@@ -779,48 +1434,48 @@ class DatabaseConnector:
         Returns the sum of all send transactions.
 
         Returns:
-            Decimal: The sum of all send transactions.
+            Amount: The sum of all send transactions.
         """
         ## Technique: Aggregate SQL Function
         self.cur.execute("SELECT COALESCE(SUM(Amount), 0) FROM Transactions WHERE PublicAddress = ? AND TransactionType = 'SEND'", (master_key,))
         result = self.cur.fetchone()
-        return result[0]
+        return Amount(result[0])
 
     def sum_of_receive_transactions(self, master_key):
         """
         Returns the sum of all receive transactions.
 
         Returns:
-            Decimal: The sum of all receive transactions.
+            Amount: The sum of all receive transactions.
         """
         ## Technique: Aggregate SQL Function
         self.cur.execute("SELECT COALESCE(SUM(Amount), 0) FROM Transactions WHERE PublicAddress = ? AND TransactionType = 'RECEIVE'", (master_key,))
         result = self.cur.fetchone()
-        return result[0]
+        return Amount(result[0])
 
     def average_transaction_value(self):
         """
         Returns the average transaction value.
 
         Returns:
-            Decimal: The average transaction value.
+            Amount: The average transaction value.
         """
         ## Technique: Aggregate SQL Function
-        self.cur.execute("SELECT COALESCE(AVG(Amount), 0) FROM Transactions")
+        self.cur.execute("SELECT COALESCE(ROUND(AVG(Amount)), 0) FROM Transactions")
         result = self.cur.fetchone()
-        return result[0]
+        return Amount(result[0])
     
     def get_sum_of_balances(self):
         """
         Returns the sum of all balances.
 
         Returns:
-            Decimal: The sum of all balances.
+            Amount: The sum of all balances.
         """
         ## Technique: Aggregate SQL Function
         self.cur.execute("SELECT COALESCE(SUM(Balance), 0) FROM Balances")
         result = self.cur.fetchone()
-        return result[0]
+        return Amount(result[0])
 
     def wallet_info(self, master_key):
         """
@@ -853,7 +1508,7 @@ class DatabaseConnector:
         result = self.cur.fetchone()
         if result:
             wallet_info = {
-                'balance': result[0],
+                'balance': Amount(result[0]),
                 'num_transactions': result[1],
                 'transactions': result[2],
                 'num_aliases': result[3],
@@ -866,13 +1521,12 @@ class DatabaseConnector:
 
     def close(self):
         """
-        Closes the database connection and cursor.
+        Closes the cursor. The connection stays open, to be returned to its pool.
 
         Returns:
             None
         """
         self.cur.close()
-        self.conn.close()
 
     @staticmethod
     def generate_transaction_id():
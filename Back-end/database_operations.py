@@ -1,6 +1,42 @@
+from flask import g
 from database import ConnectionPool, DatabaseConnector
 from response import Response
 
+
+def get_request_connection(connection_pool: ConnectionPool):
+    """
+    Get the database connection of the current request, checking one out on first use.
+
+    The replay check and the operation of a request share the connection,
+    which is returned to the pool by release_request_connection when the
+    request is torn down.
+
+    Args:
+    - connection_pool (ConnectionPool): The connection pool to check the connection out of.
+
+    Returns:
+    - A psycopg2 connection.
+    """
+    connection = g.get('db_connection')
+    if connection is None:
+        connection = connection_pool.get_conn()
+        g.db_connection = connection
+        g.db_connection_pool = connection_pool
+    return connection
+
+
+def release_request_connection(error=None):
+    """
+    Return the connection of the current request to its pool, if one was checked out.
+
+    Args:
+    - error (Exception): The error that ended the request, if any.
+    """
+    connection = g.pop('db_connection', None)
+    if connection is not None:
+        g.pop('db_connection_pool').putconn(connection)  # Rolls back anything left uncommitted
+
+
 class DatabaseHandler:
     """
     A class for handling database operations.
@@ -26,18 +62,15 @@ class DatabaseHandler:
         Returns:
         - Response: The response object with the result of the operation.
         """
-        # Creating a DatabaseConnector instance using a connection from the pool
-        db_conn = DatabaseConnector(self.connection_pool.get_conn())
+        # Creating a DatabaseConnector instance using the connection of the request
+        db_conn = DatabaseConnector(get_request_connection(self.connection_pool))
 
         # Adding the ID to the database using the DatabaseConnector
         response = db_conn.add_id(transaction_id, expiry_time)
 
-        # Closing the database connection
+        # Closing the cursor, keeping the connection for the rest of the request
         db_conn.close()
 
-        # Returning the connection to the connection pool
-        self.connection_pool.putconn(db_conn.conn)
-
         # Checking the response and creating a corresponding Response object
         if response:
             response = Response(
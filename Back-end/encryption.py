@@ -1,160 +1,1009 @@
-import time  # Import time module for timestamp operations
-import math  # Import math module for mathematical operations
 import base64  # Import base64 module for base64 encoding/decoding
+import os  # Import os module for generating random content keys and nonces
+import hashlib  # Import hashlib module for client key fingerprints
 from cryptography.hazmat.backends import default_backend  # Import cryptography library for RSA encryption
-from cryptography.hazmat.primitives.asymmetric import rsa, padding  # Import RSA and padding modules
-from cryptography.hazmat.primitives import serialization  # Import serialization module
+from cryptography.hazmat.primitives.asymmetric import rsa, padding, x25519  # Import RSA, padding and X25519 modules
+from cryptography.hazmat.primitives import serialization, hashes  # Import serialization and hash modules
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF  # Import HKDF for deriving keys from X25519 shared secrets
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM  # Import AES-GCM for hybrid envelopes
+from cryptography.exceptions import InvalidTag  # Raised when an AES-GCM ciphertext fails authentication
 
 from response import Response  # Import Response class from response module
+from key_ring import KeyRingManager, ServerKey  # Import key ring classes for background key rotation
+from tools import LRUCache  # Import LRUCache for caching parsed client keys
+from crypto_service import CryptoService  # Import CryptoService for offloading RSA work to worker processes
+from signatures import SignatureBatcher  # Import SignatureBatcher for batching signature checks
+from sessions import SessionManager, Session  # Import session classes for handshake sessions
+from framing import BinaryFrame  # Import BinaryFrame for raw binary request and response bodies
+from compact_payload import CompactPayload  # Import CompactPayload for CBOR plaintexts
+from config import EncryptionConfig, SignatureConfig  # Import encryption and signature configuration
+
+# Parsed client RSA public keys shared by request verification and response encryption
+client_key_cache = LRUCache(EncryptionConfig.CLIENT_KEY_CACHE_SIZE)
+
+
+class Envelope:
+    """
+    Parsed envelope of an encrypted request body, reused to encrypt the response.
+
+    Attributes:
+        format (str): Envelope format of the request body.
+        session (Session): Session the body was sealed with, None outside session envelopes.
+        binary (bool): True if the body was a binary frame rather than a text envelope.
+        envelope_id (str): Key id or session id named by the envelope, None if it names none.
+        fields (list): Decoded header fields (RSA blocks for legacy envelopes), None if the body is malformed.
+        payload (bytes | memoryview): AES-GCM ciphertext, None for legacy envelopes.
+        compact (bool): True if the plaintext was CBOR, so the response is encoded as CBOR too.
+    """
+
+    __slots__ = ('format', 'session', 'binary', 'envelope_id', 'fields', 'payload', 'compact')
+
+    def __init__(self, envelope_format: str, session: Session = None, binary: bool = False,
+                 envelope_id: str = None, fields: list = None, payload=None):
+        self.format = envelope_format
+        self.session = session
+        self.binary = binary
+        self.envelope_id = envelope_id
+        self.fields = fields
+        self.payload = payload
+        self.compact = False
 
 
 class Encryption:
     """
     Class for handling RSA encryption and decryption.
 
+    Two envelope formats are supported. The legacy format is a concatenation of
+    base64 RSA blocks, one per 190 characters of plaintext, optionally prefixed
+    with "<key id>.". The hybrid format ("h1.<key id>.<wrapped key>.<nonce>.<ciphertext>")
+    wraps a random AES-256-GCM key with RSA-OAEP once and encrypts the whole body
+    symmetrically. The key id names the recipient key, so the server picks the
+    matching private key directly instead of trying each one. The session format
+    ("s1.<session id>.<nonce>.<ciphertext>") seals the body with AES-256-GCM under
+    a session key established through /api/handshake, so no RSA is needed at all.
+    The key agreement format ("x1.<key id>.<ephemeral key>.<nonce>.<ciphertext>")
+    derives the AES-256-GCM key from an X25519 exchange between an ephemeral
+    client key and the server X25519 key, which is far cheaper than RSA decryption.
+    Clients that register an X25519 encryption key get x1 responses the same way.
+
+    Every format can also be sent as a binary frame (see framing.BinaryFrame)
+    carrying the raw blocks, keys, nonces and ciphertext without base64. The
+    response to a binary request is a binary frame as well.
+
     Attributes:
         KEY_LENGTH (int): Length of RSA key pairs.
         ENCRYPTION_CHUNK_SIZE (int): Size of chunks for encryption.
         DECRYPTION_CHUNK_SIZE (int): Size of chunks for decryption.
+        LEGACY_FORMAT (str): Name of the chunked RSA envelope format.
+        HYBRID_FORMAT (str): Name and prefix of the RSA + AES-GCM envelope format.
+        SESSION_FORMAT (str): Name and prefix of the session AES-GCM envelope format.
+        ECDH_FORMAT (str): Name and prefix of the X25519 + AES-GCM envelope format.
+        X25519_KEY_LENGTH (int): Length of base64-encoded X25519 public keys.
+        BINARY_FORMAT_CODES (dict): Binary frame format code of each envelope format.
+        RSA_BLOCK_SIZE (int): Size of a raw server RSA block in bytes.
+        CONTENT_KEY_SIZE (int): Size of AES-GCM content keys in bytes.
+        NONCE_SIZE (int): Size of AES-GCM nonces in bytes.
+        TAG_SIZE (int): Size of AES-GCM authentication tags in bytes.
+        MAX_LEGACY_BLOCKS (int): Maximum number of RSA blocks in a legacy envelope.
     """
 
     KEY_LENGTH = 392
     ENCRYPTION_CHUNK_SIZE = 190
     DECRYPTION_CHUNK_SIZE = 344
 
-    def __init__(self):
+    LEGACY_FORMAT = 'legacy'
+    HYBRID_FORMAT = 'h1'
+    SESSION_FORMAT = 's1'
+    ECDH_FORMAT = 'x1'
+    X25519_KEY_LENGTH = 44
+    X25519_KEY_SIZE = 32
+    ENVELOPE_SEPARATOR = '.'
+    PREFIX_LENGTH = 3  # Length of the "h1." style prefix that identifies a text envelope format
+    TEXT_PART_COUNTS = {HYBRID_FORMAT: 5, SESSION_FORMAT: 4, ECDH_FORMAT: 5}
+    BINARY_FORMAT_CODES = {LEGACY_FORMAT: 1, HYBRID_FORMAT: 2, SESSION_FORMAT: 3, ECDH_FORMAT: 4}
+    BINARY_FORMATS = {code: envelope_format for envelope_format, code in BINARY_FORMAT_CODES.items()}
+    BINARY_FIELD_COUNTS = {LEGACY_FORMAT: 0, HYBRID_FORMAT: 2, SESSION_FORMAT: 1, ECDH_FORMAT: 2}
+    RSA_BLOCK_SIZE = KeyRingManager.KEY_SIZE // 8
+    CONTENT_KEY_SIZE = 32
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+    MAX_LEGACY_BLOCKS = EncryptionConfig.MAX_LEGACY_BLOCKS
+    KEY_ID_CHARACTERS = frozenset('0123456789abcdef')
+
+    OAEP_PADDING = padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()),
+        algorithm=hashes.SHA256(),
+        label=None
+    )
+
+    def __init__(self, key_ring_manager: KeyRingManager = None, crypto_service_workers: int = 0):
         """
-        Initialize the Encryption class and generate RSA key pair.
+        Initialize the Encryption class and its RSA key ring.
+
+        Args:
+            key_ring_manager (KeyRingManager): Key ring to use, a new one with background rotation by default.
+            crypto_service_workers (int): Number of crypto worker processes, 0 to run crypto on the request thread.
         """
-        self._update_keypairs()  # Call method to generate and update RSA key pair
+        if key_ring_manager is None:
+            key_ring_manager = KeyRingManager()
+        self.key_ring_manager = key_ring_manager
 
-        self.old_updated = None
-        self.old_private_key = None
+        self.crypto_service = None
+        if crypto_service_workers > 0:
+            self.crypto_service = CryptoService(key_ring_manager, crypto_service_workers)
 
-    def _update_keypairs(self):
+        self.signature_batcher = None
+        if SignatureConfig.BATCH_WINDOW > 0:
+            offload_service = self.crypto_service if SignatureConfig.OFFLOAD_BATCHES else None
+            self.signature_batcher = SignatureBatcher(SignatureConfig.BATCH_WINDOW, SignatureConfig.MAX_BATCH_SIZE,
+                                                      SignatureConfig.VERIFY_TIMEOUT, offload_service)
+
+        self.session_manager = SessionManager(key_ring_manager, EncryptionConfig.SESSION_TTL,
+                                              EncryptionConfig.MAX_SESSIONS)
+
+    def get_public_key(self):
         """
-        Update RSA key pair and related attributes.
+        Get the current public key.
+
+        Returns:
+            str: Base64-encoded current public key.
         """
-        self.cur_private_key, self.cur_public_key = self._generate_rsa_keypair()  # Generate new RSA key pair
-        serialized_public_key = self.cur_public_key.public_bytes(
-            encoding=serialization.Encoding.DER,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        )
-        self.cur_public_key_b64 = base64.b64encode(serialized_public_key).decode('utf-8')  # Base64 encode public key
-        self.cur_updated = math.floor(time.time()) // 3600 * 3600  # Update timestamp
+        return self.key_ring_manager.get_key_ring().current.public_key_b64  # Return current public key
+
+    def get_current_key(self) -> ServerKey:
+        """
+        Get the current server key, so its public key and key id come from the same key ring.
+
+        Returns:
+            ServerKey: Current server key.
+        """
+        return self.key_ring_manager.get_key_ring().current
+
+    def get_key_metrics(self):
+        """
+        Get key rotation metrics.
+
+        Returns:
+            dict: Key ring rotation metrics.
+        """
+        return self.key_ring_manager.get_metrics()
 
     @staticmethod
-    def _generate_rsa_keypair():
+    def load_public_key(public_key_b64: str):
         """
-        Generate RSA key pair.
+        Load a client public key, either RSA in base64-encoded DER form or raw base64-encoded X25519.
+
+        Parsed keys are kept in client_key_cache, keyed by a fingerprint of the
+        encoded key, so each client key is only decoded and validated once.
+
+        Args:
+            public_key_b64 (str): Base64-encoded public key.
 
         Returns:
-            tuple: Private key and public key.
+            RSAPublicKey | X25519PublicKey: Parsed public key.
+
+        Raises:
+            ValueError: If the key is not valid base64 or not a valid public key.
+        """
+        if isinstance(public_key_b64, str):
+            public_key_b64 = public_key_b64.encode('utf-8')
+        fingerprint = hashlib.sha256(public_key_b64).digest()
+
+        public_key = client_key_cache.get(fingerprint)
+        if public_key is None:
+            serialized_public_key = base64.b64decode(public_key_b64)  # Decode base64-encoded public key
+            if len(serialized_public_key) == Encryption.X25519_KEY_SIZE:
+                public_key = x25519.X25519PublicKey.from_public_bytes(serialized_public_key)
+            else:
+                public_key = serialization.load_der_public_key(
+                    serialized_public_key,
+                    backend=default_backend()
+                )
+            client_key_cache.put(fingerprint, public_key)
+
+        return public_key
+
+    @classmethod
+    def get_envelope_format(cls, ciphertext) -> str:
+        """
+        Detect the envelope format of an encrypted request body.
+
+        Args:
+            ciphertext (str | bytes): Encrypted message.
+
+        Returns:
+            str: SESSION_FORMAT, ECDH_FORMAT, HYBRID_FORMAT or LEGACY_FORMAT.
+        """
+        if BinaryFrame.is_binary(ciphertext):
+            return cls.BINARY_FORMATS.get(ciphertext[1] if len(ciphertext) > 1 else None, cls.LEGACY_FORMAT)
+
+        for envelope_format in (cls.SESSION_FORMAT, cls.ECDH_FORMAT, cls.HYBRID_FORMAT):
+            prefix = envelope_format + cls.ENVELOPE_SEPARATOR
+            if isinstance(ciphertext, (bytes, bytearray)):
+                prefix = prefix.encode('ascii')
+            if ciphertext[:len(prefix)] == prefix:
+                return envelope_format
+        return cls.LEGACY_FORMAT
+
+    def get_envelope(self, ciphertext) -> Envelope:
+        """
+        Parse an encrypted request body.
+
+        Malformed bodies are not rejected here; their envelope has no fields and
+        is rejected by decrypt_envelope.
+
+        Args:
+            ciphertext (str | bytes): Encrypted message, a text envelope or a binary frame.
+
+        Returns:
+            Envelope: Parsed envelope, with the live session for session envelopes.
+        """
+        if BinaryFrame.is_binary(ciphertext):
+            return self._parse_binary_envelope(ciphertext)
+        return self._parse_text_envelope(ciphertext)
+
+    def _parse_text_envelope(self, ciphertext) -> Envelope:
+        """
+        Parse a text envelope.
+
+        Args:
+            ciphertext (str | bytes): Text envelope.
+
+        Returns:
+            Envelope: Parsed envelope.
         """
-        private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-            backend=default_backend()
+        envelope = Envelope(self.get_envelope_format(ciphertext))
+
+        if envelope.format == self.LEGACY_FORMAT:
+            separator = self.ENVELOPE_SEPARATOR
+            if isinstance(ciphertext, (bytes, bytearray)):
+                separator = separator.encode('ascii')
+
+            if separator in ciphertext:
+                # Body is tagged with the key id it was encrypted for
+                key_id, ciphertext = ciphertext.split(separator, 1)
+                if isinstance(key_id, (bytes, bytearray)):
+                    key_id = key_id.decode('ascii', errors='replace')
+                envelope.envelope_id = key_id
+
+            # Check the block count before decoding anything
+            block_count, remainder = divmod(len(ciphertext), self.DECRYPTION_CHUNK_SIZE)
+            if remainder or block_count > self.MAX_LEGACY_BLOCKS:
+                return envelope
+
+            ciphertext_sections = [ciphertext[i:i + self.DECRYPTION_CHUNK_SIZE] for i in range(0, len(ciphertext), self.DECRYPTION_CHUNK_SIZE)]  # Divide ciphertext into chunks
+            try:
+                envelope.fields = [base64.b64decode(section, validate=True) for section in ciphertext_sections]
+            except ValueError:
+                pass
+            return envelope
+
+        try:
+            if isinstance(ciphertext, (bytes, bytearray)):
+                ciphertext = ciphertext.decode('ascii')
+        except UnicodeDecodeError:
+            return envelope
+        parts = ciphertext.split(self.ENVELOPE_SEPARATOR)
+        envelope.envelope_id = parts[1]
+        if envelope.format == self.SESSION_FORMAT:
+            envelope.session = self.session_manager.get_session(envelope.envelope_id)
+
+        if len(parts) != self.TEXT_PART_COUNTS[envelope.format]:
+            return envelope
+        try:
+            decoded_parts = [base64.b64decode(part, validate=True) for part in parts[2:]]
+        except ValueError:  # binascii.Error
+            return envelope
+        envelope.fields = decoded_parts[:-1]
+        envelope.payload = decoded_parts[-1]
+        return envelope
+
+    def _parse_binary_envelope(self, data) -> Envelope:
+        """
+        Parse a binary frame. Fields and payload are memoryviews into the request body.
+
+        Args:
+            data (bytes): Binary frame.
+
+        Returns:
+            Envelope: Parsed envelope.
+        """
+        try:
+            frame = BinaryFrame.decode(data)
+        except ValueError:  # Covers UnicodeDecodeError
+            return Envelope(self.LEGACY_FORMAT, binary=True)
+
+        envelope_format = self.BINARY_FORMATS.get(frame.format_code)
+        if envelope_format is None:
+            return Envelope(self.LEGACY_FORMAT, binary=True)
+
+        envelope = Envelope(envelope_format, binary=True, envelope_id=frame.envelope_id or None)
+        if envelope_format == self.SESSION_FORMAT:
+            envelope.session = self.session_manager.get_session(frame.envelope_id)
+
+        if len(frame.fields) != self.BINARY_FIELD_COUNTS[envelope_format]:
+            return envelope
+
+        if envelope_format == self.LEGACY_FORMAT:
+            blocks = frame.payload
+            if len(blocks) % self.RSA_BLOCK_SIZE != 0:
+                return envelope
+            envelope.fields = [blocks[i:i + self.RSA_BLOCK_SIZE] for i in range(0, len(blocks), self.RSA_BLOCK_SIZE)]
+        else:
+            envelope.fields = frame.fields
+            envelope.payload = frame.payload
+        return envelope
+
+    def create_session(self) -> Session:
+        """
+        Create a new handshake session.
+
+        Returns:
+            Session: New session.
+        """
+        return self.session_manager.create_session()
+
+    @staticmethod
+    def _invalid_encrypted_data():
+        """
+        Build the response returned for undecryptable request bodies.
+
+        Returns:
+            Response: invalid_encrypted_data error response.
+        """
+        return Response(
+            error_message='invalid_encrypted_data',
+            message='Encrypted data is corrupt. May have been encrypted using incorrect key.',
+            status_code=400
         )
-        public_key = private_key.public_key()
-        return private_key, public_key
 
-    def get_public_key(self):
+    @staticmethod
+    def _plaintext_response(plaintext: bytes) -> Response:
         """
-        Get the current public key.
+        Build the response for a decrypted plaintext.
+
+        Args:
+            plaintext (bytes): Decrypted request body.
 
         Returns:
-            str: Base64-encoded current public key.
+            Response: The plaintext as bytes if it carries a CBOR payload, otherwise as a
+            str, or invalid_encrypted_data if it is neither CBOR nor UTF-8.
         """
-        if self.cur_updated + 3600 <= math.floor(time.time()):  # Check if current key pair is outdated
-            if self.cur_updated + 7200 > math.floor(time.time()):  # Check if old key pair is still valid
-                self.old_private_key = self.cur_private_key
-                self.old_public_key = self.cur_public_key
-                self.old_updated = self.cur_updated
-            else:
-                self.old_private_key = None
-                self.old_public_key = None
+        if CompactPayload.is_compact(plaintext):
+            return Response(message=plaintext, status_code=200)
+        try:
+            return Response(message=plaintext.decode('utf-8'), status_code=200)
+        except UnicodeDecodeError:
+            return Encryption._invalid_encrypted_data()
 
-            self._update_keypairs()  # Update key pair if needed
+    @staticmethod
+    def _message_bytes(message) -> bytes:
+        """Get the bytes to encrypt for a str (JSON) or bytes (CBOR) message."""
+        return message.encode('utf-8') if isinstance(message, str) else message
 
-        if (self.old_updated is not None) and (self.old_updated + 5400 <= math.floor(time.time())):  # Check if old key pair is outdated
-            self.old_private_key = None
-            self.old_public_key = None
-            self.old_updated = None
+    def _serialize_envelope(self, envelope_format: str, envelope_id: str, fields: list, payload: bytes,
+                            binary: bool):
+        """
+        Serialize a sealed message as a text envelope or a binary frame.
+
+        Args:
+            envelope_format (str): Envelope format.
+            envelope_id (str): Key id or session id, None for legacy envelopes.
+            fields (list): Raw header fields (RSA blocks for legacy envelopes).
+            payload (bytes): AES-GCM ciphertext, None for legacy envelopes.
+            binary (bool): Produce a binary frame.
 
-        return self.cur_public_key_b64  # Return current public key
+        Returns:
+            str | bytes: Serialized envelope.
+        """
+        if binary:
+            if envelope_format == self.LEGACY_FORMAT:
+                return BinaryFrame.encode(self.BINARY_FORMAT_CODES[envelope_format], '', [], b''.join(fields))
+            return BinaryFrame.encode(self.BINARY_FORMAT_CODES[envelope_format], envelope_id, fields, payload)
+
+        if envelope_format == self.LEGACY_FORMAT:
+            return ''.join(base64.b64encode(block).decode('utf-8') for block in fields)
+        return self.ENVELOPE_SEPARATOR.join(
+            [envelope_format, envelope_id] +
+            [base64.b64encode(part).decode('ascii') for part in fields] +
+            [base64.b64encode(payload).decode('ascii')]
+        )
 
-    def encrypt_message(self, public_key_b64: str, message: str):
+    def encrypt_message(self, public_key_b64: str, message, envelope_format: str = LEGACY_FORMAT,
+                        binary: bool = False):
         """
-        Encrypt a message using RSA public key.
+        Encrypt a message using a client public key.
+
+        X25519 keys are always answered with a key agreement envelope. RSA keys
+        use the hybrid envelope for hybrid and key agreement requests.
 
         Args:
             public_key_b64 (str): Base64-encoded public key.
-            message (str): Message to be encrypted.
+            message (str | bytes): Message to be encrypted, JSON text or CBOR.
+            envelope_format (str): Envelope format of the request.
+            binary (bool): Produce a binary frame instead of a text envelope.
 
         Returns:
             Response: Encrypted message and status code.
         """
-        serialized_public_key = base64.b64decode(public_key_b64)  # Decode base64-encoded public key
-        public_key = serialization.load_der_public_key(
-            serialized_public_key,
-            backend=default_backend()
-        )
-        message_sections = [message[i:i + self.ENCRYPTION_CHUNK_SIZE] for i in range(0, len(message), self.ENCRYPTION_CHUNK_SIZE)]  # Divide message into chunks
-        encrypted_message_sections = []
+        public_key = self.load_public_key(public_key_b64)
+
+        if isinstance(public_key, x25519.X25519PublicKey):
+            key_id, fields, payload = self._seal_ecdh(public_key, message)
+            envelope = self._serialize_envelope(self.ECDH_FORMAT, key_id, fields, payload, binary)
+        elif envelope_format in (self.HYBRID_FORMAT, self.ECDH_FORMAT):
+            key_id = ServerKey.compute_key_id(base64.b64decode(public_key_b64))
+            fields, payload = self._seal_hybrid(public_key, key_id, message)
+            envelope = self._serialize_envelope(self.HYBRID_FORMAT, key_id, fields, payload, binary)
+        else:
+            fields = self._seal_legacy(public_key_b64, public_key, message)
+            envelope = self._serialize_envelope(self.LEGACY_FORMAT, None, fields, None, binary)
+
+        return Response(message=envelope, status_code=200)
+
+    def _seal_legacy(self, public_key_b64: str, public_key, message) -> list:
+        """
+        Encrypt a message into legacy RSA blocks.
+
+        Args:
+            public_key_b64 (str): Base64-encoded public key.
+            public_key (RSAPublicKey): Parsed public key.
+            message (str | bytes): Message to be encrypted, JSON text or CBOR.
+
+        Returns:
+            list: Raw RSA blocks.
+        """
+        message_sections = [self._message_bytes(message[i:i + self.ENCRYPTION_CHUNK_SIZE]) for i in range(0, len(message), self.ENCRYPTION_CHUNK_SIZE)]  # Divide message into chunks
+
+        ciphertexts = None
+        if (self.crypto_service is not None) and (len(message_sections) >= CryptoService.MIN_ENCRYPT_JOBS):
+            ciphertexts = self.crypto_service.rsa_encrypt(base64.b64decode(public_key_b64), message_sections)
+        if ciphertexts is None:
+            ciphertexts = [public_key.encrypt(section, padding.PKCS1v15()) for section in message_sections]  # Encrypt each message chunk
+        return ciphertexts
+
+    def _seal_hybrid(self, public_key, key_id: str, message):
+        """
+        Encrypt a message for a hybrid envelope.
+
+        Args:
+            public_key (RSAPublicKey): Recipient public key used to wrap the content key.
+            key_id (str): Key id of the recipient public key.
+            message (str | bytes): Message to be encrypted, JSON text or CBOR.
+
+        Returns:
+            tuple: Header fields (wrapped key, nonce) and ciphertext.
+        """
+        content_key = AESGCM.generate_key(bit_length=self.CONTENT_KEY_SIZE * 8)  # One random key per message
+        nonce = os.urandom(self.NONCE_SIZE)
+
+        wrapped_key = public_key.encrypt(content_key, self.OAEP_PADDING)  # Single RSA operation per message
+        ciphertext = AESGCM(content_key).encrypt(nonce, self._message_bytes(message), self._hybrid_associated_data(key_id))
+        return [wrapped_key, nonce], ciphertext
+
+    def _hybrid_associated_data(self, key_id: str) -> bytes:
+        """Get the AES-GCM associated data binding a hybrid envelope to its header."""
+        return (self.HYBRID_FORMAT + self.ENVELOPE_SEPARATOR + key_id).encode('ascii')
+
+    def decrypt_message(self, ciphertext):
+        """
+        Decrypt an encrypted message.
+
+        Args:
+            ciphertext (str | bytes): Encrypted message, a text envelope or a binary frame.
+
+        Returns:
+            Response: Decrypted message and status code.
+        """
+        return self.decrypt_envelope(self.get_envelope(ciphertext))
+
+    def is_known_key_id(self, key_id: str) -> bool:
+        """
+        Check that a key id is well formed and names a key in the key ring.
+
+        Args:
+            key_id (str): Key id sent by the client.
+
+        Returns:
+            bool: True if a private key can be found for the key id.
+        """
+        if (len(key_id) != ServerKey.KEY_ID_LENGTH) or not self.KEY_ID_CHARACTERS.issuperset(key_id):
+            return False  # Not worth a key ring lookup, which may check the shared store
+        return self.key_ring_manager.get_server_key(key_id) is not None
+
+    def screen_envelope(self, envelope: Envelope):
+        """
+        Reject malformed envelopes before any private key or AES operation.
+
+        Checks that the envelope parsed, that its key id or session is known, and
+        that its blocks, keys, nonces and ciphertext have the sizes the format
+        requires, so garbage costs no more than parsing.
+
+        Args:
+            envelope (Envelope): Envelope returned by get_envelope.
+
+        Returns:
+            Response: Error response, or None if the envelope may be decrypted.
+        """
+        if (envelope.format == self.SESSION_FORMAT) and (envelope.session is None):
+            return Response(
+                error_message='session_expired',
+                message='Session is unknown or has expired. Perform a new handshake.',
+                status_code=400
+            )
+        if envelope.fields is None:
+            return self._invalid_encrypted_data()
+
+        if envelope.format == self.LEGACY_FORMAT:
+            blocks = envelope.fields
+            if (not blocks) or (len(blocks) > self.MAX_LEGACY_BLOCKS):
+                return self._invalid_encrypted_data()
+            for block in blocks:
+                if len(block) != self.RSA_BLOCK_SIZE:
+                    return self._invalid_encrypted_data()
+        elif envelope.format == self.SESSION_FORMAT:
+            nonce = envelope.fields[0]
+            if (len(nonce) != self.NONCE_SIZE) or (len(envelope.payload) < self.TAG_SIZE):
+                return self._invalid_encrypted_data()
+        else:
+            key_field, nonce = envelope.fields
+            key_size = self.RSA_BLOCK_SIZE if envelope.format == self.HYBRID_FORMAT else self.X25519_KEY_SIZE
+            if ((len(key_field) != key_size) or (len(nonce) != self.NONCE_SIZE)
+                    or (len(envelope.payload) < self.TAG_SIZE)):
+                return self._invalid_encrypted_data()
 
-        for section in message_sections:
-            ciphertext = public_key.encrypt(section.encode('utf-8'), padding.PKCS1v15())  # Encrypt each message chunk
-            encrypted_message_sections.append(base64.b64encode(ciphertext).decode('utf-8'))
+        if (envelope.format != self.SESSION_FORMAT) and (envelope.envelope_id is not None):
+            if not self.is_known_key_id(envelope.envelope_id):
+                return self._invalid_encrypted_data()
+        elif envelope.format in (self.HYBRID_FORMAT, self.ECDH_FORMAT):
+            return self._invalid_encrypted_data()  # These formats always name their key
+
+        return None
+
+    def decrypt_envelope(self, envelope: Envelope):
+        """
+        Screen and decrypt a parsed envelope.
+
+        Args:
+            envelope (Envelope): Envelope returned by get_envelope.
+
+        Returns:
+            Response: Decrypted message and status code.
+        """
+        response = self.screen_envelope(envelope)
+        if response is not None:
+            return response
 
-        final_encrypted = ''.join(encrypted_message_sections)
-        return Response(message=final_encrypted, status_code=200)
+        if envelope.format == self.SESSION_FORMAT:
+            return self._decrypt_session(envelope.session, *envelope.fields, envelope.payload)
+        if envelope.format == self.ECDH_FORMAT:
+            return self._decrypt_ecdh(envelope.envelope_id, *envelope.fields, envelope.payload)
+        if envelope.format == self.HYBRID_FORMAT:
+            return self._decrypt_hybrid(envelope.envelope_id, *envelope.fields, envelope.payload)
+        return self._decrypt_legacy(envelope.envelope_id, envelope.fields)
 
-    def decrypt_message(self, ciphertext: str):
+    def _decrypt_legacy(self, key_id: str, ciphertext_blocks: list):
         """
-        Decrypt an RSA-encrypted message.
+        Decrypt legacy RSA blocks.
 
         Args:
-            ciphertext (str): Encrypted message.
+            key_id (str): Key id the blocks were encrypted for, or None to try each accepted key.
+            ciphertext_blocks (list): Raw RSA blocks.
 
         Returns:
             Response: Decrypted message and status code.
         """
-        ciphertext_sections = [ciphertext[i:i + self.DECRYPTION_CHUNK_SIZE] for i in range(0, len(ciphertext), self.DECRYPTION_CHUNK_SIZE)]  # Divide ciphertext into chunks
-        plaintext_sections = []
+        if key_id is not None:
+            private_key = self.key_ring_manager.get_private_key(key_id)
+            if private_key is None:
+                return self._invalid_encrypted_data()
+            private_keys = [private_key]
+        else:
+            private_keys = self.key_ring_manager.get_key_ring().private_keys()  # Snapshot of the accepted keys
 
-        for section in ciphertext_sections:
+        offload = self.should_offload_legacy(len(ciphertext_blocks))
+        plaintext_blocks = self._decrypt_legacy_blocks(key_id, private_keys, ciphertext_blocks, offload)
+        if plaintext_blocks is None:
+            return self._invalid_encrypted_data()
+        return self._plaintext_response(b''.join(plaintext_blocks))
+
+    def should_offload_legacy(self, block_count: int) -> bool:
+        """
+        Check whether a legacy body is decrypted on the crypto service rather than the request thread.
+
+        Args:
+            block_count (int): Number of RSA blocks in the body.
+
+        Returns:
+            bool: True if the body has enough blocks to outweigh the round trip to the workers.
+        """
+        return (self.crypto_service is not None) and (block_count >= CryptoService.MIN_DECRYPT_JOBS)
+
+    def _decrypt_legacy_blocks(self, key_id: str, private_keys: list, ciphertext_blocks: list, offload: bool):
+        """
+        Decrypt legacy RSA blocks on the crypto service or the calling thread.
+
+        Args:
+            key_id (str): Key id the blocks were encrypted for, or None to try each accepted key.
+            private_keys (list): Private keys to try when decrypting on the calling thread.
+            ciphertext_blocks (list): Raw RSA blocks.
+            offload (bool): True to decrypt on the crypto service, falling back to the calling thread if it fails.
+
+        Returns:
+            list: Plaintext blocks, or None if any block cannot be decrypted.
+        """
+        plaintext_blocks = None
+        if offload:
+            plaintext_blocks = self.crypto_service.rsa_decrypt(key_id, ciphertext_blocks)
+        if plaintext_blocks is None:
+            plaintext_blocks = []
+            for block in ciphertext_blocks:
+                plaintext_block = self._rsa_decrypt_block(private_keys, bytes(block))
+                if plaintext_block is None:
+                    return None  # Skip the remaining blocks
+                plaintext_blocks.append(plaintext_block)
+
+        if None in plaintext_blocks:
+            return None
+        return plaintext_blocks
+
+    @staticmethod
+    def _rsa_decrypt_block(private_keys: list, ciphertext: bytes):
+        """
+        Decrypt one PKCS#1 v1.5 block with the first private key that accepts it.
+
+        Args:
+            private_keys (list): Private keys to try, in order.
+            ciphertext (bytes): RSA ciphertext block.
+
+        Returns:
+            bytes: Plaintext block, or None if no key can decrypt it.
+        """
+        for private_key in private_keys:
             try:
-                plaintext = self.cur_private_key.decrypt(base64.b64decode(section), padding.PKCS1v15())  # Decrypt each ciphertext chunk
+                return private_key.decrypt(ciphertext, padding.PKCS1v15())  # Decrypt each ciphertext chunk
             except ValueError:
-                try:
-                    if self.old_private_key is not None:
-                        plaintext = self.old_private_key.decrypt(base64.b64decode(section), padding.PKCS1v15())
-                    else:
-                        raise ValueError
-                except ValueError:
-                    return Response(
-                        error_message='invalid_encrypted_data',
-                        message='Encrypted data is corrupt. May have been encrypted using incorrect key.',
-                        status_code=400
-                    )
+                continue
+        return None
+
+    def _unwrap_content_key(self, key_id: str, wrapped_key):
+        """
+        Recover an AES content key wrapped with one of the server public keys.
+
+        Args:
+            key_id (str): Key id of the server key the content key was wrapped with.
+            wrapped_key (bytes | memoryview): RSA-OAEP encrypted content key.
+
+        Returns:
+            bytes: Content key, or None if the key id is unknown or the key cannot be unwrapped.
+        """
+        private_key = self.key_ring_manager.get_private_key(key_id)
+        if private_key is None:
+            return None  # Rejected before any RSA operation
+
+        # A single unwrap is cheaper than a round trip to the crypto service, so it always runs here
+        try:
+            return private_key.decrypt(bytes(wrapped_key), self.OAEP_PADDING)
+        except ValueError:
+            return None
+
+    def _decrypt_hybrid(self, key_id: str, wrapped_key, nonce, ciphertext):
+        """
+        Decrypt a hybrid envelope.
+
+        Args:
+            key_id (str): Key id of the server key the content key was wrapped with.
+            wrapped_key (bytes | memoryview): RSA-OAEP encrypted content key.
+            nonce (bytes | memoryview): AES-GCM nonce.
+            ciphertext (bytes | memoryview): AES-GCM ciphertext.
+
+        Returns:
+            Response: Decrypted message and status code.
+        """
+        if len(nonce) != self.NONCE_SIZE:
+            return self._invalid_encrypted_data()
+
+        content_key = self._unwrap_content_key(key_id, wrapped_key)
+        if content_key is None or len(content_key) != self.CONTENT_KEY_SIZE:
+            return self._invalid_encrypted_data()
+
+        try:
+            plaintext = AESGCM(content_key).decrypt(bytes(nonce), bytes(ciphertext), self._hybrid_associated_data(key_id))
+        except InvalidTag:
+            return self._invalid_encrypted_data()
+        return self._plaintext_response(plaintext)
+
+    @staticmethod
+    def _ecdh_associated_data(key_id: str, ephemeral_public_key: bytes) -> bytes:
+        """Get the HKDF info and AES-GCM associated data binding a key agreement envelope to its header."""
+        return Encryption.ENVELOPE_SEPARATOR.join([
+            Encryption.ECDH_FORMAT,
+            key_id,
+            base64.b64encode(ephemeral_public_key).decode('ascii')
+        ]).encode('ascii')
+
+    def _derive_ecdh_key(self, private_key, peer_public_key, associated_data: bytes) -> bytes:
+        """
+        Derive the AES content key of a key agreement envelope.
 
-            plaintext_sections.append(plaintext.decode('utf-8'))
+        Args:
+            private_key (X25519PrivateKey): Own X25519 private key.
+            peer_public_key (X25519PublicKey): Other party's X25519 public key.
+            associated_data (bytes): Envelope header, used as HKDF info.
 
-        final_plaintext = ''.join(plaintext_sections)
-        return Response(message=final_plaintext, status_code=200)
+        Returns:
+            bytes: AES-256-GCM content key.
 
-    def get_encrypted_response(self, response: Response, key: str):
+        Raises:
+            ValueError: If the peer key is a low-order point.
+        """
+        shared_secret = private_key.exchange(peer_public_key)
+        return HKDF(
+            algorithm=hashes.SHA256(),
+            length=self.CONTENT_KEY_SIZE,
+            salt=None,
+            info=associated_data
+        ).derive(shared_secret)
+
+    def _seal_ecdh(self, public_key, message):
+        """
+        Encrypt a message for a key agreement envelope to a client X25519 key.
+
+        Args:
+            public_key (X25519PublicKey): Client X25519 public key.
+            message (str | bytes): Message to be encrypted, JSON text or CBOR.
+
+        Returns:
+            tuple: Key id of the client key, header fields (ephemeral key, nonce) and ciphertext.
+        """
+        serialized_public_key = public_key.public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw
+        )
+        key_id = ServerKey.compute_key_id(serialized_public_key)
+
+        ephemeral_private_key = x25519.X25519PrivateKey.generate()  # One ephemeral key per message
+        ephemeral_public_key = ephemeral_private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw
+        )
+        associated_data = self._ecdh_associated_data(key_id, ephemeral_public_key)
+        content_key = self._derive_ecdh_key(ephemeral_private_key, public_key, associated_data)
+
+        nonce = os.urandom(self.NONCE_SIZE)
+        ciphertext = AESGCM(content_key).encrypt(nonce, self._message_bytes(message), associated_data)
+        return key_id, [ephemeral_public_key, nonce], ciphertext
+
+    def _decrypt_ecdh(self, key_id: str, ephemeral_public_key, nonce, ciphertext):
+        """
+        Decrypt a key agreement envelope sent to one of the server X25519 keys.
+
+        Args:
+            key_id (str): Key id of the server key the envelope was sent to.
+            ephemeral_public_key (bytes | memoryview): Raw ephemeral client X25519 public key.
+            nonce (bytes | memoryview): AES-GCM nonce.
+            ciphertext (bytes | memoryview): AES-GCM ciphertext.
+
+        Returns:
+            Response: Decrypted message and status code.
+        """
+        if (len(nonce) != self.NONCE_SIZE) or (len(ephemeral_public_key) != self.X25519_KEY_SIZE):
+            return self._invalid_encrypted_data()
+
+        server_key = self.key_ring_manager.get_server_key(key_id)
+        if server_key is None:
+            return self._invalid_encrypted_data()
+
+        ephemeral_public_key = bytes(ephemeral_public_key)
+        associated_data = self._ecdh_associated_data(key_id, ephemeral_public_key)
+        try:
+            content_key = self._derive_ecdh_key(server_key.x25519_private_key,
+                                                x25519.X25519PublicKey.from_public_bytes(ephemeral_public_key),
+                                                associated_data)
+            plaintext = AESGCM(content_key).decrypt(bytes(nonce), bytes(ciphertext), associated_data)
+        except (ValueError, InvalidTag):  # Covers low-order points
+            return self._invalid_encrypted_data()
+        return self._plaintext_response(plaintext)
+
+    @staticmethod
+    def _session_associated_data(session_id: str, is_response: bool) -> bytes:
+        """Get the AES-GCM associated data binding a session envelope to its session and direction."""
+        associated_data = Encryption.SESSION_FORMAT + Encryption.ENVELOPE_SEPARATOR + session_id
+        if is_response:
+            associated_data += Encryption.ENVELOPE_SEPARATOR + 'response'  # Responses cannot be replayed as requests
+        return associated_data.encode('ascii')
+
+    def _decrypt_session(self, session: Session, nonce, ciphertext):
+        """
+        Decrypt a session envelope.
+
+        Args:
+            session (Session): Session named by the envelope.
+            nonce (bytes | memoryview): AES-GCM nonce.
+            ciphertext (bytes | memoryview): AES-GCM ciphertext.
+
+        Returns:
+            Response: Decrypted message and status code.
+        """
+        if len(nonce) != self.NONCE_SIZE:
+            return self._invalid_encrypted_data()
+
+        try:
+            plaintext = session.aead.decrypt(bytes(nonce), bytes(ciphertext),
+                                             self._session_associated_data(session.session_id, False))
+        except InvalidTag:
+            return self._invalid_encrypted_data()
+        self.session_manager.confirm_session(session)  # Only sessions proven by their client are cached
+        return self._plaintext_response(plaintext)
+
+    def _seal_session(self, session: Session, message):
+        """
+        Encrypt a response for a session envelope.
+
+        Args:
+            session (Session): Session of the request.
+            message (str | bytes): Message to be encrypted, JSON text or CBOR.
+
+        Returns:
+            tuple: Header fields (nonce) and ciphertext.
+        """
+        nonce = os.urandom(self.NONCE_SIZE)
+        ciphertext = session.aead.encrypt(nonce, self._message_bytes(message),
+                                          self._session_associated_data(session.session_id, True))
+        return [nonce], ciphertext
+
+    def get_encrypted_response(self, response: Response, key: str, envelope: Envelope = None):
         """
         Get encrypted response.
 
         Args:
             response (Response): Original response.
             key (str): Base64-encoded public key.
+            envelope (Envelope): Envelope of the request, reused for the response.
+
+        Returns:
+            tuple: Encrypted response, status code and headers.
+        """
+        if envelope is None:
+            envelope = Envelope(self.LEGACY_FORMAT)
+
+        headers = response.headers()
+        message = response.cbor() if envelope.compact else response.json()
+        if envelope.session is not None:
+            fields, payload = self._seal_session(envelope.session, message)
+            encrypted = self._serialize_envelope(self.SESSION_FORMAT, envelope.session.session_id, fields, payload,
+                                                 envelope.binary)
+        elif key is None:
+            return response.json(), response.status_code, headers
+        else:
+            encrypted = self.encrypt_message(key, message, envelope.format, envelope.binary).message
+
+        if envelope.binary:
+            headers['Content-Type'] = 'application/octet-stream'
+            return encrypted, response.status_code, headers
+        return {'data': encrypted}, response.status_code, headers
+
+
+class StreamingLegacyDecryptor:
+    """
+    Decrypts a legacy text envelope block by block while the request body is still arriving.
+
+    Each complete base64 RSA block is decoded as soon as it has been received
+    and decrypted the same way Encryption decrypts a whole legacy envelope: on
+    the request thread one block at a time, or, with a crypto service, on its
+    workers in groups of MIN_DECRYPT_JOBS, so decryption overlaps with the
+    network. A body with fewer blocks than that is decrypted inline once it is
+    complete. The body is rejected at the first malformed or undecryptable
+    block, without decrypting the rest.
+
+    Attributes:
+        envelope (Envelope): Envelope of the request, used to encrypt the response.
+        failed (bool): True once the body is known to be invalid.
+    """
+
+    def __init__(self, encryption: Encryption):
+        """
+        Initialize the StreamingLegacyDecryptor.
+
+        Args:
+            encryption (Encryption): Encryption instance holding the key ring.
+        """
+        self.encryption = encryption
+        self.envelope = Envelope(Encryption.LEGACY_FORMAT)
+        self.failed = False
+        self.private_keys = None
+        self.pending = bytearray()
+        self.ciphertext_blocks = []
+        self.plaintext_blocks = []
+
+    def _start(self) -> bool:
+        """Read the optional key id prefix and pick the private keys to decrypt with."""
+        key_id_length = ServerKey.KEY_ID_LENGTH
+        separator = Encryption.ENVELOPE_SEPARATOR.encode('ascii')
+        if self.pending[key_id_length:key_id_length + 1] == separator:
+            key_id = self.pending[:key_id_length].decode('ascii', errors='replace')
+            del self.pending[:key_id_length + 1]
+            if not self.encryption.is_known_key_id(key_id):
+                return False
+            self.envelope.envelope_id = key_id
+            self.private_keys = [self.encryption.key_ring_manager.get_private_key(key_id)]
+        else:
+            self.private_keys = self.encryption.key_ring_manager.get_key_ring().private_keys()
+        return True
+
+    def feed(self, data: bytes) -> bool:
+        """
+        Decrypt any blocks completed by the next part of the body.
+
+        Args:
+            data (bytes): Next part of the request body.
+
+        Returns:
+            bool: False once the body is known to be invalid.
+        """
+        if self.failed:
+            return False
+        self.pending += data
+
+        if self.private_keys is None:
+            if len(self.pending) <= ServerKey.KEY_ID_LENGTH:
+                return True  # Wait for the whole key id prefix
+            if not self._start():
+                self.failed = True
+                return False
+
+        block_length = Encryption.DECRYPTION_CHUNK_SIZE
+        complete_length = len(self.pending) - len(self.pending) % block_length
+        for offset in range(0, complete_length, block_length):
+            if len(self.plaintext_blocks) + len(self.ciphertext_blocks) >= Encryption.MAX_LEGACY_BLOCKS:
+                self.failed = True
+                return False
+            try:
+                block = base64.b64decode(self.pending[offset:offset + block_length], validate=True)
+            except ValueError:
+                self.failed = True
+                return False
+            if len(block) != Encryption.RSA_BLOCK_SIZE:
+                self.failed = True
+                return False
+
+            self.ciphertext_blocks.append(block)
+            if self.encryption.crypto_service is None:
+                self._decrypt_blocks(False)
+            elif len(self.ciphertext_blocks) >= CryptoService.MIN_DECRYPT_JOBS:
+                self._decrypt_blocks(True)
+            if self.failed:
+                return False
+        del self.pending[:complete_length]
+        return True
+
+    def _decrypt_blocks(self, offload: bool):
+        """
+        Decrypt the blocks received since the last call.
+
+        Args:
+            offload (bool): True to decrypt on the crypto service.
+        """
+        plaintext_blocks = self.encryption._decrypt_legacy_blocks(self.envelope.envelope_id, self.private_keys,
+                                                                  self.ciphertext_blocks, offload)
+        self.ciphertext_blocks = []
+        if plaintext_blocks is None:
+            self.failed = True
+        else:
+            self.plaintext_blocks += plaintext_blocks
+
+    def finish(self) -> Response:
+        """
+        Finish decrypting once the whole body has been received.
 
         Returns:
-            tuple: Encrypted response and status code.
+            Response: Decrypted message and status code.
         """
-        if key is None:
-            return response.json(), response.status_code
-        return {'data': self.encrypt_message(key, response.json()).message}, response.status_code
+        if (self.private_keys is None) and (not self.failed):
+            self.failed = not self._start()
+        if (not self.failed) and self.ciphertext_blocks:
+            block_count = len(self.plaintext_blocks) + len(self.ciphertext_blocks)
+            self._decrypt_blocks(self.encryption.should_offload_legacy(block_count))
+        if self.failed or self.pending or (not self.plaintext_blocks):
+            return Encryption._invalid_encrypted_data()
+        return Encryption._plaintext_response(b''.join(self.plaintext_blocks))
@@ -0,0 +1,107 @@
+import struct  # Import struct module for frame length prefixes
+
+
+class BinaryFrame:
+    """
+    Binary framing for encrypted request and response bodies.
+
+    A frame is laid out as:
+
+        MAGIC (1 byte) | format code (1 byte) | id length (1 byte) | id |
+        field count (1 byte) | field count x (length (2 bytes, big-endian) | field) | payload
+
+    The magic byte never starts a base64 or text envelope, so binary and text
+    bodies can share the application/octet-stream content type. Frames are
+    parsed with memoryview slices, so no part of the body is copied until it
+    reaches the cipher.
+
+    Attributes:
+        MAGIC (int): First byte of every binary frame.
+        MAX_ID_LENGTH (int): Maximum length of the envelope id.
+        MAX_FIELD_LENGTH (int): Maximum length of a header field.
+    """
+
+    MAGIC = 0x00
+    MAX_ID_LENGTH = 0xFF
+    MAX_FIELD_LENGTH = 0xFFFF
+    FIELD_LENGTH = struct.Struct('>H')
+
+    __slots__ = ('format_code', 'envelope_id', 'fields', 'payload')
+
+    def __init__(self, format_code: int, envelope_id: str, fields: list, payload):
+        self.format_code = format_code
+        self.envelope_id = envelope_id
+        self.fields = fields
+        self.payload = payload
+
+    @classmethod
+    def is_binary(cls, data) -> bool:
+        """Check if a request body is a binary frame rather than a text envelope."""
+        return isinstance(data, (bytes, bytearray, memoryview)) and len(data) > 0 and data[0] == cls.MAGIC
+
+    @classmethod
+    def decode(cls, data) -> 'BinaryFrame':
+        """
+        Parse a binary frame.
+
+        Args:
+            data (bytes | memoryview): Request body.
+
+        Returns:
+            BinaryFrame: Parsed frame, whose fields and payload are memoryviews into data.
+
+        Raises:
+            ValueError: If the frame is truncated or malformed.
+        """
+        view = memoryview(data)
+        if len(view) < 4 or view[0] != cls.MAGIC:
+            raise ValueError('Not a binary frame')
+
+        format_code = view[1]
+        id_length = view[2]
+        offset = 3 + id_length
+        if len(view) < offset + 1:
+            raise ValueError('Truncated frame id')
+        envelope_id = bytes(view[3:offset]).decode('ascii')  # Short, and needed as a str for key lookups
+
+        field_count = view[offset]
+        offset += 1
+        fields = []
+        for _ in range(field_count):
+            if len(view) < offset + cls.FIELD_LENGTH.size:
+                raise ValueError('Truncated frame field')
+            (field_length,) = cls.FIELD_LENGTH.unpack_from(view, offset)
+            offset += cls.FIELD_LENGTH.size
+            if len(view) < offset + field_length:
+                raise ValueError('Truncated frame field')
+            fields.append(view[offset:offset + field_length])
+            offset += field_length
+
+        return cls(format_code, envelope_id, fields, view[offset:])
+
+    @classmethod
+    def encode(cls, format_code: int, envelope_id: str, fields: list, payload) -> bytes:
+        """
+        Build a binary frame.
+
+        Args:
+            format_code (int): Envelope format code.
+            envelope_id (str): Key id or session id, empty if the format has none.
+            fields (list): Header fields.
+            payload (bytes): Payload.
+
+        Returns:
+            bytes: Binary frame.
+        """
+        encoded_id = envelope_id.encode('ascii')
+        if len(encoded_id) > cls.MAX_ID_LENGTH:
+            raise ValueError('Frame id is too long')
+
+        parts = [bytes((cls.MAGIC, format_code, len(encoded_id))), encoded_id, bytes((len(fields),))]
+        for field in fields:
+            if len(field) > cls.MAX_FIELD_LENGTH:
+                raise ValueError('Frame field is too long')
+            parts.append(cls.FIELD_LENGTH.pack(len(field)))
+            parts.append(field)
+        parts.append(payload)
+        return b''.join(parts)
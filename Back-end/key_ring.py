@@ -0,0 +1,658 @@
+import time  # Import time module for timestamp operations
+import math  # Import math module for mathematical operations
+import base64  # Import base64 module for base64 encoding/decoding
+import logging  # Import logging module for rotation logging
+import hashlib  # Import hashlib module for key ids
+import threading  # Import threading for the background key generator
+import json  # Import json module for key ring serialization
+import os  # Import os module for the shared key ring file
+import re  # Import re module for recovering the generation of a damaged key ring file
+import stat  # Import stat module for checking key ring file permissions
+try:
+    import fcntl  # Import fcntl for locking the shared key ring file on POSIX
+except ImportError:
+    fcntl = None
+    import msvcrt  # Import msvcrt for locking the shared key ring file on Windows
+from cryptography.hazmat.backends import default_backend  # Import cryptography library for RSA encryption
+from cryptography.hazmat.primitives.asymmetric import rsa, x25519  # Import RSA and X25519 modules
+from cryptography.hazmat.primitives import serialization  # Import serialization module
+
+
+class ServerKey:
+    """
+    The RSA and X25519 key pairs issued for one key period.
+
+    Attributes:
+        private_key (RSAPrivateKey): Private key.
+        public_key (RSAPublicKey): Public key.
+        public_key_b64 (str): Base64-encoded DER public key, as served by /api/get-key.
+        key_id (str): Short fingerprint of the public key, carried by envelopes to select the private key.
+        updated (int): Start of the key period the key was issued for.
+        session_secret (bytes): Random secret that session keys issued during the period are derived from.
+        x25519_private_key (X25519PrivateKey): X25519 private key for key agreement envelopes.
+        x25519_public_key_b64 (str): Base64-encoded raw X25519 public key, as served by /api/get-key.
+    """
+
+    KEY_ID_LENGTH = 8
+    SESSION_SECRET_SIZE = 32
+
+    __slots__ = ('private_key', 'public_key', 'public_key_b64', 'key_id', 'updated', 'session_secret',
+                 'x25519_private_key', 'x25519_public_key_b64')
+
+    def __init__(self, private_key, updated: int, session_secret: bytes = None, x25519_private_key=None):
+        self.private_key = private_key
+        self.public_key = private_key.public_key()
+        serialized_public_key = self.public_key.public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        self.public_key_b64 = base64.b64encode(serialized_public_key).decode('utf-8')  # Base64 encode public key
+        self.key_id = self.compute_key_id(serialized_public_key)
+        self.updated = updated
+        self.session_secret = session_secret if session_secret is not None else os.urandom(self.SESSION_SECRET_SIZE)
+
+        if x25519_private_key is None:
+            x25519_private_key = x25519.X25519PrivateKey.generate()  # Near-instant, unlike RSA keygen
+        self.x25519_private_key = x25519_private_key
+        self.x25519_public_key_b64 = base64.b64encode(x25519_private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw
+        )).decode('utf-8')
+
+    @staticmethod
+    def compute_key_id(serialized_public_key: bytes) -> str:
+        """
+        Compute the key id of a DER-encoded public key.
+
+        Args:
+            serialized_public_key (bytes): DER-encoded public key.
+
+        Returns:
+            str: First KEY_ID_LENGTH hex digits of the key's SHA-256 digest.
+        """
+        return hashlib.sha256(serialized_public_key).hexdigest()[:ServerKey.KEY_ID_LENGTH]
+
+
+class KeyRing:
+    """
+    Immutable snapshot of the server keys that are valid for decryption.
+
+    A new KeyRing is built on every rotation and published with a single
+    reference assignment, so readers always see a matching current/previous pair.
+
+    Attributes:
+        KEY_PERIOD (int): Length of a key period in seconds.
+        PREVIOUS_KEY_CARRY_WINDOW (int): Maximum age of a key that is kept as the previous key on rotation.
+        PREVIOUS_KEY_GRACE (int): Age after which the previous key is no longer accepted.
+    """
+
+    KEY_PERIOD = 3600
+    PREVIOUS_KEY_CARRY_WINDOW = 7200
+    PREVIOUS_KEY_GRACE = 5400
+
+    __slots__ = ('current', 'previous', 'generation', 'keys_by_id')
+
+    def __init__(self, current: ServerKey, previous: ServerKey = None, generation: int = 0):
+        keys_by_id = {current.key_id: current}
+        if previous is not None:
+            keys_by_id[previous.key_id] = previous
+
+        object.__setattr__(self, 'current', current)
+        object.__setattr__(self, 'previous', previous)
+        object.__setattr__(self, 'generation', generation)
+        object.__setattr__(self, 'keys_by_id', keys_by_id)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('KeyRing is immutable')
+
+    @staticmethod
+    def current_period(now: float = None) -> int:
+        """
+        Get the start of the key period containing a timestamp.
+
+        Args:
+            now (float): Timestamp, defaults to the current time.
+
+        Returns:
+            int: Start of the key period.
+        """
+        if now is None:
+            now = time.time()
+        return math.floor(now) // KeyRing.KEY_PERIOD * KeyRing.KEY_PERIOD
+
+    def is_stale(self, now: float = None) -> bool:
+        """Check if the current key's period has ended."""
+        if now is None:
+            now = time.time()
+        return self.current.updated + self.KEY_PERIOD <= math.floor(now)
+
+    def private_keys(self, now: float = None) -> list:
+        """
+        Get the private keys accepted for decryption, newest first.
+
+        Args:
+            now (float): Timestamp, defaults to the current time.
+
+        Returns:
+            list: Current private key, followed by the previous one while it is within its grace period.
+        """
+        if now is None:
+            now = time.time()
+
+        private_keys = [self.current.private_key]
+        if (self.previous is not None) and (self.previous.updated + self.PREVIOUS_KEY_GRACE > math.floor(now)):
+            private_keys.append(self.previous.private_key)
+        return private_keys
+
+    def get_server_key(self, key_id: str, now: float = None):
+        """
+        Get the server key with a given key id.
+
+        Args:
+            key_id (str): Key id sent by the client.
+            now (float): Timestamp, defaults to the current time.
+
+        Returns:
+            ServerKey: Matching server key, or None if the id is unknown or past its grace period.
+        """
+        server_key = self.keys_by_id.get(key_id)
+        if server_key is None:
+            return None
+        if server_key is not self.current:
+            if now is None:
+                now = time.time()
+            if server_key.updated + self.PREVIOUS_KEY_GRACE <= math.floor(now):
+                return None
+        return server_key
+
+    def get_private_key(self, key_id: str, now: float = None):
+        """
+        Get the private key with a given key id.
+
+        Args:
+            key_id (str): Key id sent by the client.
+            now (float): Timestamp, defaults to the current time.
+
+        Returns:
+            RSAPrivateKey: Matching private key, or None if the id is unknown or past its grace period.
+        """
+        server_key = self.get_server_key(key_id, now)
+        return None if server_key is None else server_key.private_key
+
+    def rotated(self, new_key: ServerKey) -> 'KeyRing':
+        """
+        Build the key ring that follows this one.
+
+        Args:
+            new_key (ServerKey): Key issued for the new period.
+
+        Returns:
+            KeyRing: New snapshot with the current key carried over as the previous key if still recent.
+        """
+        if self.current.updated + self.PREVIOUS_KEY_CARRY_WINDOW > new_key.updated:
+            previous = self.current
+        else:
+            previous = None
+        return KeyRing(new_key, previous, self.generation + 1)
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialize the key ring, including private keys, for sharing with local worker processes.
+
+        Returns:
+            bytes: Serialized key ring.
+        """
+        server_keys = [self.current] if self.previous is None else [self.current, self.previous]
+        return json.dumps({
+            'generation': self.generation,
+            'keys': [{
+                'private_key': server_key.private_key.private_bytes(
+                    encoding=serialization.Encoding.PEM,
+                    format=serialization.PrivateFormat.PKCS8,
+                    encryption_algorithm=serialization.NoEncryption()
+                ).decode('ascii'),
+                'updated': server_key.updated,
+                'session_secret': base64.b64encode(server_key.session_secret).decode('ascii'),
+                'x25519_private_key': base64.b64encode(server_key.x25519_private_key.private_bytes(
+                    encoding=serialization.Encoding.Raw,
+                    format=serialization.PrivateFormat.Raw,
+                    encryption_algorithm=serialization.NoEncryption()
+                )).decode('ascii')
+            } for server_key in server_keys]
+        }).encode('utf-8')
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'KeyRing':
+        """
+        Rebuild a key ring serialized with to_bytes.
+
+        Args:
+            data (bytes): Serialized key ring.
+
+        Returns:
+            KeyRing: Deserialized key ring.
+        """
+        key_ring_dict = json.loads(data)
+        server_keys = [
+            ServerKey(serialization.load_pem_private_key(key['private_key'].encode('ascii'), password=None,
+                                                         backend=default_backend()),
+                      key['updated'],
+                      base64.b64decode(key['session_secret']),
+                      x25519.X25519PrivateKey.from_private_bytes(base64.b64decode(key['x25519_private_key'])))
+            for key in key_ring_dict['keys']
+        ]
+        previous = server_keys[1] if len(server_keys) > 1 else None
+        return KeyRing(server_keys[0], previous, key_ring_dict['generation'])
+
+
+class KeyRingUnreadableError(ValueError):
+    """
+    Raised when the key ring file exists but cannot be read.
+
+    Attributes:
+        generation (int): Generation recovered from the damaged file, None if it could not be.
+    """
+
+    def __init__(self, path: str, generation: int = None):
+        super().__init__(f'Key ring file {path} cannot be read')
+        self.generation = generation
+
+
+class KeyRingStore:
+    """
+    File that shares one key ring between all API worker processes on a host.
+
+    The key ring is replaced atomically with os.replace, so readers never see a
+    partial file and need no lock. A separate lock file makes sure only one
+    process rotates the keys for a period.
+
+    The file holds the server private keys unencrypted. It is created readable
+    by its owner only, and must be kept in a directory that only the API user
+    can access; a file readable by other users is reported when loaded.
+    """
+
+    GENERATION_PATTERN = re.compile(rb'"generation"\s*:\s*(\d+)')
+
+    def __init__(self, path: str):
+        """
+        Initialize the KeyRingStore.
+
+        Args:
+            path (str): Absolute path of the key ring file. The lock file is the same path with '.lock' appended.
+
+        Raises:
+            ValueError: If the path is not absolute, so the keys never land in whatever directory the server started in.
+        """
+        if not os.path.isabs(path):
+            raise ValueError(f'Key ring path must be absolute, got {path!r}')
+        self.path = path
+        self.lock_path = path + '.lock'
+        self._lock_fd = None
+
+    def version(self):
+        """
+        Get a token that changes whenever the key ring file is replaced.
+
+        Returns:
+            tuple: Inode, modification time and size of the file, or None if it does not exist.
+        """
+        try:
+            stat_result = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size
+
+    def load(self):
+        """
+        Read the shared key ring.
+
+        Returns:
+            KeyRing: Stored key ring, or None if none has been written yet.
+
+        Raises:
+            KeyRingUnreadableError: If the file is empty, truncated or has been edited by hand.
+        """
+        try:
+            with open(self.path, 'rb') as key_ring_file:
+                if (os.name == 'posix') and (os.fstat(key_ring_file.fileno()).st_mode & (stat.S_IRWXG | stat.S_IRWXO)):
+                    logging.warning("Key ring file %s is accessible by other users", self.path)
+                data = key_ring_file.read()
+        except FileNotFoundError:
+            return None
+
+        try:
+            return KeyRing.from_bytes(data)
+        except (KeyError, ValueError, TypeError, IndexError, AttributeError) as error:
+            logging.exception("Cannot read key ring file %s", self.path)
+            match = self.GENERATION_PATTERN.search(data)
+            raise KeyRingUnreadableError(self.path, int(match.group(1)) if match else None) from error
+
+    def save(self, key_ring: KeyRing):
+        """
+        Atomically replace the shared key ring.
+
+        Args:
+            key_ring (KeyRing): Key ring to store.
+        """
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)  # Private keys, owner only
+        with os.fdopen(fd, 'wb') as key_ring_file:
+            key_ring_file.write(key_ring.to_bytes())
+            key_ring_file.flush()
+            os.fsync(key_ring_file.fileno())
+        os.replace(temp_path, self.path)
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """
+        Take the rotation lock shared by all processes using this store.
+
+        Args:
+            blocking (bool): Wait for the lock if another process holds it.
+
+        Returns:
+            bool: True if the lock was taken.
+        """
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(fd)
+            return False
+
+        self._lock_fd = fd
+        return True
+
+    def release(self):
+        """Release the rotation lock."""
+        fd, self._lock_fd = self._lock_fd, None
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        else:
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        os.close(fd)
+
+
+class KeyRingManager:
+    """
+    Owns the published KeyRing and rotates it from a background thread.
+
+    The next RSA key pair is generated ahead of time, so rotation at the start
+    of each key period is a reference swap and never waits on key generation.
+    """
+
+    KEY_SIZE = 2048
+    PUBLIC_EXPONENT = 65537
+    CHECK_INTERVAL = 1  # Seconds between rotation checks in the background thread
+
+    def __init__(self, start_thread: bool = True, store: KeyRingStore = None):
+        """
+        Load or generate the first key ring and start the background rotation thread.
+
+        Args:
+            start_thread (bool): Whether to start the background rotation thread.
+            store (KeyRingStore): Key ring shared with other worker processes, None to keep keys in this process.
+        """
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._next_private_key = None
+        self._rotation_listeners = []
+
+        self.rotation_count = 0
+        self.inline_keygen_count = 0
+        self.store_reload_count = 0
+        self.store_restore_count = 0
+        self.last_keygen_seconds = None
+        self.max_keygen_seconds = 0.0
+        self.last_rotation_time = None
+        self.last_rotation_lag_seconds = None
+
+        self.store = store
+        self._store_version = None
+        if store is None:
+            self.key_ring = KeyRing(ServerKey(self._generate_private_key(), KeyRing.current_period()))
+        else:
+            store.acquire()
+            try:
+                try:
+                    key_ring = store.load()
+                    generation = 0
+                except KeyRingUnreadableError as error:
+                    # Replaced after the last generation known, other workers also put back any later one
+                    key_ring = None
+                    generation = 0 if error.generation is None else error.generation + 1
+                if key_ring is None:
+                    key_ring = KeyRing(ServerKey(self._generate_private_key(), KeyRing.current_period()),
+                                       generation=generation)
+                    store.save(key_ring)
+                elif key_ring.is_stale():
+                    key_ring = key_ring.rotated(ServerKey(self._generate_private_key(), KeyRing.current_period()))
+                    store.save(key_ring)
+                self._store_version = store.version()
+            finally:
+                store.release()
+            self.key_ring = key_ring
+
+        self._thread = None
+        if start_thread:
+            self._thread = threading.Thread(target=self._run, name='key-ring-rotation', daemon=True)
+            self._thread.start()
+
+    def _generate_private_key(self):
+        """
+        Generate an RSA private key and record how long it took.
+
+        Returns:
+            RSAPrivateKey: New private key.
+        """
+        start_time = time.perf_counter()
+        private_key = rsa.generate_private_key(
+            public_exponent=self.PUBLIC_EXPONENT,
+            key_size=self.KEY_SIZE,
+            backend=default_backend()
+        )
+        elapsed = time.perf_counter() - start_time
+
+        self.last_keygen_seconds = elapsed
+        self.max_keygen_seconds = max(self.max_keygen_seconds, elapsed)
+        return private_key
+
+    def _pregenerate(self):
+        """Generate the next key pair if one is not already waiting."""
+        if self._next_private_key is None:
+            private_key = self._generate_private_key()
+            with self._lock:
+                if self._next_private_key is None:
+                    self._next_private_key = private_key
+
+    def _publish(self, key_ring: KeyRing):
+        """
+        Make a key ring current and notify rotation listeners. Called with the lock held.
+
+        Args:
+            key_ring (KeyRing): Key ring to publish.
+        """
+        self.key_ring = key_ring  # Single reference assignment
+        for listener in self._rotation_listeners:
+            listener(key_ring)
+
+    def _reload_from_store(self, store_locked: bool = False):
+        """
+        Adopt a key ring rotated by another process, if the store has changed. Called with the lock held.
+
+        If the store holds an older key ring than this process, or none at all,
+        a restarted process has replaced it, so this process writes its own back
+        and every process converges on the latest keys.
+
+        Args:
+            store_locked (bool): True if the store lock is already held.
+        """
+        version = self.store.version()
+        if version == self._store_version:
+            return
+
+        try:
+            key_ring = self.store.load()
+        except KeyRingUnreadableError:
+            key_ring = None
+
+        if (key_ring is not None) and (key_ring.generation >= self.key_ring.generation):
+            self._store_version = version
+            if key_ring.generation > self.key_ring.generation:
+                self.store_reload_count += 1
+                self._publish(key_ring)
+            return
+
+        if (not store_locked) and (not self.store.acquire(blocking=False)):
+            return  # Retried on the next check, as the version is not recorded
+        try:
+            if store_locked or (self.store.version() == version):
+                self.store.save(self.key_ring)
+                self.store_restore_count += 1
+                logging.warning("Restored key ring generation %s over an older shared key ring",
+                                self.key_ring.generation)
+            self._store_version = None  # Re-read on the next check
+        finally:
+            if not store_locked:
+                self.store.release()
+
+    def _rotate_if_stale(self, inline: bool):
+        """
+        Publish a new key ring if the current key period has ended.
+
+        With a shared store, only the process holding the store lock rotates;
+        the others adopt its key ring from the store.
+
+        Args:
+            inline (bool): True when called from a request thread.
+        """
+        with self._lock:
+            if self.store is not None:
+                self._reload_from_store()
+
+            now = time.time()
+            if not self.key_ring.is_stale(now):
+                return
+
+            if (self.store is not None) and (not self.store.acquire(blocking=False)):
+                return  # Another process is rotating; its key ring is picked up on the next reload
+
+            try:
+                if self.store is not None:
+                    self._reload_from_store(store_locked=True)  # Re-check under the store lock
+                    if not self.key_ring.is_stale(now):
+                        return
+
+                private_key = self._next_private_key
+                self._next_private_key = None
+                if private_key is None:
+                    # Only reached if the background thread has fallen behind
+                    if inline:
+                        self.inline_keygen_count += 1
+                    private_key = self._generate_private_key()
+
+                period = KeyRing.current_period(now)
+                new_key_ring = self.key_ring.rotated(ServerKey(private_key, period))
+                if self.store is not None:
+                    self.store.save(new_key_ring)
+                    self._store_version = self.store.version()
+                self._publish(new_key_ring)
+
+                self.rotation_count += 1
+                self.last_rotation_time = now
+                self.last_rotation_lag_seconds = now - period
+            finally:
+                if self.store is not None:
+                    self.store.release()
+
+        logging.info("Rotated encryption key ring to generation %s (lag %.3fs)",
+                     new_key_ring.generation, self.last_rotation_lag_seconds)
+
+    def add_rotation_listener(self, listener):
+        """
+        Register a callback that receives every newly published key ring.
+
+        Args:
+            listener (callable): Function taking the new KeyRing.
+        """
+        self._rotation_listeners.append(listener)
+
+    def _run(self):
+        """Background loop keeping a key pregenerated and rotating on period boundaries."""
+        while not self._stop_event.is_set():
+            self._rotate_if_stale(inline=False)
+            self._pregenerate()
+            self._stop_event.wait(self.CHECK_INTERVAL)
+
+    def get_key_ring(self) -> KeyRing:
+        """
+        Get the current key ring snapshot.
+
+        Returns:
+            KeyRing: Current key ring.
+        """
+        key_ring = self.key_ring
+        if key_ring.is_stale():
+            # Background thread has not rotated yet; swap in the pregenerated key
+            self._rotate_if_stale(inline=True)
+            key_ring = self.key_ring
+        return key_ring
+
+    def get_server_key(self, key_id: str):
+        """
+        Get the server key for a key id, checking the shared store for a newer key ring on a miss.
+
+        Args:
+            key_id (str): Key id sent by the client.
+
+        Returns:
+            ServerKey: Matching server key, or None if the id is unknown.
+        """
+        server_key = self.get_key_ring().get_server_key(key_id)
+        if (server_key is None) and (self.store is not None):
+            # The client may have fetched a key that another process rotated in moments ago
+            with self._lock:
+                self._reload_from_store()
+            server_key = self.key_ring.get_server_key(key_id)
+        return server_key
+
+    def get_private_key(self, key_id: str):
+        """
+        Get the private key for a key id, checking the shared store for a newer key ring on a miss.
+
+        Args:
+            key_id (str): Key id sent by the client.
+
+        Returns:
+            RSAPrivateKey: Matching private key, or None if the id is unknown.
+        """
+        server_key = self.get_server_key(key_id)
+        return None if server_key is None else server_key.private_key
+
+    def get_metrics(self) -> dict:
+        """
+        Get key rotation metrics.
+
+        Returns:
+            dict: Rotation count, key generation timings and how often key generation ran on a request thread.
+        """
+        return {
+            'generation': self.key_ring.generation,
+            'rotation_count': self.rotation_count,
+            'inline_keygen_count': self.inline_keygen_count,
+            'store_reload_count': self.store_reload_count,
+            'store_restore_count': self.store_restore_count,
+            'last_keygen_seconds': self.last_keygen_seconds,
+            'max_keygen_seconds': self.max_keygen_seconds,
+            'last_rotation_time': self.last_rotation_time,
+            'last_rotation_lag_seconds': self.last_rotation_lag_seconds,
+            'next_key_ready': self._next_private_key is not None
+        }
+
+    def stop(self):
+        """Stop the background rotation thread."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -2,10 +2,15 @@ import time  # Importing the time module for handling time-related operations
 import logging  # Importing the logging module for logging functionality
 import threading  # Importing threading for concurrent execution
 from flask import Flask  # Importing Flask for creating a web application
+from werkzeug.middleware.proxy_fix import ProxyFix  # Importing ProxyFix for taking client IPs from trusted proxies
 
 from api_blueprint import app_api_blueprint  # Importing the blueprint_app from api_blueprint
 from database import DatabaseCreator, ConnectionPool, DatabaseConnector  # Importing database-related modules
 from encryption import Encryption  # Importing Encryption class for handling encryption operations
+from key_ring import KeyRingManager, KeyRingStore  # Importing key ring classes for sharing server keys
+from replay_guard import ReplayGuard  # Importing ReplayGuard for in-memory replay protection
+from admission import AdmissionControl, TokenBucketTable  # Importing admission control for rate limiting clients
+from config import EncryptionConfig, ReplayConfig, AdmissionConfig, PoolConfig  # Importing encryption, replay, admission and pool configuration
 
 # Initializing a flag to control the deletion of rows
 delete_rows = True
@@ -28,16 +33,16 @@ def delete_expired_rows(connection_pool: ConnectionPool):
         None
     """
     while delete_rows:
-        # Creating a DatabaseConnector instance using a connection from the pool
-        db_conn = DatabaseConnector(connection_pool.get_conn())
-        # Deleting old IDs, transactions, and alias addresses from the database
-        db_conn.delete_old_ids()
-        db_conn.delete_old_transactions()
-        db_conn.delete_old_alias_addresses()
-        # Closing the database connection
-        db_conn.close()
-        # Returning the connection to the pool for reuse
-        connection_pool.putconn(db_conn.conn)
+        # Checking out a connection from the pool, returned to it at the end of the block
+        with connection_pool.connection() as connection:
+            # Creating a DatabaseConnector instance using the connection
+            db_conn = DatabaseConnector(connection)
+            # Deleting old IDs, transactions, and alias addresses from the database
+            db_conn.delete_old_ids()
+            db_conn.delete_old_transactions()
+            db_conn.delete_old_alias_addresses()
+            # Closing the cursor, keeping the connection open for reuse
+            db_conn.close()
         # Sleeping for 10 seconds before the next iteration
         time.sleep(10)
 
@@ -52,16 +57,18 @@ if __name__ == "__main__":
     db_creator.create_database_if_not_exists()
 
     # Creating a ConnectionPool instance for managing database connections
-    connection_pool = ConnectionPool('currency', 'postgres', 'password', 'localhost', '5432', 10, 50)
-
-    # Creating a DatabaseConnector instance using a connection from the pool
-    db_conn = DatabaseConnector(connection_pool.get_conn())
-    # Creating necessary tables if they don't exist
-    db_conn.create_tables_if_not_exist()
-    # Closing the database connection
-    db_conn.close()
-    # Returning the connection to the pool for reuse
-    connection_pool.putconn(db_conn.conn)
+    connection_pool = ConnectionPool('currency', 'postgres', 'password', 'localhost', '5432',
+                                     PoolConfig.MIN_CONNECTIONS, PoolConfig.MAX_CONNECTIONS,
+                                     on_connect=DatabaseConnector.prepare_statements if PoolConfig.PREPARE_ON_CONNECT else None)
+
+    # Checking out a connection from the pool, returned to it at the end of the block
+    with connection_pool.connection() as connection:
+        # Creating a DatabaseConnector instance using the connection
+        db_conn = DatabaseConnector(connection)
+        # Creating necessary tables if they don't exist
+        db_conn.create_tables_if_not_exist()
+        # Closing the cursor, keeping the connection open for reuse
+        db_conn.close()
 
     # Creating a thread for the delete_expired_rows function
     thread = threading.Thread(target=delete_expired_rows, args=(connection_pool,))
@@ -70,11 +77,40 @@ if __name__ == "__main__":
 
     # Setting up Flask app configurations
     app.config['connection_pool'] = connection_pool
-    app.config['encryption'] = Encryption()
+    # Checking request ids in memory saves a database round trip per write request, but only a single process may do it
+    if ReplayConfig.IN_MEMORY and EncryptionConfig.KEY_RING_PATH:
+        raise RuntimeError("ReplayConfig.IN_MEMORY only protects a single API process, "
+                           "so it cannot be enabled with a shared EncryptionConfig.KEY_RING_PATH")
+    replay_guard = None
+    if ReplayConfig.IN_MEMORY:
+        replay_guard = ReplayGuard(connection_pool, ReplayConfig.FLUSH_INTERVAL, ReplayConfig.MAX_BATCH_SIZE)
+    app.config['replay_guard'] = replay_guard
+    # Rate limiting clients keeps database connections free for well-behaved users during spikes
+    if AdmissionConfig.TRUSTED_PROXY_COUNT > 0:
+        # Behind a load balancer every request comes from its address, so take the client IP it forwards.
+        # Without a configured proxy X-Forwarded-For is set by the client and is never used
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=AdmissionConfig.TRUSTED_PROXY_COUNT)
+    ip_buckets = None
+    if AdmissionConfig.IP_RATE > 0:
+        ip_buckets = TokenBucketTable(AdmissionConfig.IP_RATE, AdmissionConfig.IP_BURST,
+                                      AdmissionConfig.STRIPE_COUNT, AdmissionConfig.MAX_TRACKED_CLIENTS)
+    key_buckets = None
+    if AdmissionConfig.KEY_RATE > 0:
+        key_buckets = TokenBucketTable(AdmissionConfig.KEY_RATE, AdmissionConfig.KEY_BURST,
+                                       AdmissionConfig.STRIPE_COUNT, AdmissionConfig.MAX_TRACKED_CLIENTS)
+    app.config['admission_control'] = AdmissionControl(ip_buckets, key_buckets)
+    # Sharing the key ring file lets every API worker process decrypt requests encrypted for any of them
+    key_ring_store = KeyRingStore(EncryptionConfig.KEY_RING_PATH) if EncryptionConfig.KEY_RING_PATH else None
+    app.config['encryption'] = Encryption(key_ring_manager=KeyRingManager(store=key_ring_store),
+                                          crypto_service_workers=EncryptionConfig.CRYPTO_SERVICE_WORKERS)
 
     # Running the Flask app in debug mode
     app.run(debug=True)
 
+    # Writing any request ids still queued by the replay guard
+    if replay_guard is not None:
+        replay_guard.stop()
+
     # Updating the flag to stop the deletion of rows
     delete_rows = False
     # Waiting for the delete_expired_rows thread to finish
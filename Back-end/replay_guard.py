@@ -0,0 +1,187 @@
+import time  # Import time module for expiring request ids
+import logging  # Import logging module for failed writes
+import threading  # Import threading for the lock and the write-behind thread
+
+from database import ConnectionPool, DatabaseConnector  # Import database classes for persisting request ids
+from response import Response  # Import Response class from response module
+
+
+class ReplayGuard:
+    """
+    In-memory replay protection for request ids, persisted to the Ids table in the background.
+
+    Ids are looked up in a dict and also filed in buckets keyed by their
+    expiry time. Request expiry times are at most MAX_REQUEST_EXPIRY_TIME
+    seconds ahead, so only that many buckets are ever live, and a bucket is
+    dropped as a whole once its expiry time has passed. New ids are queued and
+    written to the Ids table in batches by a background thread, and the guard
+    is loaded from the Ids table when it starts, so a restarted server still
+    rejects ids it accepted before.
+
+    The guard only sees ids accepted by its own process, so another process
+    sharing the database could accept a replayed id before it is written, or
+    at any time if it never loads it. It must only be enabled
+    (ReplayConfig.IN_MEMORY) for a single API process, and main.py refuses to
+    enable it while a shared key ring lets several processes serve requests.
+
+    Attributes:
+        flush_interval (float): Seconds between background writes.
+        max_batch_size (int): Maximum number of ids written per INSERT.
+    """
+
+    ID_LENGTH = 32  # Request ids are stored as numbers, so leading zeros are restored on load
+
+    def __init__(self, connection_pool: ConnectionPool, flush_interval: float, max_batch_size: int):
+        """
+        Initialize the ReplayGuard, load live ids from the database and start the write-behind thread.
+
+        Args:
+            connection_pool (ConnectionPool): Connection pool for database connections.
+            flush_interval (float): Seconds between background writes.
+            max_batch_size (int): Maximum number of ids written per INSERT.
+        """
+        self.connection_pool = connection_pool
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+
+        self.lock = threading.Lock()
+        self.ids = {}  # Request id -> expiry time
+        self.buckets = {}  # Expiry time -> request ids expiring then
+        self.oldest_expiry_time = None
+        self.pending = []  # (request id, expiry time) not yet written to the database
+
+        self.accepted_count = 0
+        self.rejected_count = 0
+        self.flushed_count = 0
+        self.failed_flush_count = 0
+
+        self.load()
+
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='replay-guard-writer', daemon=True)
+        self._thread.start()
+
+    def load(self):
+        """Load the unexpired ids from the Ids table."""
+        with self.connection_pool.connection() as connection:
+            db_conn = DatabaseConnector(connection)
+            rows = db_conn.get_live_ids(int(time.time()))
+            db_conn.close()
+
+        with self.lock:
+            for request_id, expiry_time in rows:
+                self._remember(str(request_id).zfill(self.ID_LENGTH), int(expiry_time))
+
+    def _remember(self, request_id: str, expiry_time: int):
+        """File an id under its expiry time. The lock must be held."""
+        self.ids[request_id] = expiry_time
+        bucket = self.buckets.get(expiry_time)
+        if bucket is None:
+            bucket = self.buckets[expiry_time] = []
+            if (self.oldest_expiry_time is None) or (expiry_time < self.oldest_expiry_time):
+                self.oldest_expiry_time = expiry_time
+        bucket.append(request_id)
+
+    def _drop_expired(self, now: int):
+        """Drop every bucket whose expiry time has passed. The lock must be held."""
+        if (self.oldest_expiry_time is None) or (self.oldest_expiry_time >= now):
+            return
+
+        for expiry_time in [expiry_time for expiry_time in self.buckets if expiry_time < now]:
+            for request_id in self.buckets.pop(expiry_time):
+                del self.ids[request_id]
+        self.oldest_expiry_time = min(self.buckets) if self.buckets else None
+
+    def add_id(self, request_id: str, expiry_time) -> Response:
+        """
+        Accept a request id if it has not been seen before.
+
+        Args:
+            request_id (str): Request id.
+            expiry_time (str | int): Expiry time of the request.
+
+        Returns:
+            Response: The response object with the result of the operation.
+        """
+        expiry_time = int(expiry_time)
+        with self.lock:
+            self._drop_expired(int(time.time()))
+
+            if request_id in self.ids:
+                self.rejected_count += 1
+                accepted = False
+            else:
+                self._remember(request_id, expiry_time)
+                self.pending.append((request_id, expiry_time))
+                self.accepted_count += 1
+                accepted = True
+
+        if accepted:
+            response = Response(
+                message='success',
+                status_code=200
+            )
+        else:
+            response = Response(
+                error_message='invalid_id',
+                message='Id has expired',
+                status_code=400
+            )
+
+        return response
+
+    def flush(self):
+        """Write the queued ids to the Ids table."""
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        if not pending:
+            return
+
+        try:
+            with self.connection_pool.connection() as connection:
+                db_conn = DatabaseConnector(connection)
+                try:
+                    for start in range(0, len(pending), self.max_batch_size):
+                        db_conn.add_ids(pending[start:start + self.max_batch_size])
+                finally:
+                    db_conn.close()
+        except Exception:
+            logging.exception("Failed to write %s request ids", len(pending))
+            self.failed_flush_count += 1
+            now = int(time.time())
+            with self.lock:
+                # Retry the ids that can still be replayed, ahead of any queued since
+                self.pending = [item for item in pending if item[1] >= now] + self.pending
+            return
+
+        self.flushed_count += len(pending)
+
+    def _run(self):
+        """Write-behind loop run by the writer thread."""
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def get_metrics(self) -> dict:
+        """
+        Get replay guard metrics.
+
+        Returns:
+            dict: Live ids and buckets, accepted and rejected ids, ids written and waiting, and failed writes.
+        """
+        with self.lock:
+            return {
+                'live_ids': len(self.ids),
+                'buckets': len(self.buckets),
+                'accepted_count': self.accepted_count,
+                'rejected_count': self.rejected_count,
+                'pending_count': len(self.pending),
+                'flushed_count': self.flushed_count,
+                'failed_flush_count': self.failed_flush_count
+            }
+
+    def stop(self):
+        """Stop the writer thread and write any ids still queued."""
+        self._stop_event.set()
+        self._thread.join()
+        self.flush()
@@ -1,11 +1,10 @@
-import ast
-import json
-from decimal import Decimal
+import base64
 from flask import Request
 
-from database import ConnectionPool, DatabaseConnector
-from database_operations import DatabaseHandler
-from request_verification import RequestData, VerifyRequest
+from database import ConnectionPool
+from replay_guard import ReplayGuard
+from admission import AdmissionControl
+from request_verification import RequestData, VerifyRequest, ValidatorPlan
 from response import Response
 from encryption import Encryption
 
@@ -18,54 +17,53 @@ class TransferRequest(VerifyRequest):
         request (Request): The Flask request object.
         encryption (Encryption): An instance of the Encryption class.
         connection_pool (ConnectionPool): Connection pool for database connections.
+        replay_guard (ReplayGuard): In-memory replay guard, None to check request ids in the database.
+        admission_control (AdmissionControl): Rate limits per wallet key, if any.
 
     Returns:
         Response: The response object.
     """
 
-    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool):
-        super().__init__(request, encryption, connection_pool)
+    VALIDATOR_PLAN = ValidatorPlan(
+        required=['request_id',
+                  'request_expiry_time',
+                  'transfer_amount',
+                  'sender_key',
+                  'recipient_key',
+                  'signature',
+                  'encryption_key'],
+        message_vars=['request_id',
+                      'request_expiry_time',
+                      'transfer_amount',
+                      'sender_key',
+                      'recipient_key'],
+        verifying_key_name='sender_key'
+    )
+
+    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool,
+                 replay_guard: ReplayGuard = None, admission_control: AdmissionControl = None):
+        super().__init__(request, encryption, connection_pool, replay_guard, admission_control)
 
         self.request: RequestData = None
 
         # Verify and process the transfer request
-        self.response = self.verify_request(
-            required=['request_id',
-                      'request_expiry_time',
-                      'transfer_amount',
-                      'sender_key',
-                      'recipient_key',
-                      'signature',
-                      'encryption_key'],
-            message_vars=['request_id',
-                          'request_expiry_time',
-                          'transfer_amount',
-                          'sender_key',
-                          'recipient_key'],
-            verifying_key_name='sender_key'
-        )
+        self.response = self.verify_request(self.VALIDATOR_PLAN)
         if self.response.status_code == 200:
-            self.response = DatabaseHandler(self.connection_pool).add_id(self.request.data['request_id'],
-                                   self.request.data['request_expiry_time'])
+            self.response = self.add_request_id()
             if self.response.status_code == 200:
                 self.response = self.transfer()
 
     def transfer(self):
         # Extract data from the request
         data = self.request.data
-        amount_decimal = Decimal(data['transfer_amount'])
+        amount = self.request.amounts['transfer_amount']
 
-        db_conn = DatabaseConnector(self.connection_pool.get_conn())
+        db_conn = self.get_db_connector()
 
-        # Get master keys for sender and recipient
-        sender_master_key = db_conn.get_master_from_alias(data['sender_key'])
-        recipient_master_key = db_conn.get_master_from_alias(data['recipient_key'])
-
-        # Perform the transfer
-        response = db_conn.transfer(sender_master_key, recipient_master_key, amount_decimal)
+        # Perform the transfer, resolving aliases to their master keys on the database server
+        response = db_conn.transfer(data['sender_key'], data['recipient_key'], amount)
 
         db_conn.close()
-        self.connection_pool.putconn(db_conn.conn)
 
         return response
 
@@ -78,40 +76,44 @@ class DeleteTransactionRequest(VerifyRequest):
         request (Request): The Flask request object.
         encryption (Encryption): An instance of the Encryption class.
         connection_pool (ConnectionPool): Connection pool for database connections.
+        replay_guard (ReplayGuard): In-memory replay guard, None to check request ids in the database.
+        admission_control (AdmissionControl): Rate limits per wallet key, if any.
 
     Returns:
         Response: The response object.
     """
 
-    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool):
-        super().__init__(request, encryption, connection_pool)
+    VALIDATOR_PLAN = ValidatorPlan(
+        required=['request_id',
+                  'request_expiry_time',
+                  'transaction_id',
+                  'master_key',
+                  'signature',
+                  'encryption_key'],
+        message_vars=['request_id',
+                      'request_expiry_time',
+                      'transaction_id',
+                      'master_key'],
+        verifying_key_name='master_key'
+    )
+
+    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool,
+                 replay_guard: ReplayGuard = None, admission_control: AdmissionControl = None):
+        super().__init__(request, encryption, connection_pool, replay_guard, admission_control)
 
         self.request: RequestData = None
 
         # Verify and process the delete transaction request
-        self.response = self.verify_request(
-            required=['request_id',
-                      'request_expiry_time',
-                      'transaction_id',
-                      'master_key',
-                      'signature',
-                      'encryption_key'],
-            message_vars=['request_id',
-                          'request_expiry_time',
-                          'transaction_id',
-                          'master_key'],
-            verifying_key_name='master_key'
-        )
+        self.response = self.verify_request(self.VALIDATOR_PLAN)
         if self.response.status_code == 200:
-            self.response = DatabaseHandler(self.connection_pool).add_id(self.request.data['request_id'],
-                                   self.request.data['request_expiry_time'])
+            self.response = self.add_request_id()
             if self.response.status_code == 200:
                 self.response = self.delete_transaction()
 
     def delete_transaction(self):
         # Extract data from the request
         data = self.request.data
-        db_conn = DatabaseConnector(self.connection_pool.get_conn())
+        db_conn = self.get_db_connector()
 
         # Get transaction owner
         response = db_conn.get_transaction_owner(data['transaction_id'])
@@ -126,7 +128,6 @@ class DeleteTransactionRequest(VerifyRequest):
             )
 
         db_conn.close()
-        self.connection_pool.putconn(db_conn.conn)
 
         return response
 
@@ -144,45 +145,35 @@ class GetTransactionsRequest(VerifyRequest):
         Response: The response object.
     """
 
+    VALIDATOR_PLAN = ValidatorPlan(
+        required=['transaction_ids',
+                  'encryption_key']
+    )
+
     def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool):
         super().__init__(request, encryption, connection_pool)
 
         self.request: RequestData = None
 
         # Verify and process the get transactions request
-        self.response = self.verify_request(
-            required=['transaction_ids',
-                      'encryption_key']
-        )
+        self.response = self.verify_request(self.VALIDATOR_PLAN)
         if self.response.status_code == 200:
             self.response = self.get_transactions()
 
     def get_transactions(self):
         # Extract data from the request
-        transaction_ids = ast.literal_eval(self.request.data['transaction_ids'])
-        transaction_ids = list(map(str, transaction_ids))
+        transaction_ids = self.request.transaction_ids  # Parsed and validated once during verification
 
-        db_conn = DatabaseConnector(self.connection_pool.get_conn())
+        db_conn = self.get_db_connector()
 
-        transactions = {}
-
-        # Retrieve transaction details for each transaction ID
-        for transaction_id in transaction_ids:
-            response = db_conn.get_transaction(transaction_id)
-            if response.status_code == 200:
-                transactions[transaction_id] = json.dumps({
-                    'transaction_type': response.transaction_type,
-                    'transaction_amount': response.transaction_amount,
-                    'expiry_time': response.expiry_time,
-                    'status': response.status
-                })
+        # Retrieve transaction details for every transaction ID in one query
+        transactions = db_conn.get_transactions(transaction_ids)
 
         db_conn.close()
-        self.connection_pool.putconn(db_conn.conn)
 
         return Response(
             message='success',
-            transactions=json.dumps(transactions),
+            transactions=transactions,
             status_code=200
         )
 
@@ -195,52 +186,55 @@ class CreateTransactionRequest(VerifyRequest):
         request (Request): The Flask request object.
         encryption (Encryption): An instance of the Encryption class.
         connection_pool (ConnectionPool): Connection pool for database connections.
+        replay_guard (ReplayGuard): In-memory replay guard, None to check request ids in the database.
+        admission_control (AdmissionControl): Rate limits per wallet key, if any.
 
     Returns:
         Response: The response object.
     """
 
-    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool):
-        super().__init__(request, encryption, connection_pool)
-
-        self.request: RequestData = None
-
-        # Verify and process the create transaction request
-        self.response = self.verify_request(
-            required=['request_id',
+    VALIDATOR_PLAN = ValidatorPlan(
+        required=['request_id',
+                  'request_expiry_time',
+                  'transaction_expiry_time',
+                  'transaction_amount',
+                  'transaction_type',
+                  'master_key',
+                  'signature',
+                  'encryption_key'],
+        message_vars=['request_id',
                       'request_expiry_time',
                       'transaction_expiry_time',
                       'transaction_amount',
                       'transaction_type',
-                      'master_key',
-                      'signature',
-                      'encryption_key'],
-            message_vars=['request_id',
-                          'request_expiry_time',
-                          'transaction_expiry_time',
-                          'transaction_amount',
-                          'transaction_type',
-                          'master_key'],
-            verifying_key_name='master_key'
-        )
+                      'master_key'],
+        verifying_key_name='master_key'
+    )
+
+    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool,
+                 replay_guard: ReplayGuard = None, admission_control: AdmissionControl = None):
+        super().__init__(request, encryption, connection_pool, replay_guard, admission_control)
+
+        self.request: RequestData = None
+
+        # Verify and process the create transaction request
+        self.response = self.verify_request(self.VALIDATOR_PLAN)
         if self.response.status_code == 200:
-            self.response = DatabaseHandler(self.connection_pool).add_id(self.request.data['request_id'],
-                                   self.request.data['request_expiry_time'])
+            self.response = self.add_request_id()
             if self.response.status_code == 200:
                 self.response = self.create_transaction()
 
     def create_transaction(self):
         # Extract data from the request
         data = self.request.data
-        db_conn = DatabaseConnector(self.connection_pool.get_conn())
+        db_conn = self.get_db_connector()
 
         response = db_conn.insert_transaction(transaction_type=data['transaction_type'],
                                                public_key=data['master_key'],
-                                               amount=Decimal(data['transaction_amount']),
+                                               amount=self.request.amounts['transaction_amount'],
                                                expiry_time=int(data['transaction_expiry_time']))
 
         db_conn.close()
-        self.connection_pool.putconn(db_conn.conn)
 
         return response
 
@@ -253,46 +247,49 @@ class CompleteTransactionRequest(VerifyRequest):
         request (Request): The Flask request object.
         encryption (Encryption): An instance of the Encryption class.
         connection_pool (ConnectionPool): Connection pool for database connections.
+        replay_guard (ReplayGuard): In-memory replay guard, None to check request ids in the database.
+        admission_control (AdmissionControl): Rate limits per wallet key, if any.
 
     Returns:
         Response: The response object.
     """
 
-    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool):
-        super().__init__(request, encryption, connection_pool)
+    VALIDATOR_PLAN = ValidatorPlan(
+        required=['request_id',
+                  'request_expiry_time',
+                  'transaction_id',
+                  'master_key',
+                  'signature',
+                  'encryption_key'],
+        message_vars=['request_id',
+                      'request_expiry_time',
+                      'transaction_id',
+                      'master_key'],
+        verifying_key_name='master_key'
+    )
+
+    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool,
+                 replay_guard: ReplayGuard = None, admission_control: AdmissionControl = None):
+        super().__init__(request, encryption, connection_pool, replay_guard, admission_control)
 
         self.request: RequestData = None
 
         # Verify and process the complete transaction request
-        self.response = self.verify_request(
-            required=['request_id',
-                      'request_expiry_time',
-                      'transaction_id',
-                      'master_key',
-                      'signature',
-                      'encryption_key'],
-            message_vars=['request_id',
-                          'request_expiry_time',
-                          'transaction_id',
-                          'master_key'],
-            verifying_key_name='master_key'
-        )
+        self.response = self.verify_request(self.VALIDATOR_PLAN)
         if self.response.status_code == 200:
-            self.response = DatabaseHandler(self.connection_pool).add_id(self.request.data['request_id'],
-                                   self.request.data['request_expiry_time'])
+            self.response = self.add_request_id()
             if self.response.status_code == 200:
                 self.response = self.complete_transaction()
 
     def complete_transaction(self):
         # Extract data from the request
         data = self.request.data
-        db_conn = DatabaseConnector(self.connection_pool.get_conn())
+        db_conn = self.get_db_connector()
 
         response = db_conn.complete_transaction(transaction_id=data['transaction_id'],
                                                 master_key=data['master_key'])
 
         db_conn.close()
-        self.connection_pool.putconn(db_conn.conn)
 
         return response
 
@@ -305,35 +302,39 @@ class AddAliasRequest(VerifyRequest):
         request (Request): The Flask request object.
         encryption (Encryption): An instance of the Encryption class.
         connection_pool (ConnectionPool): Connection pool for database connections.
+        replay_guard (ReplayGuard): In-memory replay guard, None to check request ids in the database.
+        admission_control (AdmissionControl): Rate limits per wallet key, if any.
 
     Returns:
         Response: The response object.
     """
 
-    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool):
-        super().__init__(request, encryption, connection_pool)
+    VALIDATOR_PLAN = ValidatorPlan(
+        required=['request_id',
+                  'request_expiry_time',
+                  'alias_expiry_time',
+                  'alias_address',
+                  'master_key',
+                  'signature',
+                  'encryption_key'],
+        message_vars=['request_id',
+                      'request_expiry_time',
+                      'alias_expiry_time',
+                      'alias_address',
+                      'master_key'],
+        verifying_key_name='master_key'
+    )
+
+    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool,
+                 replay_guard: ReplayGuard = None, admission_control: AdmissionControl = None):
+        super().__init__(request, encryption, connection_pool, replay_guard, admission_control)
 
         self.request: RequestData = None
 
         # Verify and process the add alias request
-        self.response = self.verify_request(
-            required=['request_id',
-                      'request_expiry_time',
-                      'alias_expiry_time',
-                      'alias_address',
-                      'master_key',
-                      'signature',
-                      'encryption_key'],
-            message_vars=['request_id',
-                          'request_expiry_time',
-                          'alias_expiry_time',
-                          'alias_address',
-                          'master_key'],
-            verifying_key_name='master_key'
-        )
+        self.response = self.verify_request(self.VALIDATOR_PLAN)
         if self.response.status_code == 200:
-            self.response = DatabaseHandler(self.connection_pool).add_id(self.request.data['request_id'],
-                                   self.request.data['request_expiry_time'])
+            self.response = self.add_request_id()
             if self.response.status_code == 200:
                 self.response = self.add_alias()
 
@@ -341,13 +342,12 @@ class AddAliasRequest(VerifyRequest):
         # Extract data from the request
         data = self.request.data
 
-        db_conn = DatabaseConnector(self.connection_pool.get_conn())
+        db_conn = self.get_db_connector()
 
         response = db_conn.add_alias_address(data['alias_address'],
                                              data['master_key'],
                                              int(data['alias_expiry_time']))
         db_conn.close()
-        self.connection_pool.putconn(db_conn.conn)
 
         return response
 
@@ -360,33 +360,37 @@ class DeleteAliasRequest(VerifyRequest):
         request (Request): The Flask request object.
         encryption (Encryption): An instance of the Encryption class.
         connection_pool (ConnectionPool): Connection pool for database connections.
+        replay_guard (ReplayGuard): In-memory replay guard, None to check request ids in the database.
+        admission_control (AdmissionControl): Rate limits per wallet key, if any.
 
     Returns:
         Response: The response object.
     """
 
-    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool):
-        super().__init__(request, encryption, connection_pool)
+    VALIDATOR_PLAN = ValidatorPlan(
+        required=['request_id',
+                  'request_expiry_time',
+                  'alias_address',
+                  'master_key',
+                  'signature',
+                  'encryption_key'],
+        message_vars=['request_id',
+                      'alias_address',
+                      'master_key',
+                      'request_expiry_time'],
+        verifying_key_name='master_key'
+    )
+
+    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool,
+                 replay_guard: ReplayGuard = None, admission_control: AdmissionControl = None):
+        super().__init__(request, encryption, connection_pool, replay_guard, admission_control)
 
         self.request: RequestData = None
 
         # Verify and process the delete alias request
-        self.response = self.verify_request(
-            required=['request_id',
-                      'request_expiry_time',
-                      'alias_address',
-                      'master_key',
-                      'signature',
-                      'encryption_key'],
-            message_vars=['request_id',
-                          'alias_address',
-                          'master_key',
-                          'request_expiry_time'],
-            verifying_key_name='master_key'
-        )
+        self.response = self.verify_request(self.VALIDATOR_PLAN)
         if self.response.status_code == 200:
-            self.response = DatabaseHandler(self.connection_pool).add_id(self.request.data['request_id'],
-                                   self.request.data['request_expiry_time'])
+            self.response = self.add_request_id()
             if self.response.status_code == 200:
                 self.response = self.delete_alias()
 
@@ -394,7 +398,7 @@ class DeleteAliasRequest(VerifyRequest):
         # Extract data from the request
         data = self.request.data
 
-        db_conn = DatabaseConnector(self.connection_pool.get_conn())
+        db_conn = self.get_db_connector()
 
         alias_owner = db_conn.get_master_from_alias(data['alias_address'])
 
@@ -409,7 +413,6 @@ class DeleteAliasRequest(VerifyRequest):
             )
 
         db_conn.close()
-        self.connection_pool.putconn(db_conn.conn)
 
         return response
 
@@ -422,31 +425,35 @@ class GetBalanceRequest(VerifyRequest):
         request (Request): The Flask request object.
         encryption (Encryption): An instance of the Encryption class.
         connection_pool (ConnectionPool): Connection pool for database connections.
+        replay_guard (ReplayGuard): In-memory replay guard, None to check request ids in the database.
+        admission_control (AdmissionControl): Rate limits per wallet key, if any.
 
     Returns:
         Response: The response object.
     """
 
-    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool):
-        super().__init__(request, encryption, connection_pool)
+    VALIDATOR_PLAN = ValidatorPlan(
+        required=['request_id',
+                  'request_expiry_time',
+                  'master_key',
+                  'signature',
+                  'encryption_key'],
+        message_vars=['request_id',
+                      'request_expiry_time',
+                      'master_key'],
+        verifying_key_name='master_key'
+    )
+
+    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool,
+                 replay_guard: ReplayGuard = None, admission_control: AdmissionControl = None):
+        super().__init__(request, encryption, connection_pool, replay_guard, admission_control)
 
         self.request: RequestData = None
 
         # Verify and process the get balance request
-        self.response = self.verify_request(
-            required=['request_id',
-                      'request_expiry_time',
-                      'master_key',
-                      'signature',
-                      'encryption_key'],
-            message_vars=['request_id',
-                          'request_expiry_time',
-                          'master_key'],
-            verifying_key_name='master_key'
-        )
+        self.response = self.verify_request(self.VALIDATOR_PLAN)
         if self.response.status_code == 200:
-            self.response = DatabaseHandler(self.connection_pool).add_id(self.request.data['request_id'],
-                                   self.request.data['request_expiry_time'])
+            self.response = self.add_request_id()
             if self.response.status_code == 200:
                 self.response = self.get_balance()
 
@@ -454,7 +461,7 @@ class GetBalanceRequest(VerifyRequest):
         # Extract data from the request
         data = self.request.data
 
-        db_conn = DatabaseConnector(self.connection_pool.get_conn())
+        db_conn = self.get_db_connector()
 
         # Get the balance for the master key
         balance = db_conn.get_balance(data['master_key'])
@@ -465,6 +472,48 @@ class GetBalanceRequest(VerifyRequest):
         )
 
         db_conn.close()
-        self.connection_pool.putconn(db_conn.conn)
 
         return response
+
+
+class HandshakeRequest(VerifyRequest):
+    """
+    Handles handshake requests.
+
+    Establishes a short-lived session whose key seals later requests and their
+    responses with AES-GCM instead of RSA.
+    
+    Args:
+        request (Request): The Flask request object.
+        encryption (Encryption): An instance of the Encryption class.
+        connection_pool (ConnectionPool): Connection pool for database connections.
+
+    Returns:
+        Response: The response object.
+    """
+
+    VALIDATOR_PLAN = ValidatorPlan(
+        required=['encryption_key']
+    )
+
+    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool):
+        super().__init__(request, encryption, connection_pool)
+
+        self.request: RequestData = None
+
+        # Verify and process the handshake request
+        self.response = self.verify_request(self.VALIDATOR_PLAN)
+        if self.response.status_code == 200:
+            self.response = self.create_session()
+
+    def create_session(self):
+        session = self.encryption.create_session()
+
+        # The session key is only ever sent encrypted to the client's encryption key
+        return Response(
+            message='success',
+            session_id=session.session_id,
+            session_key=base64.b64encode(session.key).decode('utf-8'),
+            expiry_time=str(session.expiry_time),
+            status_code=200
+        )
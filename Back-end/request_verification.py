@@ -1,20 +1,21 @@
 import time
 import re
-import ast
 import json
 import base64
 import string
-from decimal import Decimal, InvalidOperation
 from flask import Request
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import ed25519
-from cryptography.exceptions import InvalidSignature
 from response import Response
 from tools import CustomList
+from amounts import Amount
 from config import TransactionConfig, TransferLimits
-from database import ConnectionPool
-from encryption import Encryption
+from database import ConnectionPool, DatabaseConnector
+from database_operations import DatabaseHandler, get_request_connection
+from replay_guard import ReplayGuard
+from admission import AdmissionControl
+from encryption import Encryption, Envelope, StreamingLegacyDecryptor
+from framing import BinaryFrame
+from compact_payload import CompactPayload
+from signatures import SignatureBatcher, verify_ed25519, split_raw_signed, RAW_SIGNED_PREFIX
 
 MAX_REQUEST_EXPIRY_TIME = TransactionConfig.MAX_REQUEST_EXPIRY_TIME
 MAX_TRANSACTION_EXPIRY_TIME = TransactionConfig.MAX_TRANSACTION_EXPIRY_TIME
@@ -23,10 +24,15 @@ MAX_TRANSFER_PRECISION = TransferLimits.MAX_TRANSFER_PRECISION
 MAX_TRANSFER_AMOUNT = TransferLimits.MAX_TRANSFER_AMOUNT
 MIN_TRANSFER_AMOUNT = TransferLimits.MIN_TRANSFER_AMOUNT
 MAX_REQUEST_SIZE = TransactionConfig.MAX_REQUEST_SIZE
+READ_BLOCK_SIZE = TransactionConfig.READ_BLOCK_SIZE
+MAX_TRANSACTION_IDS = TransactionConfig.MAX_TRANSACTION_IDS
 
 class RequestData:
     """
     Class representing request data and providing methods for verification.
+
+    The verify_* field checkers return None if the field is valid and an error
+    Response otherwise, so valid requests allocate no responses.
     """
 
     ID_LENGTH = 32
@@ -35,31 +41,38 @@ class RequestData:
     ALLOWED_TRANSACTION_TYPES = ['SEND', 'RECEIVE']
 
     @staticmethod
-    def is_valid_decimal(number: str):
-        """Check if a string represents a valid decimal number."""
-        try:
-            Decimal(number)
-            return True
-        except InvalidOperation:
-            return False
-    
-    @staticmethod
-    def count_decimal_digits(value: str):
-        """Count the decimal digits in a string."""
-        match = re.match(r"^(\d*\.\d*?)0*$", value)
-        if match:
-            return len(match.group(1).split('.')[1])
-        else:
-            return 0
-        
-    @staticmethod
-    def is_list(string: str):
-        """Check if a string represents a valid list."""
-        try:
-            ast.literal_eval(string)
-            return True
-        except SyntaxError:
-            return False
+    def parse_id_list(string: str, max_length: int):
+        """
+        Parse a list of ids in one linear pass.
+
+        Accepts a JSON array, the Dart List.toString() form ("[1, 2]") sent by the
+        client, and the str() of a list sent as a JSON array. Items are returned
+        as strings without their quotes and are not validated.
+
+        Args:
+            string (str): List to parse.
+            max_length (int): Maximum number of items.
+
+        Returns:
+            tuple: Items, or None if the string is not a list. A list longer than max_length
+            is returned truncated to max_length + 1 items, so the caller can reject it.
+        """
+        string = string.strip()
+        if len(string) < 2 or string[0] != '[' or string[-1] != ']':
+            return None
+
+        body = string[1:-1].strip()
+        if not body:
+            return ()
+
+        items = body.split(',', max_length)  # Stops splitting after max_length + 1 items
+        ids = []
+        for item in items:
+            item = item.strip()
+            if len(item) >= 2 and item[0] == item[-1] and item[0] in '"\'':
+                item = item[1:-1]
+            ids.append(item)
+        return tuple(ids)
     
     @staticmethod
     def is_hex(string: str):
@@ -86,12 +99,14 @@ class RequestData:
         """Initialize RequestData object with the given data."""
         data = {key: str(value) for key, value in data.items()}
         self.data = data
+        self.amounts = {}
+        self.transaction_ids = None  # Parsed by verify_transaction_ids_syntax
     
     def verify_id_syntax(self, var_name: str, var: str):
         """Verify syntax of an ID."""
         request_id = var
 
-        if not request_id.isdigit():
+        if not (request_id.isascii() and request_id.isdigit()):
             response = Response(
                 error_message=f'invalid_{var_name}',
                 message= f'{var_name} must be an integer.',
@@ -104,42 +119,40 @@ class RequestData:
                 status_code=400
             )
         else:
-            response = Response(
-                message='valid',
-                status_code=200
-            )
+            response = None
         
         return response
     
     def verify_transaction_ids_syntax(self, var_name: str, var: str):
-        """Verify syntax of transaction IDs."""
-        if not RequestData.is_list(var):
+        """Verify syntax of transaction IDs, caching the parsed IDs in transaction_ids."""
+        ids = RequestData.parse_id_list(var, MAX_TRANSACTION_IDS)
+        if ids is None:
             response = Response(
                 error_message=f'invalid_{var_name}',
                 message= f'{var_name} must be a list.',
                 status_code=400
             )
-        else:        
-            ids = ast.literal_eval(var)
-            ids = list(map(str, ids))
-            
-            if len(ids) == 0:
-                response = Response(
-                    error_message=f'invalid_{var_name}',
-                    message='Transaction id list is empty.',
-                    status_code=400
-                )
+        elif len(ids) == 0:
+            response = Response(
+                error_message=f'invalid_{var_name}',
+                message='Transaction id list is empty.',
+                status_code=400
+            )
+        elif len(ids) > MAX_TRANSACTION_IDS:
+            response = Response(
+                error_message=f'invalid_{var_name}',
+                message=f'Too many transaction ids. Maximum is {MAX_TRANSACTION_IDS}.',
+                status_code=400
+            )
+        else:
+            for transaction_id in ids:
+                response = self.verify_id_syntax(var_name, transaction_id)
+                if response is not None:
+                    response.error_message = f'invalid_{var_name}'
+                    break
             else:
-                for transaction_id in ids:
-                    response = self.verify_id_syntax(var_name, transaction_id)
-                    if response.status_code != 200:
-                        response.error_message = f'invalid_{var_name}'
-                        break
-                else:
-                    response =  Response(
-                        message='valid',
-                        status_code=200
-                    )
+                self.transaction_ids = ids
+                response = None
         
         return response
     
@@ -167,10 +180,7 @@ class RequestData:
                 status_code=400
             )
         else:
-            response =  Response(
-                message='valid',
-                status_code=200
-            )
+            response = None
         
         return response
     
@@ -197,10 +207,7 @@ class RequestData:
                 status_code=400
             )
         else:
-            response = Response(
-                message='valid',
-                status_code=200
-            )
+            response = None
         
         return response
     
@@ -217,38 +224,41 @@ class RequestData:
         return self.verify_expiry_time(var_name, var, MAX_TRANSACTION_EXPIRY_TIME)
 
     def verify_amount(self, var_name: str, var: str):
-        """Verify syntax of an amount."""
-        amount = var
+        """Verify syntax of an amount, keeping the parsed amount in self.amounts."""
+        try:
+            amount = Amount.parse(var)
+            error = None
+        except ValueError as parse_error:
+            amount = None
+            error = parse_error.args[0]
 
-        if not RequestData.is_valid_decimal(amount):
+        if error == Amount.INVALID:
             response = Response(
                 error_message=f'invalid_{var_name}',
                 message= f'{var_name} must be a valid decimal.',
                 status_code=400
             )
-        elif RequestData.count_decimal_digits(amount) > MAX_TRANSFER_PRECISION:
+        elif error == Amount.TOO_PRECISE:
             response = Response(
                 error_message=f'invalid_{var_name}',
                 message= f'{var_name} has too many decimal places. Max is {MAX_TRANSFER_PRECISION}.',
                 status_code=400
             )
-        elif Decimal(amount) > MAX_TRANSFER_AMOUNT:
+        elif (error == Amount.TOO_LARGE) or (amount > MAX_TRANSFER_AMOUNT):
             response = Response(
                 error_message=f'invalid_{var_name}',
                 message= f'{var_name} is too large. Max is {MAX_TRANSFER_AMOUNT}.',
                 status_code=400
             )
-        elif Decimal(amount) < MIN_TRANSFER_AMOUNT:
+        elif amount < MIN_TRANSFER_AMOUNT:
             response = Response(
                 error_message=f'invalid_{var_name}',
                 message= f'{var_name} is too small. Min is {MIN_TRANSFER_AMOUNT}.',
                 status_code=400
             )
         else:
-            response = Response(
-                message='valid',
-                status_code=200
-            )
+            self.amounts[var_name] = amount
+            response = None
         
         return response
     
@@ -269,10 +279,7 @@ class RequestData:
                 status_code=400
             )
         else:
-            response = Response(
-                message='valid',
-                status_code=200
-            )
+            response = None
         
         return response
     
@@ -285,6 +292,15 @@ class RequestData:
                 status_code=400
             )
         else:
+            response = None
+        
+        return response
+
+    def verify_signature(self, verifying_key_name: str, message_vars: list, signature_batcher: SignatureBatcher = None) -> Response:
+        """Verify a signature, in a batch when a signature batcher is given."""
+        message_vars = CustomList(message_vars)
+        response = self.verify_sorted_signature(verifying_key_name, message_vars.merge_sort(), signature_batcher)
+        if response is None:
             response = Response(
                 message='valid',
                 status_code=200
@@ -292,31 +308,27 @@ class RequestData:
         
         return response
 
-    def verify_signature(self, verifying_key_name: str, message_vars: list) -> Response:
-        """Verify a signature."""
+    def verify_sorted_signature(self, verifying_key_name: str, message_vars_sorted, signature_batcher: SignatureBatcher = None):
+        """Verify a signature over already sorted message variables. Returns None if it is valid."""
         public_key_b64 = self.data[verifying_key_name]
         signature_b64 = self.data['signature']
 
-        message_vars = CustomList(message_vars)
-        message_vars_sorted = message_vars.merge_sort()
-        
         message_dict = {}
         for var_name in message_vars_sorted:
             message_dict[var_name] = self.data[var_name]
         
         message = json.dumps(message_dict, separators=(',', ':')).encode('utf-8')
 
-        public_key_bytes = base64.b64decode(public_key_b64)
         signature = base64.b64decode(signature_b64)
-        public_key = ed25519.Ed25519PublicKey.from_public_bytes(public_key_bytes)
 
-        try:
-            public_key.verify(signature, message)
-            response = Response(
-                message='valid',
-                status_code=200
-            )
-        except InvalidSignature:
+        if signature_batcher is not None:
+            valid = signature_batcher.verify(public_key_b64, signature, message)
+        else:
+            valid = verify_ed25519(public_key_b64, signature, message)
+
+        if valid:
+            response = None
+        else:
             response = Response(
                 error_message='invalid_signature',
                 message= 'Invalid signature',
@@ -342,10 +354,7 @@ class RequestData:
                 status_code=400
             )
         else:
-            response = Response(
-                message='valid',
-                status_code=200
-            )
+            response = None
         
         return response
 
@@ -359,95 +368,158 @@ class RequestData:
                 message= f'{var_name} contains invalid characters. It should only contain base64 characters.',
                 status_code=400
             )
-        elif len(encryption_key) != 392:
+        elif len(encryption_key) not in (Encryption.KEY_LENGTH, Encryption.X25519_KEY_LENGTH):
             response = Response(
                 error_message=f'invalid_{var_name}',
-                message= f'{var_name} length is incorrect. It should be a 392 characters long.',
+                message= f'{var_name} length is incorrect. It should be {Encryption.KEY_LENGTH} characters long for an RSA key or {Encryption.X25519_KEY_LENGTH} for an X25519 key.',
                 status_code=400
             )
-        elif not RequestData.valid_rsa_public_key(encryption_key):
+        elif not RequestData.valid_encryption_public_key(encryption_key):
             response = Response(
                 error_message=f'invalid_{var_name}',
-                message= f'{var_name} is not a valid RSA public key.',
+                message= f'{var_name} is not a valid RSA or X25519 public key.',
                 status_code=400
             )
         else:
-            response = Response(
-                message='valid',
-                encryption_key=encryption_key,
-                status_code=200
-            )
+            response = None
         
         return response
     
     @staticmethod
-    def valid_rsa_public_key(public_key: str) -> bool:
-        """Check if a string represents a valid RSA public key."""
-        serialized_public_key = base64.b64decode(public_key)
+    def valid_encryption_public_key(public_key: str) -> bool:
+        """Check if a string represents a valid RSA or X25519 public key."""
         try:
-            serialization.load_der_public_key(
-                serialized_public_key,
-                backend=default_backend()
-            )
+            Encryption.load_public_key(public_key)  # Parsed key is cached for response encryption
             return True
         except ValueError:
             return False
 
+    # Field checker for each request field, bound to a RequestData by ValidatorPlan
+    FIELD_CHECKERS = {
+        'request_id' : verify_id_syntax,
+        'transaction_id' : verify_id_syntax,
+        'transaction_ids' : verify_transaction_ids_syntax,
+        'alias_address' : verify_public_key_syntax,
+        'master_key' : verify_public_key_syntax,
+        'request_expiry_time' : verify_request_expiry_time,
+        'alias_expiry_time' : verify_alias_expiry_time,
+        'transaction_expiry_time' : verify_transaction_expiry_time,
+        'transaction_amount' : verify_amount,
+        'transfer_amount' : verify_amount,
+        'signature' : verify_signature_syntax,
+        'transaction_type' : verify_transaction_type,
+        'sender_key' : verify_public_key_syntax,
+        'recipient_key' : verify_public_key_syntax,
+        'data' : verify_encrypted_data_syntax,
+        'encryption_key' : verify_encryption_key
+    }
+
     def verify(self, required: list) -> Response:
         """Verify the request data against the required keys."""
-        
-        data_keys = list(self.data.keys())
-        
-        missing_keys = [key for key in required if key not in data_keys]
-        if missing_keys:
+        response = ValidatorPlan(required).verify(self)
+        if response is None:
             response = Response(
+                message='valid',
+                encryption_key=self.data.get('encryption_key') if 'encryption_key' in required else None,
+                status_code=200
+            )
+        
+        return response
+
+
+class ValidatorPlan:
+    """
+    Validation plan for one endpoint, compiled once when the request class is defined.
+
+    The field order, bound field checkers and sorted signature fields are worked
+    out up front, so verifying a request is a single loop over the fields that
+    only builds a Response when a check fails.
+
+    Attributes:
+        required (tuple): Required fields, in the order they are checked.
+        checkers (tuple): (field name, field checker) pairs.
+        signature_fields (tuple): Sorted fields covered by the signature, None if the endpoint is unsigned.
+        verifying_key_name (str): Field holding the key that verifies the signature.
+        returns_encryption_key (bool): True if the endpoint takes a client encryption key.
+        session_plan (ValidatorPlan): Plan for session envelopes, which need no client encryption key.
+        raw_signed_plan (ValidatorPlan): Plan for raw-signed requests, whose signature is checked before parsing.
+    """
+
+    def __init__(self, required: list, message_vars: list = None, verifying_key_name: str = None):
+        """
+        Compile a validation plan.
+
+        Args:
+            required (list): List of required elements in the request.
+            message_vars (list): List of message variables for signature verification.
+            verifying_key_name (str): Name of the verifying key.
+        """
+        self.required = tuple(required)
+        self.required_keys = frozenset(required)
+        self.checkers = tuple((key, RequestData.FIELD_CHECKERS[key]) for key in required)
+        self.signature_fields = None if message_vars is None else tuple(CustomList(message_vars).merge_sort())
+        self.verifying_key_name = verifying_key_name
+        self.returns_encryption_key = 'encryption_key' in self.required_keys
+
+        self.session_plan = self
+        if self.returns_encryption_key:
+            self.session_plan = ValidatorPlan([key for key in required if key != 'encryption_key'],
+                                              message_vars, verifying_key_name)
+
+        # Raw-signed requests carry their signature outside the JSON and have already been verified
+        self.raw_signed_plan = self
+        if self.signature_fields is not None:
+            self.raw_signed_plan = ValidatorPlan([key for key in required if key != 'signature'],
+                                                 None, verifying_key_name)
+
+    def verify(self, request_data: RequestData):
+        """
+        Check that the required fields are present and valid.
+
+        Args:
+            request_data (RequestData): Request data to verify.
+
+        Returns:
+            Response: Error response, or None if every field is valid.
+        """
+        data = request_data.data
+        if not self.required_keys.issubset(data):
+            missing_keys = [key for key in self.required if key not in data]
+            return Response(
                 error_message='missing_keys',
                 message=f'Missing {", ".join(missing_keys)} in JSON data',
                 status_code=400
             )
-        else:
-            verification_functions = {
-                'request_id' : self.verify_id_syntax,
-                'transaction_id' : self.verify_id_syntax,
-                'transaction_ids' : self.verify_transaction_ids_syntax,
-                'alias_address' : self.verify_public_key_syntax,
-                'master_key' : self.verify_public_key_syntax,
-                'request_expiry_time' : self.verify_request_expiry_time,
-                'alias_expiry_time' : self.verify_alias_expiry_time,
-                'transaction_expiry_time' : self.verify_transaction_expiry_time,
-                'transaction_amount' : self.verify_amount,
-                'transfer_amount' : self.verify_amount,
-                'signature' : self.verify_signature_syntax,
-                'transaction_type' : self.verify_transaction_type,
-                'sender_key' : self.verify_public_key_syntax,
-                'recipient_key' : self.verify_public_key_syntax,
-                'data' : self.verify_encrypted_data_syntax,
-                'encryption_key' : self.verify_encryption_key
-
-            }
-            
-            encryption_key = None
-            for key in required:
-                response = verification_functions[key](var_name=key, var=self.data[key])
-                if response.encryption_key is not None:
-                    encryption_key = response.encryption_key
-                if response.status_code != 200:
-                    break
-            else:
-                response = Response(
-                    message='valid',
-                    encryption_key=encryption_key,
-                    status_code=200
-                )
-        
-        return response
+
+        for key, checker in self.checkers:
+            response = checker(request_data, key, data[key])
+            if response is not None:
+                return response
+        return None
+
+    def verify_signature(self, request_data: RequestData, signature_batcher: SignatureBatcher = None):
+        """
+        Verify the request signature, if the endpoint is signed.
+
+        Args:
+            request_data (RequestData): Request data to verify.
+            signature_batcher (SignatureBatcher): Batcher to verify in, if any.
+
+        Returns:
+            Response: Error response, or None if the signature is valid or not required.
+        """
+        if self.signature_fields is None:
+            return None
+        return request_data.verify_sorted_signature(self.verifying_key_name, self.signature_fields, signature_batcher)
+
 
 class VerifyRequest:
     """
     Class to handle the verification of incoming requests.
     """
 
-    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool) -> None:
+    def __init__(self, request: Request, encryption: Encryption, connection_pool: ConnectionPool,
+                 replay_guard: ReplayGuard = None, admission_control: AdmissionControl = None) -> None:
         """
         Initialize the VerifyRequest instance.
 
@@ -455,13 +527,19 @@ class VerifyRequest:
             request (Request): The incoming request object.
             encryption (Encryption): The encryption object.
             connection_pool (ConnectionPool): The connection pool object.
+            replay_guard (ReplayGuard): In-memory replay guard, None to check request ids in the database.
+            admission_control (AdmissionControl): Rate limits per verifying key, if any.
         """
         self.request = request
         self.connection_pool = connection_pool
+        self.replay_guard = replay_guard
+        self.admission_control = admission_control
         self.data = None
         self.response = None
         self.encryption_key = None
         self.encryption = encryption
+        self.envelope = Envelope(Encryption.LEGACY_FORMAT)
+        self.raw_signer_key = None
 
         self.verify_encrypted_data()
 
@@ -469,33 +547,52 @@ class VerifyRequest:
         """
         Verify the encrypted data in the incoming request.
         """
-        # Get the content length from the request headers
-        content_length = int(self.request.headers.get('Content-Length'))
+        # Get the content length from the request headers, None if the client sent none or an invalid one
+        content_length = self.request.content_length
 
         # Check if the content length exceeds the maximum allowed size
-        if content_length > MAX_REQUEST_SIZE:
-            self.response = Response(
-                error_message='request_too_large',
-                message=f'Request size is too large. Maximum is {MAX_REQUEST_SIZE} bytes.',
-                status_code=413
-            )
+        if (content_length is not None) and (content_length > MAX_REQUEST_SIZE):
+            self.response = self.request_too_large()
             return
         else:
-            # Extract encrypted data from the request
-            encrypted_data = self.request.data
-
-            # Decrypt the encrypted data
-            response = self.encryption.decrypt_message(encrypted_data)
+            # Receive and decrypt the encrypted data
+            response = self.receive_encrypted_data()
 
             # Check the status code of the decryption response
             if response.status_code != 200:
                 self.response = response
                 return
 
+            # CBOR plaintexts are returned as bytes, JSON plaintexts as str
+            plaintext = response.message
+            compact = isinstance(plaintext, bytes)
+            self.envelope.compact = compact  # Answer in CBOR, even if the payload turns out to be invalid
+
+            # Raw-signed requests are verified over the decrypted bytes before they are parsed
+            if plaintext[:len(RAW_SIGNED_PREFIX)] in (RAW_SIGNED_PREFIX, RAW_SIGNED_PREFIX.encode('ascii')):
+                plaintext = self.verify_raw_signature(plaintext)
+                if plaintext is None:
+                    return
+
+            if compact:
+                try:
+                    self.data = CompactPayload.decode_request(plaintext)
+                except ValueError:
+                    self.response = Response(
+                        error_message='invalid_cbor',
+                        message='Invalid CBOR data in encrypted data.',
+                        status_code=400
+                    )
+                return
+
             # Try to load the decrypted data as JSON
             try:
-                self.data = json.loads(response.message)
+                self.data = json.loads(plaintext)
             except json.JSONDecodeError:
+                self.data = None
+
+            if not isinstance(self.data, dict):
+                self.data = None
                 self.response = Response(
                     error_message='invalid_json',
                     message='Invalid JSON data in encrypted data.',
@@ -503,14 +600,133 @@ class VerifyRequest:
                 )
                 return
 
-    def verify_request(self, required: list, message_vars: list = None, verifying_key_name: str = None):
+    @staticmethod
+    def request_too_large() -> Response:
+        """
+        Build the response returned for request bodies over MAX_REQUEST_SIZE.
+
+        Returns:
+            Response: request_too_large error response.
+        """
+        return Response(
+            error_message='request_too_large',
+            message=f'Request size is too large. Maximum is {MAX_REQUEST_SIZE} bytes.',
+            status_code=413
+        )
+
+    def receive_encrypted_data(self) -> Response:
+        """
+        Read the request body in blocks, enforcing MAX_REQUEST_SIZE on the bytes actually received.
+
+        Legacy text envelopes are decrypted block by block as they arrive. Other
+        envelopes are collected and decrypted once the body is complete. A
+        rejected body is still read to its end, up to MAX_REQUEST_SIZE, so no
+        unread input is left on a keep-alive connection.
+
+        Returns:
+            Response: Decrypted message and status code.
+        """
+        stream = self.request.stream
+        received = 0
+        body = bytearray()
+        decryptor = None
+        format_known = False
+
+        while True:
+            data = stream.read(READ_BLOCK_SIZE)
+            if not data:
+                break
+            received += len(data)
+            if received > MAX_REQUEST_SIZE:
+                return self.request_too_large()
+
+            if decryptor is not None:
+                decryptor.feed(data)  # Once the body is rejected the rest is discarded without decrypting it
+                continue
+            body += data
+
+            # Pick how to decrypt once the envelope prefix has arrived
+            if (not format_known) and (len(body) >= Encryption.PREFIX_LENGTH):
+                format_known = True
+                if ((not BinaryFrame.is_binary(body))
+                        and (Encryption.get_envelope_format(bytes(body[:Encryption.PREFIX_LENGTH])) == Encryption.LEGACY_FORMAT)):
+                    decryptor = StreamingLegacyDecryptor(self.encryption)
+                    decryptor.feed(bytes(body))
+                    body = None
+
+        if decryptor is not None:
+            self.envelope = decryptor.envelope
+            return decryptor.finish()
+
+        # Parse the envelope once, and remember it so the response can be encrypted the same way
+        self.envelope = self.encryption.get_envelope(bytes(body))
+        return self.encryption.decrypt_envelope(self.envelope)
+
+    def verify_raw_signature(self, plaintext: str):
+        """
+        Verify the signature of a raw-signed request over its exact payload bytes.
+
+        Args:
+            plaintext (str | bytes): Decrypted request body, as bytes if its payload is CBOR.
+
+        Returns:
+            str | bytes: The signed JSON or CBOR payload, or None if the signature is invalid, in which case self.response is set.
+        """
+        parts = split_raw_signed(plaintext)
+        if parts is not None:
+            public_key_b64, signature_b64, payload = parts
+            try:
+                signature = base64.b64decode(signature_b64, validate=True)
+            except ValueError:
+                signature = None
+
+            if signature is not None:
+                message = payload if isinstance(payload, bytes) else payload.encode('utf-8')
+                signature_batcher = self.encryption.signature_batcher
+                if signature_batcher is not None:
+                    valid = signature_batcher.verify(public_key_b64, signature, message)
+                else:
+                    valid = verify_ed25519(public_key_b64, signature, message)
+
+                if valid:
+                    self.raw_signer_key = public_key_b64
+                    return payload
+
+        self.response = Response(
+            error_message='invalid_signature',
+            message='Invalid signature',
+            status_code=400
+        )
+        return None
+
+    def get_db_connector(self) -> DatabaseConnector:
+        """
+        Get a DatabaseConnector on the connection of this request.
+
+        Returns:
+            DatabaseConnector: Connector with its own cursor, to be closed when done. The
+            connection is returned to the pool when the request is torn down.
+        """
+        return DatabaseConnector(get_request_connection(self.connection_pool))
+
+    def add_request_id(self) -> Response:
+        """
+        Record the request id, so the request cannot be replayed.
+
+        Returns:
+            Response: The response object, invalid_id if the id has been used.
+        """
+        data = self.request.data
+        if self.replay_guard is not None:
+            return self.replay_guard.add_id(data['request_id'], data['request_expiry_time'])
+        return DatabaseHandler(self.connection_pool).add_id(data['request_id'], data['request_expiry_time'])
+
+    def verify_request(self, plan: ValidatorPlan):
         """
         Verify the incoming request.
 
         Args:
-            required (List): List of required elements in the request.
-            message_vars (List): List of message variables for signature verification.
-            verifying_key_name (str): Name of the verifying key.
+            plan (ValidatorPlan): Compiled validation plan of the endpoint.
 
         Returns:
             Response: The response object indicating the result of the verification.
@@ -518,23 +734,41 @@ class VerifyRequest:
         if self.response is not None:
             return self.response
 
+        # Session envelopes are answered with the session key, so no client encryption key is needed
+        if self.envelope.session is not None:
+            plan = plan.session_plan
+        if self.raw_signer_key is not None:
+            plan = plan.raw_signed_plan
+
         # Create a RequestData instance using the decrypted data
         self.request = RequestData(self.data)
 
         # Verify the required elements in the request
-        response = self.request.verify(required)
-        self.encryption_key = response.encryption_key
-
-        # Check the status code of the verification response
-        if response.status_code != 200:
+        response = plan.verify(self.request)
+        if response is not None:
             return response
 
-        # Verify the signature if message variables are provided
-        if message_vars is not None:
-            response = self.request.verify_signature(verifying_key_name, message_vars)
+        if plan.returns_encryption_key:
+            self.encryption_key = self.request.data['encryption_key']
 
-            # Check the status code of the signature verification response
-            if response.status_code != 200:
+        # A raw signature must come from the key the endpoint verifies against
+        if (self.raw_signer_key is not None) and (plan.verifying_key_name is not None):
+            if self.request.data[plan.verifying_key_name] != self.raw_signer_key:
+                return Response(
+                    error_message='invalid_signature',
+                    message='Invalid signature',
+                    status_code=400
+                )
+
+        # Verify the signature if the endpoint is signed
+        response = plan.verify_signature(self.request, self.encryption.signature_batcher)
+        if response is not None:
+            return response
+
+        # Rate limit the verified key before any database work
+        if (self.admission_control is not None) and (plan.verifying_key_name is not None):
+            response = self.admission_control.check_key(self.request.data[plan.verifying_key_name])
+            if response is not None:
                 return response
 
         # Return a valid response if all verifications pass
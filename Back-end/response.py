@@ -1,4 +1,7 @@
 import json
+import base64
+from amounts import Amount
+from compact_payload import CompactPayload
 
 class Response:
     """
@@ -15,17 +18,27 @@ class Response:
         expiry_time (str, optional): An optional expiry time.
         status (str, optional): An optional status.
         public_key (str, optional): An optional public key.
-        transactions (str, optional): An optional transactions field.
+        transactions (dict, optional): Optional transactions, keyed by transaction ID.
         balance (str, optional): An optional balance.
         encryption_key (str, optional): An optional encryption key.
+        session_id (str, optional): An optional handshake session ID.
+        session_key (str, optional): An optional base64-encoded handshake session key.
+        retry_after (int, optional): Seconds to wait before retrying, sent as the Retry-After header.
 
     Returns:
         None
 
     Methods:
         json(): Converts the Response object to a JSON-formatted string.
+        cbor(): Converts the Response object to a CBOR map with typed values.
+        headers(): Gets the HTTP headers of the response.
     """
 
+    # Typed fields of CBOR responses, sent as text in JSON responses
+    AMOUNT_FIELDS = frozenset(['transfer_amount', 'transaction_amount', 'balance'])
+    INTEGER_FIELDS = frozenset(['status_code', 'transaction_id', 'expiry_time', 'retry_after'])
+    KEY_FIELDS = frozenset(['public_key', 'encryption_key', 'session_key'])
+
     def __init__(
         self,
         message: str,
@@ -38,9 +51,12 @@ class Response:
         expiry_time: str = None,
         status: str = None,
         public_key: str = None,
-        transactions: str = None,
+        transactions: dict = None,
         balance: str = None,
-        encryption_key: str = None
+        encryption_key: str = None,
+        session_id: str = None,
+        session_key: str = None,
+        retry_after: int = None
     ):
         # Initialize Response attributes
         self.message = message
@@ -56,6 +72,9 @@ class Response:
         self.transactions = transactions
         self.balance = balance
         self.encryption_key = encryption_key
+        self.session_id = session_id
+        self.session_key = session_key
+        self.retry_after = retry_after
     
     def json(self):
         """
@@ -74,4 +93,70 @@ class Response:
             if attr_value is not None:
                 response_dict[attr_name] = attr_value
 
+        # Each transaction is sent as a JSON string inside the JSON response
+        if self.transactions is not None:
+            response_dict['transactions'] = json.dumps({
+                transaction_id: json.dumps(transaction) for transaction_id, transaction in self.transactions.items()
+            })
+
         return json.dumps(response_dict)
+
+    @classmethod
+    def _typed_value(cls, attr_name: str, attr_value):
+        """Convert a response value to its CBOR type."""
+        if isinstance(attr_value, (dict, Amount)):
+            return attr_value
+        if attr_name in cls.AMOUNT_FIELDS:
+            return Amount.parse(str(attr_value))
+        if attr_name in cls.INTEGER_FIELDS:
+            return int(attr_value)
+        if attr_name in cls.KEY_FIELDS:
+            return base64.b64decode(attr_value)
+        return attr_value
+
+    def cbor(self):
+        """
+        Converts the Response object to a CBOR map.
+
+        Amounts are sent as decimal fractions, ids and times as integers, keys as
+        raw bytes and transactions as a list of maps, each with its transaction_id.
+
+        Args:
+            None
+
+        Returns:
+            bytes: CBOR encoding of the Response object.
+        """
+        response_dict = {'message': self.message}
+
+        # Add non-None variables to the response_dict
+        for attr_name, attr_value in self.__dict__.items():
+            if attr_value is not None:
+                response_dict[attr_name] = self._typed_value(attr_name, attr_value)
+
+        if self.transactions is not None:
+            response_dict['transactions'] = [
+                dict(
+                    {'transaction_id': int(transaction_id)},
+                    **{attr_name: self._typed_value(attr_name, attr_value) for attr_name, attr_value in transaction.items()}
+                )
+                for transaction_id, transaction in self.transactions.items()
+            ]
+
+        return CompactPayload.encode(response_dict)
+
+    def headers(self):
+        """
+        Gets the HTTP headers of the response.
+
+        Args:
+            None
+
+        Returns:
+            dict: Headers to send with the response.
+        """
+        headers = {}
+        if self.retry_after is not None:
+            headers['Retry-After'] = str(self.retry_after)
+
+        return headers
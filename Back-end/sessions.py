@@ -0,0 +1,137 @@
+import time  # Import time module for session expiry
+import hmac  # Import hmac module for deriving session keys
+import hashlib  # Import hashlib module for deriving session keys
+import secrets  # Import secrets module for random session ids
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM  # Import AES-GCM for sealing session messages
+
+from key_ring import KeyRingManager  # Import KeyRingManager for the secrets session keys are derived from
+from tools import LRUCache  # Import LRUCache for the bounded session table
+
+
+class Session:
+    """
+    A short-lived symmetric session established through /api/handshake.
+
+    Attributes:
+        session_id (str): Session id, "<server key id>-<expiry time>-<random hex>".
+        key (bytes): AES-256-GCM session key.
+        expiry_time (int): Time after which the session is rejected.
+        aead (AESGCM): Cipher for the session key.
+        confirmed (bool): True once the session is known to be genuine, because this process
+            created it or a client has sealed a message with its key.
+    """
+
+    __slots__ = ('session_id', 'key', 'expiry_time', 'aead', 'confirmed')
+
+    def __init__(self, session_id: str, key: bytes, expiry_time: int, confirmed: bool = False):
+        self.session_id = session_id
+        self.key = key
+        self.expiry_time = expiry_time
+        self.aead = AESGCM(key)
+        self.confirmed = confirmed
+
+
+class SessionManager:
+    """
+    Issues sessions and looks them up by id.
+
+    Session keys are derived from the session id with the session secret of the
+    server key that was current when the session was created. Any process
+    sharing the key ring can therefore rebuild a session it did not create, and
+    a session can never outlive its server key. Rebuilt sessions are kept in a
+    bounded LRU table, so steady-state lookups cost no key derivation. Anyone
+    can make up a well-formed session id, so a rebuilt session is only added to
+    the table once a message sealed with its key has been opened, and ids
+    expiring more than the session lifetime ahead are rejected outright.
+    """
+
+    SESSION_ID_SEPARATOR = '-'
+    RANDOM_BYTES = 8
+
+    def __init__(self, key_ring_manager: KeyRingManager, ttl: int, max_sessions: int):
+        """
+        Initialize the SessionManager.
+
+        Args:
+            key_ring_manager (KeyRingManager): Key ring holding the session secrets.
+            ttl (int): Session lifetime in seconds.
+            max_sessions (int): Maximum number of sessions kept in the session table.
+        """
+        self.key_ring_manager = key_ring_manager
+        self.ttl = ttl
+        self.sessions = LRUCache(max_sessions)
+
+    @staticmethod
+    def _derive_key(session_secret: bytes, session_id: str) -> bytes:
+        """Derive the AES key of a session from a server key's session secret."""
+        return hmac.new(session_secret, session_id.encode('ascii'), hashlib.sha256).digest()
+
+    def create_session(self) -> Session:
+        """
+        Create a new session.
+
+        Returns:
+            Session: New session.
+        """
+        server_key = self.key_ring_manager.get_key_ring().current
+        expiry_time = int(time.time()) + self.ttl
+        session_id = self.SESSION_ID_SEPARATOR.join([server_key.key_id,
+                                                      str(expiry_time),
+                                                      secrets.token_hex(self.RANDOM_BYTES)])
+
+        session = Session(session_id, self._derive_key(server_key.session_secret, session_id), expiry_time,
+                          confirmed=True)
+        self.sessions.put(session_id, session)
+        return session
+
+    def get_session(self, session_id: str):
+        """
+        Get a live session by id.
+
+        Args:
+            session_id (str): Session id sent by the client.
+
+        Returns:
+            Session: Matching session, or None if the id is malformed, unknown or expired. A session
+            rebuilt from its id is unconfirmed until confirm_session is called.
+        """
+        now = time.time()
+        session = self.sessions.get(session_id)
+        if session is None:
+            parts = session_id.split(self.SESSION_ID_SEPARATOR)
+            if (len(parts) != 3) or (not session_id.isascii()) or (not parts[1].isdigit()):
+                return None
+
+            expiry_time = int(parts[1])
+            if (expiry_time <= now) or (expiry_time > now + self.ttl):
+                return None  # Expired, or further ahead than any session this server issues
+
+            server_key = self.key_ring_manager.get_server_key(parts[0])
+            if server_key is None:
+                return None  # Issued under a key that has left the key ring
+
+            return Session(session_id, self._derive_key(server_key.session_secret, session_id), expiry_time)
+
+        if session.expiry_time <= now:
+            return None
+        return session
+
+    def confirm_session(self, session: Session):
+        """
+        Add a rebuilt session to the session table once a message sealed with its key has been opened.
+
+        Args:
+            session (Session): Session returned by get_session.
+        """
+        if not session.confirmed:
+            session.confirmed = True
+            self.sessions.put(session.session_id, session)
+
+    def get_stats(self) -> dict:
+        """
+        Get session table statistics.
+
+        Returns:
+            dict: Session table size, hits, misses and evictions.
+        """
+        return self.sessions.get_stats()
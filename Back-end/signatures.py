@@ -0,0 +1,279 @@
+import time  # Import time module for batch windows
+import base64  # Import base64 module for decoding public keys
+import queue  # Import queue module for collecting signatures from request threads
+import logging  # Import logging module for batch failures
+import threading  # Import threading for the batch verification thread
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError  # Import Future for handing results back to request threads
+from cryptography.hazmat.primitives.asymmetric import ed25519  # Import Ed25519 module
+from cryptography.exceptions import InvalidSignature  # Raised when an Ed25519 signature does not verify
+
+from tools import LRUCache  # Import LRUCache for caching verifying keys
+from crypto_service import CryptoService  # Import CryptoService for optionally verifying large batches in worker processes
+from config import SignatureConfig  # Import signature configuration
+
+# Constructed Ed25519 verifying keys, keyed by their base64 form as sent in requests
+verifying_key_cache = LRUCache(SignatureConfig.VERIFYING_KEY_CACHE_SIZE)
+
+# Raw-signed plaintexts are "r1.<public key b64>.<signature b64>.<payload>", signed over the payload bytes
+RAW_SIGNED_PREFIX = 'r1.'
+RAW_SIGNED_SEPARATOR = '.'
+PUBLIC_KEY_LENGTH = 44
+SIGNATURE_LENGTH = 88
+
+
+def load_verifying_key(public_key_b64: str) -> ed25519.Ed25519PublicKey:
+    """
+    Load an Ed25519 public key through the verifying key cache.
+
+    Args:
+        public_key_b64 (str): Base64-encoded raw public key.
+
+    Returns:
+        Ed25519PublicKey: Verifying key.
+
+    Raises:
+        ValueError: If the key is not valid base64 or not a valid Ed25519 public key.
+    """
+    public_key = verifying_key_cache.get(public_key_b64)
+    if public_key is None:
+        public_key = ed25519.Ed25519PublicKey.from_public_bytes(base64.b64decode(public_key_b64))
+        verifying_key_cache.put(public_key_b64, public_key)
+    return public_key
+
+
+def verify_ed25519(public_key_b64: str, signature: bytes, message: bytes) -> bool:
+    """
+    Verify an Ed25519 signature on the calling thread.
+
+    Args:
+        public_key_b64 (str): Base64-encoded raw public key.
+        signature (bytes): Signature.
+        message (bytes): Signed message.
+
+    Returns:
+        bool: True if the signature is valid.
+    """
+    try:
+        load_verifying_key(public_key_b64).verify(signature, message)
+        return True
+    except (InvalidSignature, ValueError):
+        return False
+
+
+def split_raw_signed(plaintext):
+    """
+    Split a raw-signed plaintext into its signer, signature and payload.
+
+    Base64 never contains the separator, so the payload is everything after the
+    third one and is passed through untouched.
+
+    Args:
+        plaintext (str | bytes): Decrypted request body starting with RAW_SIGNED_PREFIX,
+            as bytes if its payload is CBOR.
+
+    Returns:
+        tuple: (public key b64, signature b64, payload), or None if the header is malformed.
+            The payload has the type of the plaintext.
+    """
+    if isinstance(plaintext, bytes):
+        parts = plaintext.split(RAW_SIGNED_SEPARATOR.encode('ascii'), 3)
+    else:
+        parts = plaintext.split(RAW_SIGNED_SEPARATOR, 3)
+    if (len(parts) != 4) or (len(parts[1]) != PUBLIC_KEY_LENGTH) or (len(parts[2]) != SIGNATURE_LENGTH):
+        return None
+    if isinstance(plaintext, bytes):
+        if not (parts[1].isascii() and parts[2].isascii()):
+            return None
+        return parts[1].decode('ascii'), parts[2].decode('ascii'), parts[3]
+    return parts[1], parts[2], parts[3]
+
+
+class SignatureBatcher:
+    """
+    Verifies signatures from concurrently arriving requests in batches.
+
+    Request threads queue their signature and wait. A batch thread takes the
+    first queued signature, collects any others that arrive within the batch
+    window, and verifies them one after another with the cached verifying keys.
+    With a crypto service, batches of at least MIN_OFFLOAD_SIZE signatures are
+    sent to its worker processes instead, falling back to the batch thread if
+    the workers fail; smaller batches are not worth the round trip. A request
+    thread whose batch does not finish within the verify timeout, or that
+    arrives after stop(), verifies its signature itself.
+
+    Attributes:
+        batch_window (float): Seconds to wait for more signatures after the first one.
+        max_batch_size (int): Maximum number of signatures per batch.
+        verify_timeout (float): Seconds a request thread waits for its batch.
+        crypto_service (CryptoService): Crypto service to offload large batches to, None to verify every batch in-process.
+    """
+
+    MIN_OFFLOAD_SIZE = 32  # An Ed25519 check takes ~50us, so only large batches outweigh the round trip to a worker
+
+    def __init__(self, batch_window: float, max_batch_size: int, verify_timeout: float,
+                 crypto_service: CryptoService = None):
+        """
+        Initialize the SignatureBatcher and start its batch thread.
+
+        Args:
+            batch_window (float): Seconds to wait for more signatures after the first one.
+            max_batch_size (int): Maximum number of signatures per batch.
+            verify_timeout (float): Seconds a request thread waits for its batch before verifying inline.
+            crypto_service (CryptoService): Crypto service to offload large batches to, None to verify every batch in-process.
+        """
+        self.crypto_service = crypto_service
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.verify_timeout = verify_timeout
+        self.pending = queue.SimpleQueue()
+
+        self._metrics_lock = threading.Lock()
+        self.batch_count = 0
+        self.signature_count = 0
+        self.max_seen_batch_size = 0
+        self.offload_count = 0
+        self.fallback_count = 0
+        self.timeout_count = 0
+
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='signature-batcher', daemon=True)
+        self._thread.start()
+
+    def verify(self, public_key_b64: str, signature: bytes, message: bytes) -> bool:
+        """
+        Queue a signature for the next batch and wait for its result.
+
+        Args:
+            public_key_b64 (str): Base64-encoded raw public key.
+            signature (bytes): Signature.
+            message (bytes): Signed message.
+
+        Returns:
+            bool: True if the signature is valid.
+        """
+        if self._stop_event.is_set() or not self._thread.is_alive():
+            return verify_ed25519(public_key_b64, signature, message)
+
+        future = Future()
+        self.pending.put((public_key_b64, signature, message, future))
+        try:
+            return future.result(timeout=self.verify_timeout)
+        except FutureTimeoutError:
+            # The batch thread is stuck or gone, the late result is ignored
+            with self._metrics_lock:
+                self.timeout_count += 1
+            return verify_ed25519(public_key_b64, signature, message)
+
+    def _collect_batch(self) -> list:
+        """Wait for a signature, then collect more until the batch window ends or the batch is full."""
+        item = self.pending.get()
+        if item is None:
+            return []  # Woken by stop()
+        batch = [item]
+        deadline = time.perf_counter() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self.pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is not None:
+                batch.append(item)
+        return batch
+
+    def _verify_batch(self, batch: list) -> list:
+        """
+        Verify a batch of queued signatures.
+
+        Args:
+            batch (list): (public key, signature, message, future) tuples.
+
+        Returns:
+            list: True/False for each signature.
+        """
+        if (self.crypto_service is not None) and (len(batch) >= self.MIN_OFFLOAD_SIZE):
+            results = self._offload_batch(batch)
+            if results is not None:
+                return results
+            with self._metrics_lock:
+                self.fallback_count += 1
+
+        return [verify_ed25519(public_key_b64, signature, message) for public_key_b64, signature, message, _ in batch]
+
+    def _offload_batch(self, batch: list):
+        """
+        Verify a batch of queued signatures on the crypto service's worker processes.
+
+        Args:
+            batch (list): (public key, signature, message, future) tuples.
+
+        Returns:
+            list: True/False for each signature, or None if the workers failed.
+        """
+        results = [False] * len(batch)
+        jobs = []
+        job_indexes = []
+        for index, (public_key_b64, signature, message, _) in enumerate(batch):
+            try:
+                jobs.append((base64.b64decode(public_key_b64), signature, message))
+                job_indexes.append(index)
+            except ValueError:
+                pass  # A key that is not valid base64 never verifies
+
+        job_results = self.crypto_service.verify_ed25519(jobs) if jobs else []
+        if job_results is None:
+            return None
+
+        with self._metrics_lock:
+            self.offload_count += 1
+        for index, result in zip(job_indexes, job_results):
+            results[index] = result
+        return results
+
+    def _run(self):
+        """Batch loop run by the batch thread."""
+        while not self._stop_event.is_set():
+            batch = self._collect_batch()
+            if not batch:
+                continue
+            try:
+                results = self._verify_batch(batch)
+            except Exception as error:
+                logging.exception("Signature batch of %s failed", len(batch))
+                for _, _, _, future in batch:
+                    future.set_exception(error)
+                continue
+
+            with self._metrics_lock:
+                self.batch_count += 1
+                self.signature_count += len(batch)
+                self.max_seen_batch_size = max(self.max_seen_batch_size, len(batch))
+            for (_, _, _, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def get_metrics(self) -> dict:
+        """
+        Get batching metrics.
+
+        Returns:
+            dict: Batches and signatures verified, largest batch, offloaded batches, fallbacks, timed out waits
+            and verifying key cache statistics.
+        """
+        with self._metrics_lock:
+            return {
+                'batch_count': self.batch_count,
+                'signature_count': self.signature_count,
+                'mean_batch_size': self.signature_count / self.batch_count if self.batch_count else 0.0,
+                'max_batch_size': self.max_seen_batch_size,
+                'offload_count': self.offload_count,
+                'fallback_count': self.fallback_count,
+                'timeout_count': self.timeout_count,
+                'verifying_key_cache': verifying_key_cache.get_stats()
+            }
+
+    def stop(self):
+        """Stop the batch thread once its current batch is done."""
+        self._stop_event.set()
+        self.pending.put(None)
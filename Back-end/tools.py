@@ -1,3 +1,7 @@
+import threading
+from collections import OrderedDict
+
+
 class CustomList(list):
     """
     CustomList class, a subclass of the built-in list class,
@@ -166,3 +170,79 @@ class BinarySearch:
 
         return -1  # Target element not found
 
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded least recently used cache with hit/miss counters.
+
+    Methods:
+    - get(key): Get a cached value, or None if it is not cached.
+    - put(key, value): Add a value, evicting the least recently used entry when full.
+    - get_stats(): Get the cache size and hit/miss counters.
+    """
+
+    def __init__(self, max_size: int):
+        """
+        Initialize LRUCache object.
+
+        Args:
+            max_size (int): Maximum number of entries to keep.
+        """
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Get a cached value and mark it as most recently used.
+
+        Args:
+            key: Cache key.
+
+        Returns:
+            The cached value, or None if the key is not cached.
+        """
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Add a value to the cache.
+
+        Args:
+            key: Cache key.
+            value: Value to cache. None values are not stored.
+        """
+        if value is None:
+            return
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def get_stats(self):
+        """
+        Get cache statistics.
+
+        Returns:
+        dict: Current size, maximum size, hits, misses and evictions.
+        """
+        with self.lock:
+            return {
+                'size': len(self.items),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }